@@ -25,36 +25,52 @@ CREATE TABLE profiles (
     first_name VARCHAR(100),
     last_name VARCHAR(100),
     profile_url VARCHAR(255),
-    age INTEGER,
+    age INTEGER, -- возраст на момент загрузки из VK
+    birth_date DATE, -- без года в VK - год-заглушка 1904
+    birth_year_missing BOOLEAN DEFAULT FALSE,
     sex INTEGER, -- 1 - женский, 2 - мужской
-    city VARCHAR(100)
+    city VARCHAR(100),
+    interests TEXT,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP -- последняя загрузка из VK
 );
 
+CREATE INDEX idx_profile_city ON profiles (city);
+CREATE INDEX idx_profile_sex ON profiles (sex);
+CREATE INDEX idx_profile_birth_date ON profiles (birth_date);
+CREATE INDEX idx_profile_fetched ON profiles (fetched_at);
+
 -- Таблица для фотографий
 CREATE TABLE photos (
     id SERIAL PRIMARY KEY,
     profile_id INTEGER REFERENCES profiles(id) ON DELETE CASCADE,
     photo_url VARCHAR(500) NOT NULL,
     likes_count INTEGER DEFAULT 0,
-    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    owner_id INTEGER, -- вложение photo{owner_id}_{vk_photo_id}
+    vk_photo_id INTEGER,
+    fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+CREATE INDEX idx_photos_profile_fetched ON photos (profile_id, fetched_at);
+
 -- Таблица избранных
 CREATE TABLE favorites (
     id SERIAL PRIMARY KEY,
     bot_user_id INTEGER REFERENCES bot_users(id) ON DELETE CASCADE,
     profile_id INTEGER REFERENCES profiles(id) ON DELETE CASCADE,
     added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(bot_user_id, profile_id)
+    CONSTRAINT uq_favorites_user_profile UNIQUE(bot_user_id, profile_id)
 );
 
+CREATE INDEX idx_favorites_user_added ON favorites (bot_user_id, added_at, id);
+
 -- Таблица черного списка
 CREATE TABLE blacklist (
     id SERIAL PRIMARY KEY,
     bot_user_id INTEGER REFERENCES bot_users(id) ON DELETE CASCADE,
     profile_id INTEGER REFERENCES profiles(id) ON DELETE CASCADE,
     added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE(bot_user_id, profile_id)
+    CONSTRAINT uq_blacklist_user_profile UNIQUE(bot_user_id, profile_id)
 );
 
 -- Таблица предпочтений поиска
@@ -68,6 +84,18 @@ CREATE TABLE search_preferences (
     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
+-- Таблица позиций поиска в VK по критериям пользователя
+CREATE TABLE search_cursors (
+    id SERIAL PRIMARY KEY,
+    bot_user_id INTEGER REFERENCES bot_users(id) ON DELETE CASCADE,
+    criteria_hash VARCHAR(40) NOT NULL, -- хеш города, возраста и пола
+    search_sort INTEGER, -- следующий запрос users.search
+    search_offset INTEGER DEFAULT 0,
+    exhausted BOOLEAN DEFAULT FALSE, -- все стратегии поиска пройдены
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_search_cursor_user_criteria UNIQUE(bot_user_id, criteria_hash)
+);
+
 -- Таблица для истории просмотров
 CREATE TABLE viewed_profiles (
     id SERIAL PRIMARY KEY,
@@ -76,6 +104,8 @@ CREATE TABLE viewed_profiles (
     viewed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     UNIQUE(bot_user_id, profile_id)
 );
+
+CREATE INDEX idx_viewed_profiles_user_viewed_at ON viewed_profiles (bot_user_id, viewed_at);
 -- Таблица для лайков фотографий
 CREATE TABLE photo_likes (
     id SERIAL PRIMARY KEY,
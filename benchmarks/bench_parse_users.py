@@ -0,0 +1,117 @@
+"""Микробенчмарк разбора ответа users.search на 1000 пользователях
+
+Сравнивает прежний разбор (json + словарь на пользователя, datetime.now()
+для каждой даты рождения) с общим конвейером src.vk_bot.user_parser.
+
+    python benchmarks/bench_parse_users.py [--users 1000] [--repeat 200]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.vk_bot import user_parser  # noqa: E402
+from src.vk_bot.user_parser import loads, parse_users  # noqa: E402
+
+CITIES = [(1, 'Москва'), (2, 'Санкт-Петербург'), (99, 'Новосибирск'), (49, 'Екатеринбург')]
+
+
+def make_fixture(count: int, seed: int = 42) -> bytes:
+    # Ответ users.search: открытые и закрытые профили, даты с годом и без
+    rnd = random.Random(seed)
+    items = []
+    for i in range(count):
+        item = {
+            'id': 100000 + i,
+            'first_name': f'Имя{i}',
+            'last_name': f'Фамилия{i}',
+            'is_closed': rnd.random() < 0.15,
+            'can_access_closed': True,
+            'sex': rnd.choice((1, 2)),
+            'domain': f'user{i}' if rnd.random() < 0.5 else f'id{100000 + i}',
+            'photo_max_orig': f'https://sun9-{i % 90}.userapi.com/impg/{i}.jpg?size=400x400',
+        }
+        if rnd.random() < 0.9:
+            day, month = rnd.randint(1, 28), rnd.randint(1, 12)
+            item['bdate'] = f'{day}.{month}' if rnd.random() < 0.2 else f'{day}.{month}.{rnd.randint(1970, 2006)}'
+        if rnd.random() < 0.8:
+            city_id, title = rnd.choice(CITIES)
+            item['city'] = {'id': city_id, 'title': title}
+        items.append(item)
+    return json.dumps({'response': {'count': count, 'items': items}}, ensure_ascii=False).encode('utf-8')
+
+
+def legacy_calculate_age(bdate):
+    if not bdate:
+        return None
+    try:
+        parts = bdate.split('.')
+        if len(parts) != 3:
+            return None
+        day, month, year = map(int, parts)
+        birth_date = datetime(year, month, day)
+        today = datetime.now()
+        age = today.year - birth_date.year
+        if (today.month, today.day) < (birth_date.month, birth_date.day):
+            age -= 1
+        return age
+    except (ValueError, AttributeError):
+        return None
+
+
+def legacy_parse(content: bytes):
+    # Разбор до общего конвейера (VKSearcher._parse_users_response)
+    items = json.loads(content)['response']['items']
+    parsed_users = []
+    for user in items:
+        if user.get('is_closed', False):
+            continue
+        parsed_users.append({
+            'vk_id': user['id'],
+            'first_name': user.get('first_name', ''),
+            'last_name': user.get('last_name', ''),
+            'profile_url': f"https://vk.com/{user.get('domain', 'id' + str(user['id']))}",
+            'age': legacy_calculate_age(user.get('bdate')),
+            'sex': user.get('sex', 0),
+            'city': user.get('city', {}).get('title') if user.get('city') else None,
+            'photo_url': user.get('photo_max_orig')
+        })
+    return parsed_users
+
+
+def pipeline_parse(content: bytes):
+    return parse_users(loads(content)['response']['items'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    content = make_fixture(args.users)
+    legacy, pipeline = legacy_parse(content), pipeline_parse(content)
+    assert [u['vk_id'] for u in legacy] == [u.vk_id for u in pipeline]
+    assert [u['age'] for u in legacy] == [u.age for u in pipeline]
+
+    print(f"Пользователей: {args.users} ({len(pipeline)} открытых), ответ {len(content) / 1024:.0f} КБ, "
+          f"JSON: {'orjson' if user_parser.orjson else 'json'}")
+    results = {}
+    for name, parse in (('прежний разбор', legacy_parse), ('общий конвейер', pipeline_parse)):
+        best = min(timeit.repeat(lambda: parse(content), number=args.repeat, repeat=5)) / args.repeat
+        results[name] = best
+        print(f"{name:>16}: {best * 1000:.3f} мс на ответ")
+    print(f"{'ускорение':>16}: x{results['прежний разбор'] / results['общий конвейер']:.2f}")
+
+    legacy_size = sum(sys.getsizeof(u) for u in legacy)
+    pipeline_size = sum(sys.getsizeof(u) for u in pipeline)
+    print(f"{'память записей':>16}: {legacy_size / 1024:.0f} КБ -> {pipeline_size / 1024:.0f} КБ")
+
+
+if __name__ == '__main__':
+    main()
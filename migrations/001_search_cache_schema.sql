@@ -0,0 +1,57 @@
+-- Обновление схемы существующей базы VKinder.
+-- create_tables() (Base.metadata.create_all) создает только отсутствующие
+-- таблицы и не меняет существующие - новые колонки, ограничения и индексы
+-- добавляются этим скриптом. Повторный запуск безопасен:
+--   psql -d vkinder -f migrations/001_search_cache_schema.sql
+
+BEGIN;
+
+-- Анкеты: дата рождения и время загрузки из VK
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS birth_date DATE;
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS birth_year_missing BOOLEAN DEFAULT FALSE;
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS interests TEXT;
+-- Старые анкеты считаются устаревшими - их обновит ProfileRefresher
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS fetched_at TIMESTAMP;
+ALTER TABLE profiles ALTER COLUMN fetched_at SET DEFAULT CURRENT_TIMESTAMP;
+
+DROP INDEX IF EXISTS idx_profile_age;
+CREATE INDEX IF NOT EXISTS idx_profile_city ON profiles (city);
+CREATE INDEX IF NOT EXISTS idx_profile_sex ON profiles (sex);
+CREATE INDEX IF NOT EXISTS idx_profile_birth_date ON profiles (birth_date);
+CREATE INDEX IF NOT EXISTS idx_profile_fetched ON profiles (fetched_at);
+
+-- Фото: id фото в VK для вложений и время загрузки
+ALTER TABLE photos ADD COLUMN IF NOT EXISTS owner_id INTEGER;
+ALTER TABLE photos ADD COLUMN IF NOT EXISTS vk_photo_id INTEGER;
+ALTER TABLE photos ADD COLUMN IF NOT EXISTS fetched_at TIMESTAMP;
+ALTER TABLE photos ALTER COLUMN fetched_at SET DEFAULT CURRENT_TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_photos_profile_fetched ON photos (profile_id, fetched_at);
+
+-- Избранное и черный список: уникальность пары для INSERT ... ON CONFLICT.
+-- Сначала удаляем дубликаты, оставляя самую раннюю запись
+DELETE FROM favorites f USING favorites d
+WHERE f.bot_user_id = d.bot_user_id AND f.profile_id = d.profile_id AND f.id > d.id;
+DELETE FROM blacklist b USING blacklist d
+WHERE b.bot_user_id = d.bot_user_id AND b.profile_id = d.profile_id AND b.id > d.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_favorites_user_profile ON favorites (bot_user_id, profile_id);
+CREATE UNIQUE INDEX IF NOT EXISTS uq_blacklist_user_profile ON blacklist (bot_user_id, profile_id);
+
+-- Постраничный вывод избранного и последние просмотры
+CREATE INDEX IF NOT EXISTS idx_favorites_user_added ON favorites (bot_user_id, added_at, id);
+CREATE INDEX IF NOT EXISTS idx_viewed_profiles_user_viewed_at ON viewed_profiles (bot_user_id, viewed_at);
+
+-- Позиция поиска в VK по критериям пользователя
+CREATE TABLE IF NOT EXISTS search_cursors (
+    id SERIAL PRIMARY KEY,
+    bot_user_id INTEGER REFERENCES bot_users(id) ON DELETE CASCADE,
+    criteria_hash VARCHAR(40) NOT NULL,
+    search_sort INTEGER,
+    search_offset INTEGER DEFAULT 0,
+    exhausted BOOLEAN DEFAULT FALSE,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT uq_search_cursor_user_criteria UNIQUE (bot_user_id, criteria_hash)
+);
+
+COMMIT;
@@ -1,4 +1,5 @@
 
+from typing import List
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -11,11 +12,43 @@ class Settings(BaseSettings):
     VK_GROUP_TOKEN: str = "your_group_token_here"  # Для работы бота
     VK_USER_TOKEN: str = "your_user_token_here"  # Для поиска пользователей
     DEBUG: bool = False
+    DB_ASYNC: bool = False  # Асинхронный движок БД (нужен asyncpg)
+    DB_REPLICA_URLS: str = ""  # URL реплик для чтения через запятую
+    DB_REPLICA_MAX_LAG: float = 5.0  # Допустимое отставание реплики, сек
+    WRITE_BEHIND_INTERVAL_MS: int = 200  # Период пакетной записи просмотров и лайков
+    WRITE_BEHIND_MAX_ROWS: int = 500  # Запись пакета раньше срока при таком числе строк
+    WRITE_BEHIND_MAX_RETRIES: int = 5  # Попыток записи события при ошибках БД, затем оно отбрасывается
+    WRITE_BEHIND_MAX_PENDING: int = 50000  # Предел событий, возвращаемых в буфер после ошибки
+    PROFILE_INDEX: bool = False  # Индекс анкет в памяти для выбора кандидатов (нужен numpy)
+    PROFILE_INDEX_DIR: str = ""  # Общий снимок индекса для нескольких процессов бота
+    PROFILE_INDEX_REBUILD_SEC: int = 600  # Период перестроения общего снимка
+    HARVEST_ENABLED: bool = False  # Фоновое пополнение анкет для популярных критериев
+    HARVEST_HOURS: str = "2-7"  # Непиковые часы пополнения (от-до, местное время)
+    HARVEST_INTERVAL_SEC: int = 1800  # Период запуска пополнения
+    HARVEST_API_BUDGET: int = 100  # Запросов users.search за один запуск
+    HARVEST_TOP_CRITERIA: int = 10  # Сколько популярных сочетаний критериев пополнять
+    HARVEST_POOL_SIZE: int = 500  # Пополнять, пока анкет под критерии меньше
+    PROFILE_TTL_SEC: int = 7 * 24 * 3600  # Срок актуальности данных профиля из VK
+    PHOTO_TTL_SEC: int = 24 * 3600  # Срок актуальности фото профиля из VK
+    REFRESH_ENABLED: bool = False  # Фоновое обновление устаревших профилей и фото
+    REFRESH_INTERVAL_SEC: int = 900  # Период фонового обновления
+    REFRESH_BATCH_SIZE: int = 200  # Профилей за один запрос users.get
+    REFRESH_PHOTO_BATCH: int = 20  # Профилей с устаревшими фото за один запуск
+    SEARCH_DB_MIN_CANDIDATES: int = 0  # Поиск без VK, если в БД столько непросмотренных анкет (0 - всегда VK)
+    STATS_LOG_INTERVAL_SEC: int = 600  # Период записи метрик бота в лог (0 - не писать)
 
     @property
     def DATABASE_URL_psycopg(self) -> str:
         return f"postgresql+psycopg2://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
 
+    @property
+    def DATABASE_URL_asyncpg(self) -> str:
+        return f"postgresql+asyncpg://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
+
+    @property
+    def replica_urls(self) -> List[str]:
+        return [url.strip() for url in self.DB_REPLICA_URLS.split(",") if url.strip()]
+
     LOG_LEVEL: str = "INFO"
     LOG_FILE: str = "vkinder.log"
 
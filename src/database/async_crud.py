@@ -0,0 +1,99 @@
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.database.models import (
+    BotUser, UserState, Profile, Favorite,
+    Blacklist, SearchPreferences
+)
+from src.database.crud import search_profile_filters, after_commit, _insert_ignore_statement
+from src.database.exclusions import exclusion_sets
+from typing import Dict, Optional
+import random
+
+# Асинхронные варианты горячих CRUD операций (режим DB_ASYNC).
+# Как и в crud, функции делают только flush - commit выполняет единица работы
+
+
+# ==================== Операции с пользователями ====================
+
+async def get_bot_user_by_vk_id(db: AsyncSession, vk_id: int) -> Optional[BotUser]:
+    # Получить пользователя бота по VK ID
+    result = await db.execute(select(BotUser).where(BotUser.vk_id == vk_id))
+    return result.scalars().first()
+
+# ==================== Операции с состояниями ====================
+
+
+async def get_user_state(db: AsyncSession, vk_id: int) -> Optional[UserState]:
+    """Получить состояние пользователя"""
+    result = await db.execute(select(UserState).where(UserState.vk_id == vk_id))
+    return result.scalars().first()
+
+
+async def create_or_update_user_state(db: AsyncSession, vk_id: int, state: str = None,
+                                      state_data: Dict = None) -> UserState:
+    """Создать или обновить состояние пользователя"""
+    existing_state = await get_user_state(db, vk_id)
+
+    if not existing_state:
+        existing_state = UserState(vk_id=vk_id)
+        db.add(existing_state)
+
+    if state is not None:
+        existing_state.current_state = state
+    if state_data is not None:
+        existing_state.set_data(state_data)
+
+    await db.flush()
+    return existing_state
+
+# ==================== Операции с поиском ====================
+
+
+async def get_search_preferences(db: AsyncSession, bot_user_id: int) -> Optional[SearchPreferences]:
+    # Получить поисковые предпочтения пользователя
+    result = await db.execute(
+        select(SearchPreferences).where(SearchPreferences.bot_user_id == bot_user_id)
+    )
+    return result.scalars().first()
+
+
+async def get_next_search_profile(db: AsyncSession, bot_user_id: int) -> Optional[Profile]:
+    bot_user = await get_bot_user_by_vk_id(db, bot_user_id)
+    if not bot_user:
+        return None
+
+    prefs = await get_search_preferences(db, bot_user.id)
+    filters = search_profile_filters(bot_user.id, prefs)
+
+    # Берем случайный профиль
+    count = await db.scalar(select(func.count(Profile.id)).where(*filters))
+    if not count:
+        return None
+    result = await db.execute(
+        select(Profile).where(*filters).offset(random.randint(0, count - 1)).limit(1)
+    )
+    return result.scalars().first()
+
+# ==================== Избранное и черный список ====================
+
+
+async def add_to_favorites(db: AsyncSession, bot_user_id: int, profile_id: int) -> bool:
+    # Добавить в избранное одним INSERT ... ON CONFLICT DO NOTHING RETURNING (как crud.insert_favorite).
+    # True - добавлено, False - уже было в избранном
+    inserted = await _insert_ignore(db, Favorite, bot_user_id=bot_user_id, profile_id=profile_id)
+    after_commit(db, lambda: exclusion_sets.add(bot_user_id, profile_id))
+    return inserted
+
+
+async def add_to_blacklist(db: AsyncSession, bot_user_id: int, profile_id: int) -> bool:
+    # Добавить в черный список одним INSERT ... ON CONFLICT DO NOTHING RETURNING (как crud.insert_blacklist).
+    # True - добавлено, False - уже было в черном списке
+    inserted = await _insert_ignore(db, Blacklist, bot_user_id=bot_user_id, profile_id=profile_id)
+    after_commit(db, lambda: exclusion_sets.add(bot_user_id, profile_id))
+    return inserted
+
+
+async def _insert_ignore(db: AsyncSession, model, **values) -> bool:
+    statement = _insert_ignore_statement(db, model, ['bot_user_id', 'profile_id'], values).returning(model.id)
+    result = await db.execute(statement)
+    return result.first() is not None
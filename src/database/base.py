@@ -1,10 +1,20 @@
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+from contextlib import contextmanager, asynccontextmanager
+from typing import Dict, Optional
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.orm import sessionmaker, scoped_session
 from src.config import settings
 from src.database.models import Base
 
+logger = logging.getLogger(__name__)
+
 
 class DatabaseManager:
+    # Как часто перепроверять отставание реплики, сек
+    REPLICA_LAG_CHECK_INTERVAL = 5.0
+
     def __init__(self):
         self.engine = create_engine(
             settings.DATABASE_URL_psycopg,
@@ -20,6 +30,245 @@ class DatabaseManager:
             autoflush=False,
             bind=self.engine
         ))
+        # Сессии единиц работы: объекты остаются доступны после commit
+        self.RequestSession = sessionmaker(
+            autocommit=False,
+            autoflush=False,
+            expire_on_commit=False,
+            bind=self.engine
+        )
+        # Отметка о записи в транзакции (CRUD функции делают flush до commit)
+        event.listen(self.RequestSession, 'after_flush', self._on_flush)
+        event.listen(self.RequestSession, 'do_orm_execute', self._on_execute)
+
+        # Учет занятых соединений пула: всего и в рамках текущего запроса (поток)
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        self.checked_out = 0
+        self.peak_checked_out = 0
+        self.peak_per_request = 0
+        event.listen(self.engine, 'checkout', self._on_checkout)
+        event.listen(self.engine, 'checkin', self._on_checkin)
+
+        # Реплики для чтения: списки избранного, лайков, истории и выбор анкет
+        self.max_replica_lag = settings.DB_REPLICA_MAX_LAG
+        self.replica_engines = []
+        self.ReplicaSessions = []
+        self._replica_lag: Dict[int, float] = {}
+        self._replica_checked_at: Dict[int, float] = {}
+        self._replica_index = 0
+        # Время последней записи пользователя (read-your-writes)
+        self._last_write: Dict[int, float] = {}
+        self._routing_lock = threading.Lock()
+        for url in settings.replica_urls:
+            self.add_replica(url)
+
+        # Асинхронный движок создается только в режиме DB_ASYNC
+        self.async_engine = None
+        self.AsyncSession = None
+        if settings.DB_ASYNC:
+            self.init_async()
+
+    def init_async(self, url: str = None):
+        # Асинхронный движок и фабрика сессий (sqlalchemy.ext.asyncio + asyncpg)
+        from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+        self.async_engine = create_async_engine(
+            url or settings.DATABASE_URL_asyncpg,
+            pool_size=10,
+            max_overflow=20,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            pool_timeout=30,
+            echo=settings.DEBUG
+        )
+        self.AsyncSession = async_sessionmaker(
+            self.async_engine,
+            autoflush=False,
+            expire_on_commit=False
+        )
+        logger.info("Асинхронный движок БД инициализирован")
+
+    def add_replica(self, url: str, **engine_kwargs):
+        # Подключение реплики только для чтения
+        engine = create_engine(
+            url,
+            **(engine_kwargs or dict(
+                pool_size=10,
+                max_overflow=20,
+                pool_pre_ping=True,
+                pool_recycle=3600,
+                pool_timeout=30,
+                echo=settings.DEBUG
+            ))
+        )
+        event.listen(engine, 'checkout', self._on_checkout)
+        event.listen(engine, 'checkin', self._on_checkin)
+        self.replica_engines.append(engine)
+        self.ReplicaSessions.append(sessionmaker(
+            autocommit=False,
+            autoflush=False,
+            expire_on_commit=False,
+            bind=engine
+        ))
+        logger.info(f"Подключена реплика БД #{len(self.replica_engines)}")
+
+    def _replica_lag_seconds(self, index: int) -> float:
+        # Отставание реплики от основной БД (кэшируется на REPLICA_LAG_CHECK_INTERVAL)
+        now = time.monotonic()
+        checked_at = self._replica_checked_at.get(index)
+        if checked_at is not None and now - checked_at < self.REPLICA_LAG_CHECK_INTERVAL:
+            return self._replica_lag[index]
+
+        try:
+            with self.replica_engines[index].connect() as connection:
+                if connection.dialect.name == 'postgresql':
+                    lag = connection.execute(text(
+                        "SELECT COALESCE(EXTRACT(EPOCH FROM "
+                        "now() - pg_last_xact_replay_timestamp()), 0)"
+                    )).scalar()
+                else:
+                    lag = 0
+            lag = float(lag or 0)
+        except Exception as e:
+            logger.warning(f"Реплика БД #{index + 1} недоступна: {e}")
+            lag = float('inf')
+
+        self._replica_lag[index] = lag
+        self._replica_checked_at[index] = now
+        return lag
+
+    def _pick_replica(self, user_id: Optional[int]) -> Optional[int]:
+        # Индекс реплики для чтения или None, если читать нужно с основной БД
+        if not self.replica_engines:
+            return None
+
+        # Пользователь недавно писал - реплика может еще не увидеть его изменения
+        if user_id is not None:
+            last_write = self._last_write.get(user_id)
+            if last_write is not None and time.monotonic() - last_write < self.max_replica_lag:
+                return None
+
+        # Перебор реплик по кругу, пропуская отстающие больше допустимого
+        with self._routing_lock:
+            start = self._replica_index
+            self._replica_index = (start + 1) % len(self.replica_engines)
+        for offset in range(len(self.replica_engines)):
+            index = (start + offset) % len(self.replica_engines)
+            if self._replica_lag_seconds(index) <= self.max_replica_lag:
+                return index
+        return None
+
+    @contextmanager
+    def read_session(self, user_id: Optional[int] = None, session=None):
+        # Сессия только для чтения: реплика, если она достаточно свежая,
+        # иначе основная БД (переданная сессия единицы работы или новая)
+        index = self._pick_replica(user_id)
+        if index is None and session is not None:
+            yield session
+            return
+
+        factory = self.RequestSession if index is None else self.ReplicaSessions[index]
+        read = factory()
+        try:
+            yield read
+        finally:
+            read.rollback()
+            read.close()
+
+    def mark_write(self, user_id: int) -> None:
+        # Запоминаем запись пользователя, чтобы следующее чтение шло с основной БД
+        with self._routing_lock:
+            self._last_write[user_id] = time.monotonic()
+            # Не копим устаревшие отметки
+            if len(self._last_write) > 10000:
+                border = time.monotonic() - self.max_replica_lag
+                self._last_write = {uid: ts for uid, ts in self._last_write.items() if ts >= border}
+
+    @staticmethod
+    def _on_flush(session, flush_context):
+        session.info['flushed'] = True
+
+    @staticmethod
+    def _on_execute(orm_execute_state):
+        # INSERT/UPDATE/DELETE выражениями (без flush) - тоже запись
+        if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+            orm_execute_state.session.info['flushed'] = True
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._stats_lock:
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+        held = getattr(self._local, 'held', 0) + 1
+        self._local.held = held
+        self._local.peak = max(getattr(self._local, 'peak', 0), held)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._stats_lock:
+            self.checked_out = max(self.checked_out - 1, 0)
+        self._local.held = max(getattr(self._local, 'held', 0) - 1, 0)
+
+    @contextmanager
+    def track_request(self, request_name: str):
+        # Пиковое число соединений, одновременно занятых одним запросом
+        self._local.peak = getattr(self._local, 'held', 0)
+        try:
+            yield
+        finally:
+            peak = self._local.peak
+            with self._stats_lock:
+                self.peak_per_request = max(self.peak_per_request, peak)
+            logger.debug(f"{request_name}: пик соединений {peak}, "
+                         f"занято в пуле {self.checked_out}")
+
+    @contextmanager
+    def unit_of_work(self, user_id: Optional[int] = None):
+        # Одна сессия и одна транзакция на входящее событие.
+        # CRUD функции только делают flush, commit выполняется здесь
+        session = self.RequestSession()
+        session.info['user_id'] = user_id
+        try:
+            yield session
+            self.release(session)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    @asynccontextmanager
+    async def async_unit_of_work(self):
+        # Асинхронная единица работы: commit при успехе, rollback при ошибке
+        if self.AsyncSession is None:
+            raise RuntimeError("Асинхронный режим БД не включен (DB_ASYNC)")
+
+        async with self.AsyncSession() as session:
+            try:
+                yield session
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+
+    def release(self, session):
+        # Завершение текущей транзакции и возврат соединения в пул
+        # (например, перед сетевым запросом к VK). Транзакция только на чтение
+        # фиксируется без записи в WAL
+        wrote = bool(session.new or session.dirty or session.deleted or session.info.pop('flushed', False))
+        session.commit()
+
+        user_id = session.info.get('user_id')
+        if wrote and user_id is not None and self.replica_engines:
+            self.mark_write(user_id)
+
+    def pool_stats(self) -> Dict[str, int]:
+        with self._stats_lock:
+            return {
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'peak_per_request': self.peak_per_request,
+                'pool_size': self.engine.pool.size()
+            }
 
     def create_tables(self):
         Base.metadata.create_all(self.engine)
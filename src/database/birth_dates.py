@@ -0,0 +1,48 @@
+from datetime import date
+from typing import Optional, Tuple
+
+# Год-заглушка для дат рождения без года (високосный - подходит и 29.02)
+MISSING_YEAR = 1904
+
+
+def parse_bdate(bdate: Optional[str]) -> Tuple[Optional[date], bool]:
+    # Дата рождения из VK ('Д.М.ГГГГ' или 'Д.М') -> (дата, год не указан)
+    if not bdate:
+        return None, False
+    try:
+        parts = bdate.split('.')
+        if len(parts) == 3:
+            day, month, year = map(int, parts)
+            return date(year, month, day), False
+        if len(parts) == 2:
+            day, month = map(int, parts)
+            return date(MISSING_YEAR, month, day), True
+    except (ValueError, AttributeError):
+        pass
+    return None, False
+
+
+def years_before(day: date, years: int) -> date:
+    # Та же дата years лет назад (29.02 -> 28.02 в невисокосный год)
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:
+        return day.replace(year=day.year - years, day=28)
+
+
+def age_on(birth_date: Optional[date], today: Optional[date] = None) -> Optional[int]:
+    # Полных лет на дату today
+    if birth_date is None:
+        return None
+    today = today or date.today()
+    return today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
+
+
+def birth_date_bounds(age_min: Optional[int], age_max: Optional[int],
+                      today: Optional[date] = None) -> Tuple[Optional[date], Optional[date]]:
+    # Возраст от age_min до age_max <=> born_after < дата рождения <= born_until.
+    # None - граница не задана
+    today = today or date.today()
+    born_until = years_before(today, age_min) if age_min else None
+    born_after = years_before(today, age_max + 1) if age_max else None
+    return born_after, born_until
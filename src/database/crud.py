@@ -1,12 +1,50 @@
-from sqlalchemy.orm import Session
+import logging
+from datetime import date, datetime
+from sqlalchemy import event, select, tuple_, func, delete, update, and_, or_, case, all_, bindparam, Integer
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session, joinedload
 from src.database.models import (
     BotUser, UserState, Profile, Photo, Favorite,
     Blacklist, SearchPreferences, ViewedProfiles,
-    PhotoLike
+    PhotoLike, SearchCursor
 )
-from typing import List, Optional, Dict
+from src.database.profile_index import profile_index
+from src.database.exclusions import exclusion_sets
+from src.database.birth_dates import birth_date_bounds
+from typing import Callable, List, Optional, Dict, Set, Tuple, Iterable, Iterator
+import hashlib
 import random
 
+logger = logging.getLogger(__name__)
+
+
+def after_commit(db: Session, callback: Callable[[], None]) -> None:
+    # Выполнить callback после commit транзакции db; при откате - отбросить.
+    # Кэши в памяти (исключения, индекс анкет) обновляются только зафиксированными строками
+    session = getattr(db, 'sync_session', db)
+    callbacks = session.info.get('after_commit')
+    if callbacks is None:
+        callbacks = session.info['after_commit'] = []
+        event.listen(session, 'after_commit', _run_after_commit)
+        event.listen(session, 'after_soft_rollback', _discard_after_commit)
+    callbacks.append(callback)
+
+
+def _run_after_commit(session: Session) -> None:
+    callbacks = session.info['after_commit']
+    pending, callbacks[:] = list(callbacks), []
+    for callback in pending:
+        try:
+            callback()
+        except Exception as e:
+            logger.error(f"Ошибка обработчика после commit: {e}", exc_info=True)
+
+
+def _discard_after_commit(session: Session, previous_transaction) -> None:
+    # Откат точки сохранения (begin_nested) внешнюю транзакцию не отменяет
+    if not previous_transaction.nested:
+        session.info['after_commit'].clear()
+
 
 # ==================== Операции с пользователями ====================
 
@@ -47,8 +85,7 @@ def create_or_update_bot_user(db: Session, vk_id: int, first_name: str, last_nam
         )
         db.add(existing_user)
 
-    db.commit()
-    db.refresh(existing_user)
+    db.flush()
     return existing_user
 
 
@@ -57,7 +94,7 @@ def delete_bot_user(db: Session, bot_user_id: int) -> bool:
     user = db.query(BotUser).filter(BotUser.id == bot_user_id).first()
     if user:
         db.delete(user)
-        db.commit()
+        db.flush()
         return True
     return False
 
@@ -125,8 +162,7 @@ def create_or_update_user_state(db: Session, vk_id: int, state: str = None, stat
             existing_state.set_data(state_data)
         db.add(existing_state)
 
-    db.commit()
-    db.refresh(existing_state)
+    db.flush()
     return existing_state
 
 
@@ -137,8 +173,7 @@ def update_user_state_data(db: Session, vk_id: int, **kwargs) -> Optional[UserSt
         current_data = state.get_data()
         current_data.update(kwargs)
         state.set_data(current_data)
-        db.commit()
-        db.refresh(state)
+        db.flush()
     return state
 
 
@@ -147,7 +182,7 @@ def delete_user_state(db: Session, vk_id: int) -> bool:
     state = db.query(UserState).filter(UserState.vk_id == vk_id).first()
     if state:
         db.delete(state)
-        db.commit()
+        db.flush()
         return True
     return False
 
@@ -166,7 +201,8 @@ def get_profile_by_vk_id(db: Session, vk_id: int) -> Optional[Profile]:
 
 def create_or_update_profile(db: Session, vk_id: int, first_name: str, last_name: str,
                              profile_url: str = None, age: int = None, sex: int = None,
-                             city: str = None) -> Profile:
+                             city: str = None, birth_date: date = None,
+                             birth_year_missing: bool = False) -> Profile:
     # Создать или обновить профиль
     existing_profile = db.query(Profile).filter(Profile.vk_id == vk_id).first()
 
@@ -177,6 +213,9 @@ def create_or_update_profile(db: Session, vk_id: int, first_name: str, last_name
             existing_profile.profile_url = profile_url
         if age is not None:
             existing_profile.age = age
+        if birth_date is not None:
+            existing_profile.birth_date = birth_date
+            existing_profile.birth_year_missing = birth_year_missing
         if sex is not None:
             existing_profile.sex = sex
         if city is not None:
@@ -188,13 +227,14 @@ def create_or_update_profile(db: Session, vk_id: int, first_name: str, last_name
             last_name=last_name,
             profile_url=profile_url,
             age=age,
+            birth_date=birth_date,
+            birth_year_missing=birth_year_missing,
             sex=sex,
             city=city
         )
         db.add(existing_profile)
 
-    db.commit()
-    db.refresh(existing_profile)
+    db.flush()
     return existing_profile
 
 
@@ -203,33 +243,36 @@ def delete_profile(db: Session, profile_id: int) -> bool:
     profile = db.query(Profile).filter(Profile.id == profile_id).first()
     if profile:
         db.delete(profile)
-        db.commit()
+        db.flush()
         return True
     return False
 
 
 def find_profiles_by_criteria(db: Session, city: str = None, age_min: int = None,
-                              age_max: int = None, sex: int = None, exclude_vk_ids: List[int] = None) -> List[Profile]:
-    # Найти профили по критериям
-    query = db.query(Profile)
+                              age_max: int = None, sex: int = None, exclude_vk_ids: Iterable[int] = None,
+                              batch_size: int = 1000) -> Iterator[Profile]:
+    # Найти профили по критериям. Результат отдается потоком порциями по batch_size
+    # (серверный курсор), исключения передаются одним параметром-массивом
+    query = select(Profile)
 
     if city:
-        query = query.filter(Profile.city == city)
-    if age_min is not None:
-        query = query.filter(Profile.age >= age_min)
-    if age_max is not None:
-        query = query.filter(Profile.age <= age_max)
+        query = query.where(Profile.city == city)
+    query = query.where(*age_filters(age_min, age_max))
     if sex is not None:
-        query = query.filter(Profile.sex == sex)
+        query = query.where(Profile.sex == sex)
     if exclude_vk_ids:
-        query = query.filter(Profile.vk_id.notin_(exclude_vk_ids))
+        query = query.where(_not_in_ids(db, Profile.vk_id, exclude_vk_ids))
+
+    yield from db.scalars(query.execution_options(yield_per=batch_size))
 
-    return query.all()
 
 # ==================== Операции с фотографиями ====================
 
 
 def add_photos_to_profile(db: Session, profile_id: int, photos: List[Dict]) -> List[Photo]:
+    # Сохранить фото, только что полученные из VK (всем ставится одно время загрузки)
+    fetched_at = datetime.now()
+
     # Получаем текущие фото
     existing_photos = db.query(Photo).filter(
         Photo.profile_id == profile_id
@@ -249,17 +292,23 @@ def add_photos_to_profile(db: Session, profile_id: int, photos: List[Dict]) -> L
             ).first()
             if existing:
                 existing.likes_count = photo_data.get('likes', existing.likes_count)
+                existing.owner_id = photo_data.get('owner_id', existing.owner_id)
+                existing.vk_photo_id = photo_data.get('id', existing.vk_photo_id)
+                existing.fetched_at = fetched_at
         else:
             # Добавляем новое фото
             photo = Photo(
                 profile_id=profile_id,
                 photo_url=photo_url,
-                likes_count=photo_data.get('likes', 0)
+                likes_count=photo_data.get('likes', 0),
+                owner_id=photo_data.get('owner_id'),
+                vk_photo_id=photo_data.get('id'),
+                fetched_at=fetched_at
             )
             db.add(photo)
             new_photos.append(photo)
 
-    db.commit()
+    db.flush()
     return new_photos
 
 
@@ -274,6 +323,40 @@ def get_top_profile_photos(db: Session, profile_id: int, limit: int = 3) -> List
         Photo.profile_id == profile_id
     ).order_by(Photo.likes_count.desc()).limit(limit).all()
 
+
+def get_fresh_profile_photos(db: Session, profile_id: int, fresh_after: datetime,
+                             limit: int = 6) -> Optional[List[Photo]]:
+    # Фото последней загрузки из VK, если она не раньше fresh_after (по лайкам).
+    # None - фото нет или они устарели
+    last_fetch = select(func.max(Photo.fetched_at)).where(
+        Photo.profile_id == profile_id
+    ).scalar_subquery()
+    photos = list(db.scalars(select(Photo).where(
+        Photo.profile_id == profile_id,
+        Photo.fetched_at == last_fetch,
+        Photo.fetched_at >= fresh_after
+    ).order_by(Photo.likes_count.desc()).limit(limit)))
+    return photos or None
+
+
+def delete_profile_photos(db: Session, profile_id: int) -> int:
+    # Удалить фото профиля (в VK фото больше нет или профиль закрыт)
+    result = db.execute(delete(Photo).where(Photo.profile_id == profile_id))
+    return result.rowcount
+
+
+def get_stale_photo_profiles(db: Session, fresh_after: datetime, limit: int) -> List[Tuple[int, int]]:
+    # (id, vk_id) профилей, фото которых загружались раньше fresh_after
+    last_fetch = func.max(Photo.fetched_at)
+    return [tuple(row) for row in db.execute(
+        select(Profile.id, Profile.vk_id)
+        .join(Photo, Photo.profile_id == Profile.id)
+        .group_by(Profile.id, Profile.vk_id)
+        .having(or_(last_fetch < fresh_after, last_fetch.is_(None)))
+        .order_by(last_fetch)
+        .limit(limit)
+    )]
+
 # ==================== Операции с избранными  ====================
 
 
@@ -284,17 +367,40 @@ def add_to_favorites(db: Session, bot_user_id: int, profile_id: int) -> Favorite
         profile_id=profile_id
     )
     db.add(favorite)
-    db.commit()
-    db.refresh(favorite)
+    db.flush()
+    after_commit(db, lambda: exclusion_sets.add(bot_user_id, profile_id))
     return favorite
 
 
+def insert_favorite(db: Session, bot_user_id: int, profile_id: int) -> bool:
+    # Добавить в избранное одним INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    # True - добавлено, False - уже было в избранном
+    inserted = _insert_ignore(db, Favorite, ['bot_user_id', 'profile_id'],
+                              bot_user_id=bot_user_id, profile_id=profile_id)
+    after_commit(db, lambda: exclusion_sets.add(bot_user_id, profile_id))
+    return inserted
+
+
 def get_favorites(db: Session, bot_user_id: int) -> List[Profile]:
-    # Получить избранные профили пользователя
-    favorites = db.query(Favorite).filter(Favorite.bot_user_id == bot_user_id).all()
+    # Получить избранные профили пользователя (профили загружаются тем же запросом)
+    favorites = db.query(Favorite).options(joinedload(Favorite.profile)).filter(
+        Favorite.bot_user_id == bot_user_id
+    ).all()
     return [favorite.profile for favorite in favorites]
 
 
+def get_favorites_page(db: Session, bot_user_id: int, limit: int = 10,
+                       after: Optional[Tuple[datetime, int]] = None
+                       ) -> Tuple[List[Profile], Optional[Tuple[datetime, int]]]:
+    # Страница избранного (новые сначала) и курсор следующей страницы
+    return _keyset_page(db, Favorite, Favorite.added_at, bot_user_id, limit, after)
+
+
+def count_favorites(db: Session, bot_user_id: int) -> int:
+    # Количество избранных профилей пользователя
+    return db.query(Favorite).filter(Favorite.bot_user_id == bot_user_id).count()
+
+
 def remove_from_favorites(db: Session, bot_user_id: int, profile_id: int) -> bool:
     # Удалить профиль из избранного
     favorite = db.query(Favorite).filter(
@@ -304,18 +410,13 @@ def remove_from_favorites(db: Session, bot_user_id: int, profile_id: int) -> boo
 
     if favorite:
         db.delete(favorite)
-        db.commit()
+        db.flush()
+        # Анкета может остаться исключенной по другой таблице - перезагрузим набор
+        after_commit(db, lambda: exclusion_sets.reset(bot_user_id))
         return True
     return False
 
 
-def is_in_favorites(db: Session, bot_user_id: int, profile_id: int) -> bool:
-    # Проверить, находится ли профиль в избранном
-    return db.query(Favorite).filter(
-        Favorite.bot_user_id == bot_user_id,
-        Favorite.profile_id == profile_id
-    ).first() is not None
-
 # ==================== Операции с черным списком  ====================
 
 
@@ -326,14 +427,25 @@ def add_to_blacklist(db: Session, bot_user_id: int, profile_id: int) -> Blacklis
         profile_id=profile_id
     )
     db.add(blacklist)
-    db.commit()
-    db.refresh(blacklist)
+    db.flush()
+    after_commit(db, lambda: exclusion_sets.add(bot_user_id, profile_id))
     return blacklist
 
 
+def insert_blacklist(db: Session, bot_user_id: int, profile_id: int) -> bool:
+    # Добавить в черный список одним INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    # True - добавлено, False - уже было в черном списке
+    inserted = _insert_ignore(db, Blacklist, ['bot_user_id', 'profile_id'],
+                              bot_user_id=bot_user_id, profile_id=profile_id)
+    after_commit(db, lambda: exclusion_sets.add(bot_user_id, profile_id))
+    return inserted
+
+
 def get_blacklist(db: Session, bot_user_id: int) -> List[Profile]:
     # Получить черный список пользователя
-    blacklist_entries = db.query(Blacklist).filter(Blacklist.bot_user_id == bot_user_id).all()
+    blacklist_entries = db.query(Blacklist).options(joinedload(Blacklist.profile)).filter(
+        Blacklist.bot_user_id == bot_user_id
+    ).all()
     return [entry.profile for entry in blacklist_entries]
 
 
@@ -346,18 +458,13 @@ def remove_from_blacklist(db: Session, bot_user_id: int, profile_id: int) -> boo
 
     if blacklist:
         db.delete(blacklist)
-        db.commit()
+        db.flush()
+        # Анкета может остаться исключенной по другой таблице - перезагрузим набор
+        after_commit(db, lambda: exclusion_sets.reset(bot_user_id))
         return True
     return False
 
 
-def is_in_blacklist(db: Session, bot_user_id: int, profile_id: int) -> bool:
-    # Проверить, находится ли профиль в черном списке
-    return db.query(Blacklist).filter(
-        Blacklist.bot_user_id == bot_user_id,
-        Blacklist.profile_id == profile_id
-    ).first() is not None
-
 # ==================== Операции с поиском ====================
 
 
@@ -391,8 +498,7 @@ def create_or_update_search_preferences(db: Session, bot_user_id: int, search_se
         )
         db.add(preferences)
 
-    db.commit()
-    db.refresh(preferences)
+    db.flush()
     return preferences
 
 
@@ -401,84 +507,224 @@ def delete_search_preferences(db: Session, bot_user_id: int) -> bool:
     preferences = db.query(SearchPreferences).filter(SearchPreferences.bot_user_id == bot_user_id).first()
     if preferences:
         db.delete(preferences)
-        db.commit()
+        db.flush()
         return True
     return False
 
+
+def get_hot_search_criteria(db: Session, limit: int = 10,
+                            age_step: int = 5) -> List[Tuple[Optional[str], int, int, int, int]]:
+    # Самые частые сочетания (город, пол, возрастной интервал) в настройках поиска.
+    # Возраст округляется до сетки age_step лет. Возвращает (город, пол, от, до, пользователей)
+    rows = db.execute(select(
+        SearchPreferences.search_city, SearchPreferences.search_sex,
+        SearchPreferences.search_age_min, SearchPreferences.search_age_max
+    )).all()
+
+    counts: Dict[Tuple, int] = {}
+    for city, sex, age_min, age_max in rows:
+        age_from = max(18, (age_min or 18) // age_step * age_step)
+        age_to = min(99, -(-(age_max or 99) // age_step) * age_step)
+        key = ((city or '').strip() or None, sex or 0, age_from, age_to)
+        counts[key] = counts.get(key, 0) + 1
+
+    hot = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return [(*key, users) for key, users in hot]
+
+
+def search_criteria_hash(city: Optional[str], age_min: int, age_max: int, sex: int) -> str:
+    # Ключ критериев поиска для курсора
+    criteria = f"{(city or '').strip().lower()}|{age_min}|{age_max}|{sex}"
+    return hashlib.sha1(criteria.encode('utf-8')).hexdigest()
+
+
+def get_search_cursor(db: Session, bot_user_id: int, criteria_hash: str) -> Optional[Dict]:
+    # Позиция продолжения поиска VK для этих критериев
+    cursor = db.scalars(select(SearchCursor).where(
+        SearchCursor.bot_user_id == bot_user_id,
+        SearchCursor.criteria_hash == criteria_hash
+    )).first()
+    if not cursor:
+        return None
+    return {
+        'sort': cursor.search_sort,
+        'offset': cursor.search_offset,
+        'exhausted': cursor.exhausted
+    }
+
+
+def save_search_cursor(db: Session, bot_user_id: int, criteria_hash: str, cursor: Dict) -> SearchCursor:
+    # Сохранить позицию поиска VK
+    search_cursor = db.scalars(select(SearchCursor).where(
+        SearchCursor.bot_user_id == bot_user_id,
+        SearchCursor.criteria_hash == criteria_hash
+    )).first()
+
+    if not search_cursor:
+        search_cursor = SearchCursor(bot_user_id=bot_user_id, criteria_hash=criteria_hash)
+        db.add(search_cursor)
+
+    search_cursor.search_sort = cursor.get('sort')
+    search_cursor.search_offset = cursor.get('offset', 0)
+    search_cursor.exhausted = cursor.get('exhausted', False)
+
+    db.flush()
+    return search_cursor
+
 # ==================== Операции с поиском ====================
 
 
-def save_search_results(db: Session, users: List[Dict]) -> List[Profile]:
-    # Сохранить результаты в базу данных
-    saved_profiles = []
+def save_search_results(db: Session, users: List[Dict], chunk_size: int = 500) -> List[Profile]:
+    # Сохранить результаты поиска (данные только что получены из VK): один
+    # INSERT ... ON CONFLICT (vk_id) DO UPDATE ... RETURNING на порцию из chunk_size анкет.
+    # users - записи VKUser или словари с теми же ключами
+    fetched_at = datetime.now()
+    rows = {}
     for user_data in users:
-        # Проверяем, существует ли уже профиль с таким vk_id
-        existing_profile = get_profile_by_vk_id(db, user_data['vk_id'])
-
-        if existing_profile:
-            # Если профиль уже существует, обновляем его
-            existing_profile.first_name = user_data.get('first_name', existing_profile.first_name)
-            existing_profile.last_name = user_data.get('last_name', existing_profile.last_name)
-            existing_profile.profile_url = user_data.get('profile_url', existing_profile.profile_url)
-            existing_profile.age = user_data.get('age', existing_profile.age)
-            existing_profile.sex = user_data.get('sex', existing_profile.sex)
-            existing_profile.city = user_data.get('city', existing_profile.city)
-            saved_profiles.append(existing_profile)
-        else:
-            # Создаем новый профиль
-            profile = create_or_update_profile(
-                db=db,
-                vk_id=user_data['vk_id'],
-                first_name=user_data['first_name'],
-                last_name=user_data['last_name'],
-                profile_url=user_data.get('profile_url'),
-                age=user_data.get('age'),
-                sex=user_data.get('sex'),
-                city=user_data.get('city')
-            )
-            saved_profiles.append(profile)
+        # Повтор vk_id в одной команде ON CONFLICT DO UPDATE недопустим - берем последний
+        rows[user_data['vk_id']] = {
+            'vk_id': user_data['vk_id'],
+            'first_name': user_data.get('first_name', ''),
+            'last_name': user_data.get('last_name', ''),
+            'profile_url': user_data.get('profile_url'),
+            'age': user_data.get('age'),
+            'birth_date': user_data.get('birth_date'),
+            'birth_year_missing': user_data.get('birth_year_missing') or False,
+            'sex': user_data.get('sex'),
+            'city': user_data.get('city'),
+            'fetched_at': fetched_at
+        }
 
-    db.commit()
+    saved_profiles = []
+    values = list(rows.values())
+    for start in range(0, len(values), chunk_size):
+        statement = _dialect_insert(db, Profile).values(values[start:start + chunk_size])
+        new = statement.excluded
+        # Неизвестные в новых данных поля не затирают сохраненные
+        statement = statement.on_conflict_do_update(
+            index_elements=['vk_id'],
+            set_={
+                'first_name': new.first_name,
+                'last_name': new.last_name,
+                'profile_url': func.coalesce(new.profile_url, Profile.profile_url),
+                'age': func.coalesce(new.age, Profile.age),
+                'birth_date': func.coalesce(new.birth_date, Profile.birth_date),
+                'birth_year_missing': case((new.birth_date.is_(None), Profile.birth_year_missing),
+                                           else_=new.birth_year_missing),
+                'sex': func.coalesce(new.sex, Profile.sex),
+                'city': func.coalesce(new.city, Profile.city),
+                'fetched_at': new.fetched_at
+            }
+        ).returning(Profile)
+        saved_profiles.extend(db.scalars(statement, execution_options={'populate_existing': True}))
+
+    # Индекс анкет в памяти (если включен) узнает о новых анкетах после коммита:
+    # строки снимаем сейчас, после коммита атрибуты анкет уже истекли
+    if profile_index.ready:
+        index_rows = profile_index.index_rows(saved_profiles)
+        after_commit(db, lambda: profile_index.upsert_rows(index_rows))
     return saved_profiles
 
 
-def get_next_search_profile(db: Session, bot_user_id: int) -> Optional[Profile]:
-    bot_user = get_bot_user_by_vk_id(db, bot_user_id)
-    if not bot_user:
-        return None
-
-    # Базовый запрос
-    query = db.query(Profile)
+def get_stale_profile_vk_ids(db: Session, fresh_after: datetime, limit: int) -> List[int]:
+    # VK id профилей, данные которых получены раньше fresh_after (самые старые первыми)
+    return list(db.scalars(
+        select(Profile.vk_id)
+        .where(or_(Profile.fetched_at < fresh_after, Profile.fetched_at.is_(None)))
+        .order_by(Profile.fetched_at.nulls_first())
+        .limit(limit)
+    ))
+
+
+def mark_profiles_fetched(db: Session, vk_ids: List[int]) -> int:
+    # Отметить профили проверенными (в том числе закрытые и удаленные - их VK не вернул)
+    result = db.execute(update(Profile).where(Profile.vk_id.in_(vk_ids)).values(fetched_at=datetime.now()))
+    return result.rowcount
+
+
+def age_filters(age_min: Optional[int], age_max: Optional[int]) -> List:
+    # Возраст от age_min до age_max - диапазон дат рождения на сегодня (индекс по birth_date).
+    # Анкеты, сохраненные до появления birth_date, отбираются по возрасту при загрузке,
+    # пока ProfileRefresher их не обновит
+    born_after, born_until = birth_date_bounds(age_min, age_max)
+    by_birth_date = []
+    by_age = []
+    if born_until:
+        by_birth_date.append(Profile.birth_date <= born_until)
+        by_age.append(Profile.age >= age_min)
+    if born_after:
+        by_birth_date.append(Profile.birth_date > born_after)
+        by_age.append(Profile.age <= age_max)
+    if not by_birth_date:
+        return []
+    return [or_(
+        and_(*by_birth_date, Profile.birth_year_missing.is_not(True)),
+        and_(Profile.birth_date.is_(None), *by_age)
+    )]
+
+
+def search_profile_filters(bot_user_id: int, prefs: Optional[SearchPreferences],
+                           exclude_ids: Optional[Set[int]] = None, with_history: bool = True) -> List:
+    # Условия отбора анкет по настройкам поиска без избранного, черного списка и просмотренных.
+    # Общие для синхронного и асинхронного (async_crud) выбора кандидата.
+    # exclude_ids - просмотры, еще не записанные в БД (буфер отложенной записи).
+    # with_history=False - без подзапросов к истории (исключения передаются массивом)
+    filters = []
+    if exclude_ids:
+        filters.append(Profile.id.notin_(exclude_ids))
 
     # Добавляем фильтры по настройкам поиска
-    prefs = get_search_preferences(db, bot_user.id)
     if prefs:
         if prefs.search_city:
-            query = query.filter(Profile.city == prefs.search_city)
-        if prefs.search_age_min:
-            query = query.filter(Profile.age >= prefs.search_age_min)
-        if prefs.search_age_max:
-            query = query.filter(Profile.age <= prefs.search_age_max)
+            filters.append(Profile.city == prefs.search_city)
+        filters.extend(age_filters(prefs.search_age_min, prefs.search_age_max))
         if prefs.search_sex and prefs.search_sex != 0:
-            query = query.filter(Profile.sex == prefs.search_sex)
+            filters.append(Profile.sex == prefs.search_sex)
+
+    if not with_history:
+        return filters
 
     # Исключаем избранное
-    fav_subq = db.query(Favorite.profile_id).filter(
-        Favorite.bot_user_id == bot_user.id
+    fav_subq = select(Favorite.profile_id).where(
+        Favorite.bot_user_id == bot_user_id
     ).scalar_subquery()
-    query = query.filter(~Profile.id.in_(fav_subq))
+    filters.append(~Profile.id.in_(fav_subq))
 
     # Исключаем черный список
-    black_subq = db.query(Blacklist.profile_id).filter(
-        Blacklist.bot_user_id == bot_user.id
+    black_subq = select(Blacklist.profile_id).where(
+        Blacklist.bot_user_id == bot_user_id
     ).scalar_subquery()
-    query = query.filter(Profile.id.notin_(black_subq))
+    filters.append(Profile.id.notin_(black_subq))
 
     # Исключаем просмотренные
-    viewed_subq = db.query(ViewedProfiles.profile_id).filter(
-        ViewedProfiles.bot_user_id == bot_user.id
+    viewed_subq = select(ViewedProfiles.profile_id).where(
+        ViewedProfiles.bot_user_id == bot_user_id
     ).scalar_subquery()
-    query = query.filter(Profile.id.notin_(viewed_subq))
+    filters.append(Profile.id.notin_(viewed_subq))
+
+    return filters
+
+
+def get_next_search_profile(db: Session, bot_user_id: int,
+                            exclude_ids: Optional[Set[int]] = None) -> Optional[Profile]:
+    bot_user = get_bot_user_by_vk_id(db, bot_user_id)
+    if not bot_user:
+        return None
+
+    prefs = get_search_preferences(db, bot_user.id)
+    if profile_index.ready:
+        return _pick_from_profile_index(db, bot_user.id, prefs, exclude_ids)
+    return _pick_from_db(db, bot_user.id, prefs, exclude_ids)
+
+
+def _pick_from_db(db: Session, bot_user_id: int, prefs: Optional[SearchPreferences],
+                  exclude_ids: Optional[Set[int]] = None) -> Optional[Profile]:
+    # Избранное, черный список и просмотренные - один параметр-массив вместо трех anti-join
+    excluded = get_exclusion_set(db, bot_user_id)
+    query = db.query(Profile).filter(
+        *search_profile_filters(bot_user_id, prefs, exclude_ids, with_history=False),
+        _not_in_ids(db, Profile.id, excluded)
+    )
 
     # Берем случайный профиль
     count = query.count()
@@ -487,26 +733,122 @@ def get_next_search_profile(db: Session, bot_user_id: int) -> Optional[Profile]:
     return query.offset(random.randint(0, count - 1)).first()
 
 
-def add_to_viewed_profiles(db: Session, bot_user_id: int, profile_id: int):
-    # Добавляем профиль в просмотренные
-    from src.database.models import ViewedProfiles
-    # Проверяем, не добавлен ли уже
-    existing = db.query(ViewedProfiles).filter(
-        ViewedProfiles.bot_user_id == bot_user_id,
-        ViewedProfiles.profile_id == profile_id
-    ).first()
+def count_search_candidates(db: Session, bot_user_id: int, limit: int) -> int:
+    # Сколько непросмотренных анкет под настройки пользователя уже есть в БД (не больше limit)
+    prefs = get_search_preferences(db, bot_user_id)
+    excluded = get_exclusion_set(db, bot_user_id)
+    if profile_index.ready:
+        criteria = {}
+        if prefs:
+            criteria = dict(city=prefs.search_city, age_min=prefs.search_age_min,
+                            age_max=prefs.search_age_max, sex=prefs.search_sex)
+        ids, _ = profile_index.candidates(exclude_ids=excluded, **criteria)
+        return min(len(ids), limit)
+
+    candidates = select(Profile.id).where(
+        *search_profile_filters(bot_user_id, prefs, with_history=False),
+        _not_in_ids(db, Profile.id, excluded)
+    ).limit(limit).subquery()
+    return db.scalar(select(func.count()).select_from(candidates))
+
+
+def count_profiles_by_criteria(db: Session, city: Optional[str], age_min: int,
+                               age_max: int, sex: int, limit: int) -> int:
+    # Размер пула анкет под критерии (не больше limit)
+    prefs = SearchPreferences(search_city=city, search_age_min=age_min,
+                              search_age_max=age_max, search_sex=sex)
+    pool = select(Profile.id).where(
+        *search_profile_filters(None, prefs, with_history=False)
+    ).limit(limit).subquery()
+    return db.scalar(select(func.count()).select_from(pool))
+
+
+def get_excluded_profile_ids(db: Session, bot_user_id: int) -> List[int]:
+    # id анкет из избранного, черного списка и просмотренных - одним запросом
+    excluded = select(Favorite.profile_id).where(Favorite.bot_user_id == bot_user_id).union(
+        select(Blacklist.profile_id).where(Blacklist.bot_user_id == bot_user_id),
+        select(ViewedProfiles.profile_id).where(ViewedProfiles.bot_user_id == bot_user_id)
+    )
+    return list(db.scalars(excluded))
 
-    if existing:
-        return existing
 
-    viewed = ViewedProfiles(
-        bot_user_id=bot_user_id,
-        profile_id=profile_id
-    )
-    db.add(viewed)
-    db.commit()
-    db.refresh(viewed)
-    return viewed
+def get_viewed_vk_ids(db: Session, bot_user_id: int, vk_ids: Optional[List[int]] = None) -> List[int]:
+    # VK id просмотренных пользователем анкет (при vk_ids - только из этого списка)
+    query = select(Profile.vk_id).join(
+        ViewedProfiles, ViewedProfiles.profile_id == Profile.id
+    ).where(ViewedProfiles.bot_user_id == bot_user_id)
+    if vk_ids is not None:
+        query = query.where(Profile.vk_id.in_(vk_ids))
+    return list(db.scalars(query))
+
+
+def get_exclusion_set(db: Session, bot_user_id: int):
+    # Отсортированный массив исключенных анкет пользователя (загружается один раз)
+    return exclusion_sets.get(bot_user_id, lambda: get_excluded_profile_ids(db, bot_user_id))
+
+
+def _pick_from_profile_index(db: Session, bot_user_id: int, prefs: Optional[SearchPreferences],
+                             exclude_ids: Optional[Set[int]] = None) -> Optional[Profile]:
+    # Выбор кандидата в индексе анкет в памяти вместо фильтрации в Postgres.
+    # Массив исключений передается в индекс как есть, без копирования
+    excluded = get_exclusion_set(db, bot_user_id)
+    skipped = set(exclude_ids) if exclude_ids else set()
+
+    criteria = {}
+    if prefs:
+        criteria = dict(city=prefs.search_city, age_min=prefs.search_age_min,
+                        age_max=prefs.search_age_max, sex=prefs.search_sex)
+
+    for _ in range(3):
+        profile_id = profile_index.pick(exclude_ids=excluded, also_exclude=skipped, **criteria)
+        if profile_id is None:
+            return None
+        profile = db.get(Profile, profile_id)
+        if profile:
+            return profile
+        # Только что сохраненная анкета могла еще не дойти до реплики - пропускаем ее
+        # в этом выборе, а из индекса убираем, только если ее нет и в основной БД
+        # (откат транзакции)
+        skipped.add(profile_id)
+        if not _profile_on_primary(db, profile_id):
+            profile_index.remove(profile_id)
+
+    # Индекс несколько раз подряд указал на отсутствующие анкеты - выбираем через БД
+    return _pick_from_db(db, bot_user_id, prefs, skipped)
+
+
+def _profile_on_primary(db: Session, profile_id: int) -> bool:
+    # Есть ли анкета в основной БД (db может быть сессией реплики)
+    from src.database.base import db_manager
+    if db.get_bind() is db_manager.engine:
+        return False
+    with db_manager.RequestSession() as primary:
+        return primary.execute(select(Profile.id).where(Profile.id == profile_id)).first() is not None
+
+
+def delete_history_chunk(db: Session, model, bot_user_id: int, chunk_size: int = 1000) -> int:
+    # Удалить не больше chunk_size записей пользователя из blacklist / viewed_profiles.
+    # Короткие транзакции не держат блокировки долго и не раздувают WAL
+    chunk_ids = select(model.id).where(model.bot_user_id == bot_user_id).limit(chunk_size)
+    return db.execute(
+        delete(model).where(model.id.in_(chunk_ids.scalar_subquery()))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def add_viewed_profiles_batch(db: Session, rows: List[Dict]) -> int:
+    # Пакетная запись просмотров одним INSERT ... ON CONFLICT DO NOTHING
+    return _insert_ignore_many(db, ViewedProfiles, ['bot_user_id', 'profile_id'], rows)
+
+
+def get_last_viewed_profile(db: Session, bot_user_id: int) -> Optional[Profile]:
+    # Последний просмотренный профиль (одним запросом вместе с профилем)
+    last_viewed = db.query(ViewedProfiles).options(
+        joinedload(ViewedProfiles.profile)
+    ).filter(
+        ViewedProfiles.bot_user_id == bot_user_id
+    ).order_by(ViewedProfiles.viewed_at.desc()).first()
+    return last_viewed.profile if last_viewed else None
 
 
 def is_viewed(db: Session, bot_user_id: int, profile_id: int) -> bool:
@@ -520,37 +862,51 @@ def is_viewed(db: Session, bot_user_id: int, profile_id: int) -> bool:
 
 def get_viewed_profiles(db: Session, bot_user_id: int) -> List[Profile]:
     # Получаем просмотренные профили
-    from src.database.models import ViewedProfiles
-    viewed = db.query(ViewedProfiles).filter(ViewedProfiles.bot_user_id == bot_user_id).all()
+    viewed = db.query(ViewedProfiles).options(joinedload(ViewedProfiles.profile)).filter(
+        ViewedProfiles.bot_user_id == bot_user_id
+    ).all()
     return [entry.profile for entry in viewed]
 
-# ==================== Операции с лайками фотографий ====================
 
-def add_photo_like(db: Session, bot_user_id: int, profile_id: int, photo_url: str) -> PhotoLike:
-    # Добавить лайк на фото
-    like = PhotoLike(
-        bot_user_id=bot_user_id,
-        profile_id=profile_id,
-        photo_url=photo_url
+def _keyset_page(db: Session, model, time_column, bot_user_id: int, limit: int,
+                 after: Optional[Tuple[datetime, int]]
+                 ) -> Tuple[List[Profile], Optional[Tuple[datetime, int]]]:
+    # Keyset пагинация по (время добавления, id): страница читается по индексу
+    # (bot_user_id, время, id) без OFFSET, профили подгружаются тем же запросом
+    query = db.query(model).options(joinedload(model.profile)).filter(
+        model.bot_user_id == bot_user_id
     )
-    db.add(like)
-    db.commit()
-    db.refresh(like)
-    return like
+    if after is not None:
+        query = query.filter(tuple_(time_column, model.id) <
+                             tuple_(*after, types=[time_column.type, model.id.type]))
+
+    # Берем на одну запись больше, чтобы понять, есть ли следующая страница
+    entries = query.order_by(time_column.desc(), model.id.desc()).limit(limit + 1).all()
 
+    next_cursor = None
+    if len(entries) > limit:
+        entries = entries[:limit]
+        last = entries[-1]
+        next_cursor = (getattr(last, time_column.key), last.id)
+
+    return [entry.profile for entry in entries], next_cursor
+
+# ==================== Операции с лайками фотографий ====================
 
 def remove_photo_like(db: Session, bot_user_id: int, photo_url: str) -> bool:
-    # Удалить лайк с фото
-    like = db.query(PhotoLike).filter(
-        PhotoLike.bot_user_id == bot_user_id,
-        PhotoLike.photo_url == photo_url
+    # Удалить лайк с фото одним DELETE ... RETURNING
+    deleted = db.execute(
+        delete(PhotoLike).where(
+            PhotoLike.bot_user_id == bot_user_id,
+            PhotoLike.photo_url == photo_url
+        ).returning(PhotoLike.id)
     ).first()
+    return deleted is not None
 
-    if like:
-        db.delete(like)
-        db.commit()
-        return True
-    return False
+
+def add_photo_likes_batch(db: Session, rows: List[Dict]) -> int:
+    # Пакетная запись лайков одним INSERT ... ON CONFLICT DO NOTHING
+    return _insert_ignore_many(db, PhotoLike, ['bot_user_id', 'photo_url'], rows)
 
 
 def get_user_photo_likes(db: Session, bot_user_id: int) -> List[PhotoLike]:
@@ -560,9 +916,76 @@ def get_user_photo_likes(db: Session, bot_user_id: int) -> List[PhotoLike]:
     ).all()
 
 
-def is_photo_liked(db: Session, bot_user_id: int, photo_url: str) -> bool:
-    # Проверить, лайкнуто ли фото
-    return db.query(PhotoLike).filter(
-        PhotoLike.bot_user_id == bot_user_id,
-        PhotoLike.photo_url == photo_url
-    ).first() is not None
+def get_photo_likes_summary(db: Session, bot_user_id: int, max_profiles: int = 10,
+                            photos_per_profile: int = 3) -> Tuple[int, List[Tuple[Profile, List[str]]]]:
+    # Общее число лайков и до max_profiles профилей (последние лайкнутые сначала)
+    # с их последними photos_per_profile фото - одним запросом с оконными функциями.
+    # Возвращается не больше max_profiles * photos_per_profile строк
+    ranked = select(
+        PhotoLike.profile_id,
+        PhotoLike.photo_url,
+        func.row_number().over(
+            partition_by=PhotoLike.profile_id,
+            order_by=(PhotoLike.liked_at.desc(), PhotoLike.id.desc())
+        ).label('photo_rank'),
+        func.max(PhotoLike.liked_at).over(partition_by=PhotoLike.profile_id).label('last_liked_at'),
+        func.count().over().label('total')
+    ).where(PhotoLike.bot_user_id == bot_user_id).subquery()
+
+    profile_ranked = select(
+        ranked,
+        func.dense_rank().over(
+            order_by=(ranked.c.last_liked_at.desc(), ranked.c.profile_id.desc())
+        ).label('profile_rank')
+    ).subquery()
+
+    rows = db.execute(
+        select(Profile, profile_ranked.c.photo_url, profile_ranked.c.total)
+        .join(profile_ranked, profile_ranked.c.profile_id == Profile.id)
+        .where(profile_ranked.c.photo_rank <= photos_per_profile,
+               profile_ranked.c.profile_rank <= max_profiles)
+        .order_by(profile_ranked.c.profile_rank, profile_ranked.c.photo_rank)
+    ).all()
+
+    total = 0
+    summary: List[Tuple[Profile, List[str]]] = []
+    for profile, photo_url, total in rows:
+        if not summary or summary[-1][0] is not profile:
+            summary.append((profile, []))
+        summary[-1][1].append(photo_url)
+
+    return total, summary
+
+
+def _not_in_ids(db: Session, column, ids):
+    # column NOT IN ids одним параметром-массивом (Postgres: column <> ALL(:ids))
+    if db.get_bind().dialect.name == 'postgresql':
+        return column != all_(bindparam(None, list(ids), type_=postgresql.ARRAY(Integer)))
+    return column.notin_(list(ids))
+
+
+def _dialect_insert(db: Session, model):
+    # INSERT с поддержкой ON CONFLICT для диалекта сессии
+    dialect = sqlite if db.get_bind().dialect.name == 'sqlite' else postgresql
+    return dialect.insert(model)
+
+
+def _insert_ignore_statement(db: Session, model, conflict_columns: List[str], values):
+    # INSERT ... ON CONFLICT (conflict_columns) DO NOTHING для диалекта сессии
+    return _dialect_insert(db, model).values(values).on_conflict_do_nothing(
+        index_elements=conflict_columns
+    )
+
+
+def _insert_ignore(db: Session, model, conflict_columns: List[str], **values) -> bool:
+    # INSERT ... ON CONFLICT (conflict_columns) DO NOTHING RETURNING id.
+    # Гонки решает уникальный индекс, а не проверка перед вставкой
+    statement = _insert_ignore_statement(db, model, conflict_columns, values).returning(model.id)
+    return db.execute(statement).first() is not None
+
+
+def _insert_ignore_many(db: Session, model, conflict_columns: List[str], rows: List[Dict]) -> int:
+    # Многострочный INSERT ... ON CONFLICT DO NOTHING. Возвращает число вставленных строк
+    if not rows:
+        return 0
+    return db.execute(_insert_ignore_statement(db, model, conflict_columns, rows)).rowcount
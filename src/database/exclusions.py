@@ -0,0 +1,70 @@
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+class ExclusionSets:
+    """Исключенные анкеты пользователя: избранное, черный список и просмотренные
+
+    Для каждого пользователя - отсортированный массив id (array('q'), 8 байт
+    на анкету). Загружается из БД при первом обращении, затем обновляется
+    после commit каждого добавления в избранное, черный список или просмотра.
+    Подходит и для SQL (параметр-массив), и для фильтрации в памяти
+    (индекс анкет). Хранится не больше max_users пользователей (LRU).
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._sets: "OrderedDict[int, array]" = OrderedDict()
+
+    def get(self, bot_user_id: int, load: Callable[[], Iterable[int]]) -> array:
+        # Массив исключений пользователя; load() вызывается, если его еще нет в памяти
+        with self._lock:
+            excluded = self._sets.get(bot_user_id)
+            if excluded is not None:
+                self._sets.move_to_end(bot_user_id)
+                return excluded
+
+        excluded = array('q', sorted(set(load())))
+        with self._lock:
+            # Пока шла загрузка, набор могли загрузить в другом потоке
+            current = self._sets.setdefault(bot_user_id, excluded)
+            self._sets.move_to_end(bot_user_id)
+            while len(self._sets) > self.max_users:
+                self._sets.popitem(last=False)
+            return current
+
+    def add(self, bot_user_id: int, profile_id: int) -> None:
+        # Новое исключение (если набор пользователя уже загружен). Массив заменяется
+        # копией: выданные get() массивы не меняются и могут читаться без копирования
+        # (np.frombuffer в индексе анкет)
+        with self._lock:
+            excluded = self._sets.get(bot_user_id)
+            if excluded is None:
+                return
+            position = bisect_left(excluded, profile_id)
+            if position == len(excluded) or excluded[position] != profile_id:
+                self._sets[bot_user_id] = excluded[:position] + array('q', (profile_id,)) + excluded[position:]
+
+    def contains(self, bot_user_id: int, profile_id: int) -> bool:
+        with self._lock:
+            excluded = self._sets.get(bot_user_id)
+            if excluded is None:
+                return False
+            position = bisect_left(excluded, profile_id)
+            return position < len(excluded) and excluded[position] == profile_id
+
+    def reset(self, bot_user_id: int) -> None:
+        # Сброс набора (удаления из истории) - при следующем обращении загрузится заново
+        with self._lock:
+            self._sets.pop(bot_user_id, None)
+
+
+# Глобальные наборы исключений
+exclusion_sets = ExclusionSets()
@@ -0,0 +1,32 @@
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+from src.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FreshnessPolicy:
+    """Сроки актуальности данных, полученных из VK
+
+    Срок задается по виду данных: 'profile' - поля профиля (имя, ссылка,
+    возраст, пол, город приходят одним запросом users.get), 'photos' - фото
+    профиля. Устаревшие данные запрашиваются из VK заново, свежие берутся из БД.
+    """
+
+    def __init__(self, ttl: Optional[Dict[str, int]] = None):
+        self.ttl = ttl or {
+            'profile': settings.PROFILE_TTL_SEC,
+            'photos': settings.PHOTO_TTL_SEC
+        }
+
+    def fresh_after(self, kind: str, now: Optional[datetime] = None) -> datetime:
+        # Данные, полученные раньше этого момента, устарели
+        return (now or datetime.now()) - timedelta(seconds=self.ttl[kind])
+
+    def is_fresh(self, kind: str, fetched_at: Optional[datetime], now: Optional[datetime] = None) -> bool:
+        return fetched_at is not None and fetched_at >= self.fresh_after(kind, now)
+
+
+# Глобальная политика актуальности
+freshness = FreshnessPolicy()
@@ -1,7 +1,8 @@
 import json
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Date, DateTime, ForeignKey, Text, Index, UniqueConstraint, Boolean
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
+from src.database.birth_dates import age_on
 
 Base = declarative_base()
 
@@ -66,10 +67,16 @@ class Profile(Base):
     first_name = Column(String(100))
     last_name = Column(String(100))
     profile_url = Column(String(255))
+    # Возраст на момент загрузки из VK; для отбора - birth_date
     age = Column(Integer)
+    # Дата рождения; без года в VK - год-заглушка и birth_year_missing
+    birth_date = Column(Date)
+    birth_year_missing = Column(Boolean, default=False)
     sex = Column(Integer)
     city = Column(String(100))
     interests = Column(Text)
+    # Когда данные профиля последний раз получены из VK
+    fetched_at = Column(DateTime, default=func.now())
 
     # Отношения
     photos = relationship('Photo', back_populates='profile')
@@ -78,15 +85,17 @@ class Profile(Base):
 
     __table_args__ = (
         Index('idx_profile_city', 'city'),
-        Index('idx_profile_age', 'age'),
+        Index('idx_profile_birth_date', 'birth_date'),
         Index('idx_profile_sex', 'sex'),
+        Index('idx_profile_fetched', 'fetched_at'),
     )
 
-    __table_args__ = (
-        Index('idx_profile_city', 'city'),
-        Index('idx_profile_age', 'age'),
-        Index('idx_profile_sex', 'sex'),
-    )
+    @property
+    def current_age(self):
+        """Возраст на сегодня (без даты рождения - сохраненный при загрузке)"""
+        if self.birth_date and not self.birth_year_missing:
+            return age_on(self.birth_date)
+        return self.age
 
 
 class Photo(Base):
@@ -97,10 +106,19 @@ class Photo(Base):
     photo_url = Column(String(500), nullable=False)
     likes_count = Column(Integer, default=0)
     added_at = Column(DateTime, default=func.now())
+    # Фото в VK: вложение photo{owner_id}_{vk_photo_id}
+    owner_id = Column(Integer)
+    vk_photo_id = Column(Integer)
+    # Когда фото последний раз получены из VK (одинаково для всех фото одной загрузки)
+    fetched_at = Column(DateTime, default=func.now())
 
     # Отношения
     profile = relationship("Profile", back_populates="photos")
 
+    __table_args__ = (
+        Index('idx_photos_profile_fetched', 'profile_id', 'fetched_at'),
+    )
+
 
 class Favorite(Base):
     __tablename__ = 'favorites'
@@ -114,6 +132,11 @@ class Favorite(Base):
     bot_user = relationship("BotUser", back_populates="favorites")
     profile = relationship("Profile", back_populates="favorites")
 
+    __table_args__ = (
+        UniqueConstraint('bot_user_id', 'profile_id', name='uq_favorites_user_profile'),
+        Index('idx_favorites_user_added', 'bot_user_id', 'added_at', 'id'),
+    )
+
 
 class Blacklist(Base):
     __tablename__ = 'blacklist'
@@ -127,6 +150,10 @@ class Blacklist(Base):
     bot_user = relationship("BotUser", back_populates="blacklist")
     profile = relationship("Profile", back_populates="blacklist")
 
+    __table_args__ = (
+        UniqueConstraint('bot_user_id', 'profile_id', name='uq_blacklist_user_profile'),
+    )
+
 
 class SearchPreferences(Base):
     __tablename__ = 'search_preferences'
@@ -143,6 +170,28 @@ class SearchPreferences(Base):
     bot_user = relationship("BotUser", back_populates="search_preferences")
 
 
+class SearchCursor(Base):
+    __tablename__ = 'search_cursors'
+
+    id = Column(Integer, primary_key=True)
+    bot_user_id = Column(Integer, ForeignKey('bot_users.id'))
+    # Хеш критериев поиска (город, возраст, пол)
+    criteria_hash = Column(String(40), nullable=False)
+    # Следующий запрос users.search: сортировка и смещение
+    search_sort = Column(Integer)
+    search_offset = Column(Integer, default=0)
+    # Все стратегии поиска пройдены
+    exhausted = Column(Boolean, default=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+    # Отношения
+    bot_user = relationship("BotUser")
+
+    __table_args__ = (
+        UniqueConstraint('bot_user_id', 'criteria_hash', name='uq_search_cursor_user_criteria'),
+    )
+
+
 class ViewedProfiles(Base):
     __tablename__ = 'viewed_profiles'
 
@@ -156,7 +205,10 @@ class ViewedProfiles(Base):
     profile = relationship("Profile")
 
     # Уникальность
-    __table_args__ = (UniqueConstraint('bot_user_id', 'profile_id', name='uq_viewed_profiles_user_profile'),)
+    __table_args__ = (
+        UniqueConstraint('bot_user_id', 'profile_id', name='uq_viewed_profiles_user_profile'),
+        Index('idx_viewed_profiles_user_viewed_at', 'bot_user_id', 'viewed_at'),
+    )
 
 class PhotoLike(Base):
     __tablename__ = 'photo_likes'
@@ -0,0 +1,100 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+from src.database.freshness import freshness
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+    """Кэш фото анкет по VK id владельца
+
+    Хранит топ-фото и готовую строку вложений photo{owner}_{id} для
+    messages.send. Запись живет, пока фото свежие по freshness ('photos'),
+    считая от загрузки из VK. Промах в памяти проверяется по таблице photos
+    (load), и только потом фото запрашиваются из VK. Пустой результат VK
+    тоже кэшируется (на EMPTY_TTL_SEC) - анкету без фото не запрашиваем
+    при каждом показе.
+    Хранится не больше max_owners владельцев (LRU).
+    """
+
+    # Фото во вложении сообщения
+    ATTACHMENT_PHOTOS = 3
+    # Срок хранения пустого результата, сек
+    EMPTY_TTL_SEC = 3600
+
+    def __init__(self, max_owners: int = 10000):
+        self.max_owners = max_owners
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, Dict]" = OrderedDict()
+        # Метрики
+        self.hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, owner_id: int,
+            load: Optional[Callable[[], Optional[Tuple[List[Dict], datetime]]]] = None) -> Optional[Dict]:
+        # Запись {'photos', 'attachment', 'fetched_at'} или None - фото нужно запросить из VK.
+        # load() -> (свежие фото из БД, время их загрузки) или None
+        with self._lock:
+            entry = self._entries.get(owner_id)
+            if entry is not None:
+                if datetime.now() < entry['expires_at']:
+                    self._entries.move_to_end(owner_id)
+                    self.hits += 1
+                    return entry
+                del self._entries[owner_id]
+
+        loaded = load() if load is not None else None
+        with self._lock:
+            if loaded:
+                self.db_hits += 1
+            else:
+                self.misses += 1
+        if loaded:
+            photos, fetched_at = loaded
+            return self.put(owner_id, photos, fetched_at)
+        return None
+
+    def put(self, owner_id: int, photos: List[Dict], fetched_at: Optional[datetime] = None) -> Dict:
+        # Фото владельца (отсортированы по лайкам), только что из VK или из БД
+        attachments = [f"photo{photo['owner_id']}_{photo['id']}"
+                       for photo in photos[:self.ATTACHMENT_PHOTOS]
+                       if photo.get('owner_id') is not None and photo.get('id') is not None]
+        fetched_at = fetched_at or datetime.now()
+        if photos:
+            expires_at = fetched_at + timedelta(seconds=freshness.ttl['photos'])
+        else:
+            # У владельца нет фото - проверим раньше
+            expires_at = fetched_at + timedelta(seconds=self.EMPTY_TTL_SEC)
+        entry = {
+            'photos': photos,
+            'attachment': ','.join(attachments) if attachments else None,
+            'fetched_at': fetched_at,
+            'expires_at': expires_at
+        }
+        with self._lock:
+            self._entries[owner_id] = entry
+            self._entries.move_to_end(owner_id)
+            while len(self._entries) > self.max_owners:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, owner_id: int) -> None:
+        with self._lock:
+            self._entries.pop(owner_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'owners': len(self._entries),
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses
+            }
+
+
+# Глобальный кэш фото
+photo_cache = PhotoCache()
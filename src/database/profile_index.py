@@ -0,0 +1,414 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from array import array
+from datetime import date
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from src.database.models import Profile
+from src.database.birth_dates import birth_date_bounds, years_before
+
+try:
+    import numpy as np
+except ImportError:  # Индекс необязателен: без numpy выбор анкет идет через SQL
+    np = None
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileIndex:
+    """Колоночный индекс анкет в памяти процесса
+
+    Массивы NumPy id, даты рождения (номер дня), пола, кода города
+    (словарное кодирование) и случайного ключа, отсортированные по id. Отбор кандидата - векторные
+    маски по настройкам поиска и исключениям, без запроса к Postgres.
+
+    В режиме нескольких процессов основной снимок публикуется в файлы .npy
+    (publish) и подключается процессами через mmap без копирования (attach).
+    Снимки версионируются: manifest.json заменяется атомарно, процессы
+    переключаются на новую версию при следующем обращении (refresh).
+    Анкеты, сохраненные процессом после подключения снимка, хранятся
+    локально (дельта) до следующей версии.
+    """
+
+    # Значение "не указано" в числовых колонках
+    UNKNOWN = -1
+    COLUMNS = ('ids', 'birth_days', 'sexes', 'cities', 'rand_keys')
+    MANIFEST = 'manifest.json'
+    # Как часто проверять появление новой версии снимка, сек
+    REFRESH_INTERVAL = 5.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._city_codes: Dict[str, int] = {}
+        # Снимок колонок заменяется целиком - читатели не берут блокировку
+        self._columns: Optional[Tuple] = None
+        # Локальная дельта поверх опубликованного снимка: id -> (id, birth_day, sex, city)
+        self._delta_rows: Dict[int, Tuple] = {}
+        self._delta_columns: Optional[Tuple] = None
+        self._directory: Optional[str] = None
+        self._version = 0
+        self._checked_at = 0.0
+        self._publisher_lock = None
+
+    @staticmethod
+    def available() -> bool:
+        return np is not None
+
+    @property
+    def ready(self) -> bool:
+        return self._columns is not None
+
+    @property
+    def shared(self) -> bool:
+        return self._directory is not None
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def __len__(self) -> int:
+        if not self._columns:
+            return 0
+        return len(self._columns[0]) + len(self._delta_rows)
+
+    def build(self, db: Session) -> int:
+        # Полная загрузка анкет (при старте). Возвращает число анкет в индексе
+        if not self.available():
+            logger.warning("numpy не установлен - индекс анкет отключен")
+            return 0
+
+        rows = db.query(Profile.id, Profile.birth_date, Profile.birth_year_missing,
+                        Profile.age, Profile.sex, Profile.city).yield_per(10000)
+        rows = ((profile_id, self._birth_day(birth_date, year_missing, age), sex, city)
+                for profile_id, birth_date, year_missing, age, sex, city in rows)
+        with self._lock:
+            self._city_codes = {}
+            self._columns = self._sorted(self._encode(rows))
+            self._delta_rows = {}
+            self._delta_columns = None
+        logger.info(f"Индекс анкет построен: {len(self)} анкет")
+        return len(self)
+
+    def upsert(self, profiles: Iterable[Profile]) -> None:
+        # Добавление и обновление анкет (после сохранения результатов поиска)
+        self.upsert_rows(self.index_rows(profiles))
+
+    def index_rows(self, profiles: Iterable[Profile]) -> List[Tuple]:
+        # Строки индекса по анкетам - снимаются до коммита, пока атрибуты загружены
+        return [(p.id, self._birth_day(p.birth_date, p.birth_year_missing, p.age), p.sex, p.city)
+                for p in profiles if p.id is not None]
+
+    def upsert_rows(self, rows: List[Tuple]) -> None:
+        # Добавление и обновление готовых строк индекса
+        if not self.ready or not rows:
+            return
+
+        with self._lock:
+            if self.shared:
+                # Общий снимок только для чтения - изменения копим в дельте
+                self._delta_rows.update((row[0], row) for row in rows)
+                self._delta_columns = self._sorted(self._encode(self._delta_rows.values()))
+                return
+
+            new_columns = self._encode(rows)
+            ids = self._columns[0]
+            keep = ~np.isin(ids, new_columns[0])
+            self._columns = self._sorted(tuple(
+                np.concatenate((column[keep], new_column))
+                for column, new_column in zip(self._columns, new_columns)
+            ))
+
+    def remove(self, profile_id: int) -> None:
+        # Удаление анкеты, которой больше нет в БД
+        if not self.ready:
+            return
+
+        with self._lock:
+            if profile_id in self._delta_rows:
+                del self._delta_rows[profile_id]
+                self._delta_columns = self._sorted(self._encode(self._delta_rows.values()))
+            if not self.shared:
+                keep = self._columns[0] != profile_id
+                self._columns = tuple(column[keep] for column in self._columns)
+
+    def candidates(self, city: Optional[str] = None, age_min: Optional[int] = None,
+                   age_max: Optional[int] = None, sex: Optional[int] = None,
+                   exclude_ids: Optional[Iterable[int]] = None,
+                   also_exclude: Optional[Iterable[int]] = None):
+        # id и случайные ключи анкет, подходящих под настройки поиска, без исключенных.
+        # exclude_ids - обычно array('q') из exclusion_sets (читается без копирования),
+        # also_exclude - несколько id сверх него. Условия повторяют crud.search_profile_filters
+        self.refresh()
+        columns, delta, city_codes = self._columns, self._delta_columns, self._city_codes
+
+        user_excluded = self._id_array(exclude_ids)
+        if also_exclude:
+            user_excluded = np.concatenate((user_excluded, np.fromiter(also_exclude, dtype=np.int64)))
+        excluded = user_excluded
+        if delta is not None:
+            # Строки снимка, перекрытые дельтой, берем из дельты
+            excluded = np.concatenate((user_excluded, delta[0]))
+
+        ids, rand_keys = self._filter(columns, city_codes, city, age_min, age_max, sex, excluded)
+        if delta is not None:
+            delta_ids, delta_keys = self._filter(delta, city_codes, city, age_min, age_max, sex,
+                                                 user_excluded)
+            ids = np.concatenate((ids, delta_ids))
+            rand_keys = np.concatenate((rand_keys, delta_keys))
+        return ids, rand_keys
+
+    def pick(self, city: Optional[str] = None, age_min: Optional[int] = None,
+             age_max: Optional[int] = None, sex: Optional[int] = None,
+             exclude_ids: Optional[Iterable[int]] = None,
+             also_exclude: Optional[Iterable[int]] = None) -> Optional[int]:
+        # Случайная подходящая анкета: ближайший случайный ключ к случайной точке
+        ids, rand_keys = self.candidates(city, age_min, age_max, sex, exclude_ids, also_exclude)
+        if not len(ids):
+            return None
+        point = np.uint32(random.getrandbits(32))
+        return int(ids[np.argmin(rand_keys - point)])
+
+    # ==================== Общий снимок для нескольких процессов ====================
+
+    def publish(self, directory: str) -> int:
+        # Публикация текущего индекса новой версией в directory. Возвращает номер версии
+        if not self.ready:
+            raise RuntimeError("Индекс анкет не построен")
+
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            columns = self._merged_columns()
+            city_codes = dict(self._city_codes)
+
+        previous = self._read_manifest(directory)
+        version = (previous['version'] if previous else 0) + 1
+        for name, column in zip(self.COLUMNS, columns):
+            np.save(os.path.join(directory, f"{name}.v{version}.npy"), column)
+
+        # Атомарная замена манифеста - процессы видят либо старую, либо новую версию
+        manifest_tmp = os.path.join(directory, f"{self.MANIFEST}.tmp")
+        with open(manifest_tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': version, 'cities': city_codes, 'size': len(columns[0])}, f)
+        os.replace(manifest_tmp, os.path.join(directory, self.MANIFEST))
+
+        # Файлы прошлой версии удаляем: уже отображенные в память остаются доступны
+        if previous:
+            for name in self.COLUMNS:
+                try:
+                    os.remove(os.path.join(directory, f"{name}.v{previous['version']}.npy"))
+                except FileNotFoundError:
+                    pass
+
+        logger.info(f"Индекс анкет опубликован: версия {version}, {len(columns[0])} анкет")
+        return version
+
+    def attach(self, directory: str) -> bool:
+        # Подключение опубликованного снимка через mmap. False - снимка еще нет
+        if not self.available():
+            return False
+
+        manifest = self._read_manifest(directory)
+        if not manifest:
+            return False
+
+        try:
+            columns = tuple(
+                np.load(os.path.join(directory, f"{name}.v{manifest['version']}.npy"), mmap_mode='r')
+                for name in self.COLUMNS
+            )
+        except FileNotFoundError:
+            # Версию успели заменить - подключимся к новой при следующей проверке
+            return False
+
+        with self._lock:
+            self._directory = directory
+            self._columns = columns
+            self._version = manifest['version']
+            self._checked_at = time.monotonic()
+            city_codes = manifest['cities']
+            # Дельта остается только для анкет, которых нет в новом снимке
+            if self._delta_rows:
+                in_snapshot = np.isin(np.fromiter(self._delta_rows, dtype=np.int64), columns[0])
+                for profile_id, present in zip(list(self._delta_rows), in_snapshot):
+                    if present:
+                        del self._delta_rows[profile_id]
+            self._city_codes = dict(city_codes)
+            self._delta_columns = (self._sorted(self._encode(self._delta_rows.values()))
+                                   if self._delta_rows else None)
+        logger.info(f"Подключен индекс анкет версии {manifest['version']}")
+        return True
+
+    def refresh(self) -> None:
+        # Переключение на новую опубликованную версию (не чаще REFRESH_INTERVAL)
+        if not self.shared:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.REFRESH_INTERVAL:
+            return
+        self._checked_at = now
+
+        manifest = self._read_manifest(self._directory)
+        if manifest and manifest['version'] != self._version:
+            self.attach(self._directory)
+
+    def start_shared(self, directory: str, session_factory: Callable[[], Session],
+                     rebuild_interval: float = 0, wait_timeout: float = 60) -> None:
+        # Запуск в режиме нескольких процессов: первый процесс строит и публикует
+        # снимок (и перестраивает его раз в rebuild_interval сек), остальные подключаются
+        self._publisher_lock = self.acquire_publisher(directory)
+        if self._publisher_lock:
+            self._publish_fresh(directory, session_factory)
+            if rebuild_interval:
+                threading.Thread(target=self._rebuild_loop, name="profile-index",
+                                 args=(directory, session_factory, rebuild_interval),
+                                 daemon=True).start()
+        else:
+            deadline = time.monotonic() + wait_timeout
+            while time.monotonic() < deadline:
+                if self.attach(directory):
+                    return
+                time.sleep(0.5)
+            logger.warning("Снимок индекса анкет не опубликован - строим локальный индекс")
+            with session_factory() as session:
+                self.build(session)
+            return
+
+        self.attach(directory)
+
+    def _publish_fresh(self, directory: str, session_factory: Callable[[], Session]) -> int:
+        # Новая версия снимка строится отдельно и подключается процессами через refresh
+        fresh = ProfileIndex()
+        with session_factory() as session:
+            fresh.build(session)
+        return fresh.publish(directory)
+
+    def _rebuild_loop(self, directory: str, session_factory: Callable[[], Session],
+                      rebuild_interval: float) -> None:
+        while True:
+            time.sleep(rebuild_interval)
+            try:
+                self._publish_fresh(directory, session_factory)
+            except Exception as e:
+                logger.error(f"Ошибка перестроения индекса анкет: {e}")
+
+    def acquire_publisher(self, directory: str):
+        # Блокировка публикующего процесса: один строит снимок, остальные подключаются.
+        # Возвращает открытый файл блокировки (держать до завершения) или None
+        import fcntl
+
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, 'publisher.lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    def _read_manifest(self, directory: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(directory, self.MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    # ==================== Внутреннее ====================
+
+    def _merged_columns(self) -> Tuple:
+        # Снимок вместе с дельтой. Вызывается под self._lock
+        if self._delta_columns is None:
+            return self._columns
+        keep = ~np.isin(self._columns[0], self._delta_columns[0])
+        return self._sorted(tuple(
+            np.concatenate((column[keep], delta_column))
+            for column, delta_column in zip(self._columns, self._delta_columns)
+        ))
+
+    def _filter(self, columns: Tuple, city_codes: Dict[str, int], city: Optional[str],
+                age_min: Optional[int], age_max: Optional[int], sex: Optional[int], excluded):
+        ids, birth_days, sexes, cities, rand_keys = columns
+        mask = np.ones(len(ids), dtype=bool)
+
+        if city:
+            code = city_codes.get(city)
+            if code is None:
+                return ids[:0], rand_keys[:0]
+            mask &= cities == code
+        # Возраст - диапазон дат рождения на сегодня, как в crud.age_filters
+        born_after, born_until = birth_date_bounds(age_min, age_max)
+        if born_until:
+            mask &= (birth_days <= born_until.toordinal()) & (birth_days != self.UNKNOWN)
+        if born_after:
+            mask &= birth_days > born_after.toordinal()
+        if sex:
+            mask &= sexes == sex
+
+        if len(excluded) and len(ids):
+            # id отсортированы - позиции исключений находим бинарным поиском
+            positions = np.searchsorted(ids, excluded)
+            positions = positions[positions < len(ids)]
+            positions = positions[np.isin(ids[positions], excluded)]
+            mask[positions] = False
+
+        return ids[mask], rand_keys[mask]
+
+    def _encode(self, rows) -> Tuple:
+        # Строки (id, birth_day, sex, city) -> колонки NumPy. Вызывается под self._lock
+        ids: List[int] = []
+        birth_days: List[int] = []
+        sexes: List[int] = []
+        cities: List[int] = []
+        for profile_id, birth_day, sex, city in rows:
+            ids.append(profile_id)
+            birth_days.append(birth_day)
+            sexes.append(sex if sex is not None else self.UNKNOWN)
+            if city:
+                cities.append(self._city_codes.setdefault(city, len(self._city_codes)))
+            else:
+                cities.append(self.UNKNOWN)
+
+        return (
+            np.array(ids, dtype=np.int64),
+            np.array(birth_days, dtype=np.int32),
+            np.array(sexes, dtype=np.int8),
+            np.array(cities, dtype=np.int32),
+            np.random.randint(0, 2 ** 32, size=len(ids), dtype=np.uint32)
+        )
+
+    @staticmethod
+    def _id_array(ids: Optional[Iterable[int]]) -> "np.ndarray":
+        # id -> массив int64; array('q') - представление того же буфера без копирования
+        if ids is None:
+            return np.empty(0, dtype=np.int64)
+        if isinstance(ids, array) and ids.typecode == 'q':
+            return np.frombuffer(ids, dtype=np.int64) if len(ids) else np.empty(0, dtype=np.int64)
+        if isinstance(ids, np.ndarray):
+            return ids.astype(np.int64, copy=False)
+        return np.fromiter(ids, dtype=np.int64)
+
+    @classmethod
+    def _birth_day(cls, birth_date: Optional[date], year_missing: Optional[bool],
+                   age: Optional[int] = None) -> int:
+        # Дата рождения -> номер дня (date.toordinal); без даты или года - UNKNOWN.
+        # Анкета без birth_date (сохранена до ее появления) - последний день рождения
+        # с возрастом age на сегодня: отбор совпадает с age BETWEEN в crud.age_filters
+        if birth_date is None:
+            if age is None:
+                return cls.UNKNOWN
+            return years_before(date.today(), age).toordinal()
+        if year_missing:
+            return cls.UNKNOWN
+        return birth_date.toordinal()
+
+    @staticmethod
+    def _sorted(columns: Tuple) -> Tuple:
+        order = np.argsort(columns[0], kind='stable')
+        return tuple(column[order] for column in columns)
+
+
+# Глобальный индекс анкет (строится при старте, если включен PROFILE_INDEX)
+profile_index = ProfileIndex()
@@ -0,0 +1,175 @@
+import logging
+import math
+import random
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List
+
+logger = logging.getLogger(__name__)
+
+MASK64 = (1 << 64) - 1
+
+
+def _mix64(value: int) -> int:
+    # splitmix64 - быстрое перемешивание битов целого числа
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+class BloomFilter:
+    """Фильтр Блума для целых id (VK id)"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(8, int(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: int):
+        # Двойное хеширование: k позиций из двух хешей
+        first = _mix64(item)
+        second = _mix64(first) | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.size
+
+    def add(self, item: int) -> None:
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: int) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def estimated_error_rate(self) -> float:
+        # Ожидаемая доля ложных срабатываний при текущем заполнении
+        return (1 - math.exp(-self.hash_count * self.count / self.size)) ** self.hash_count
+
+
+class SeenFilters:
+    """Фильтры Блума просмотренных пользователем VK id
+
+    Отсеивают уже показанных пользователей из результатов поиска до записи
+    в БД. Фильтр строится из viewed_profiles при первом обращении и
+    пополняется при каждом показе анкеты. Ложное срабатывание означает
+    пропуск непросмотренного пользователя - часть отсеянных id выборочно
+    сверяется с БД (verify_sample_rate), доля ошибок попадает в метрики.
+    """
+
+    def __init__(self, error_rate: float = 0.01, max_users: int = 10000,
+                 verify_sample_rate: float = 0.05):
+        self.error_rate = error_rate
+        self.max_users = max_users
+        self.verify_sample_rate = verify_sample_rate
+        self._lock = threading.Lock()
+        self._filters: "OrderedDict[int, BloomFilter]" = OrderedDict()
+        # Метрики
+        self.checked = 0
+        self.dropped = 0
+        self.verified = 0
+        self.verified_unseen = 0
+        self.false_positives = 0
+
+    def load(self, bot_user_id: int, load: Callable[[], Iterable[int]]) -> BloomFilter:
+        # Фильтр пользователя; load() вызывается, если его еще нет в памяти
+        with self._lock:
+            bloom = self._filters.get(bot_user_id)
+            if bloom is not None:
+                self._filters.move_to_end(bot_user_id)
+                return bloom
+
+        bloom = self._build(list(load()))
+        with self._lock:
+            current = self._filters.setdefault(bot_user_id, bloom)
+            self._filters.move_to_end(bot_user_id)
+            while len(self._filters) > self.max_users:
+                self._filters.popitem(last=False)
+            return current
+
+    def add(self, bot_user_id: int, vk_id: int) -> None:
+        # Анкета показана (если фильтр пользователя загружен)
+        with self._lock:
+            bloom = self._filters.get(bot_user_id)
+            if bloom is None:
+                return
+            if bloom.full:
+                # Фильтр переполнен - точность падает, перестроим из БД при следующем поиске
+                del self._filters[bot_user_id]
+                return
+            bloom.add(vk_id)
+
+    def reset(self, bot_user_id: int) -> None:
+        with self._lock:
+            self._filters.pop(bot_user_id, None)
+
+    def filter_unseen(self, bot_user_id: int, users: List[Dict],
+                      verify: Callable[[List[int]], Iterable[int]] = None) -> List[Dict]:
+        # Результаты поиска без уже просмотренных пользователей.
+        # verify(vk_ids) -> действительно просмотренные из них (для метрик)
+        with self._lock:
+            bloom = self._filters.get(bot_user_id)
+        if bloom is None:
+            return users
+
+        unseen = []
+        dropped = []
+        for user in users:
+            if user['vk_id'] in bloom:
+                dropped.append(user['vk_id'])
+            else:
+                unseen.append(user)
+
+        # Выборочная сверка: ложные срабатывания / все действительно непросмотренные
+        false_positives = 0
+        verified = 0
+        verified_unseen = 0
+        if dropped and verify and random.random() < self.verify_sample_rate:
+            really_seen = len(set(verify(dropped)))
+            verified = len(users)
+            verified_unseen = len(users) - really_seen
+            false_positives = len(dropped) - really_seen
+
+        with self._lock:
+            self.checked += len(users)
+            self.dropped += len(dropped)
+            self.verified += verified
+            self.verified_unseen += verified_unseen
+            self.false_positives += false_positives
+
+        logger.info(f"Фильтр просмотренных: отсеяно {len(dropped)} из {len(users)}, "
+                    f"ожидаемая доля ошибок {bloom.estimated_error_rate():.4f}")
+        return unseen
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            filters = list(self._filters.values())
+            return {
+                'users': len(filters),
+                'checked': self.checked,
+                'dropped': self.dropped,
+                'verified': self.verified,
+                'false_positives': self.false_positives,
+                'observed_error_rate': (self.false_positives / self.verified_unseen
+                                        if self.verified_unseen else 0.0),
+                'estimated_error_rate': (sum(f.estimated_error_rate() for f in filters) / len(filters)
+                                         if filters else 0.0)
+            }
+
+    def _build(self, vk_ids: List[int]) -> BloomFilter:
+        # Запас емкости, чтобы фильтр не переполнился сразу после загрузки
+        bloom = BloomFilter(max(1000, len(vk_ids) * 2), self.error_rate)
+        for vk_id in vk_ids:
+            bloom.add(vk_id)
+        return bloom
+
+
+# Глобальные фильтры просмотренных
+seen_filters = SeenFilters()
@@ -1,72 +1,96 @@
+import threading
+from collections import OrderedDict
 from typing import Optional, Dict, Any
-from sqlalchemy.exc import SQLAlchemyError
-import logging
-from src.database.base import Session
+from sqlalchemy.orm import Session as SASession
 from src.database.crud import get_user_state, create_or_update_user_state, delete_user_state
 
-logger = logging.getLogger(__name__)
-
 
 class StateManager:
-    # Менеджер состояний пользователей
-
-    def __init__(self) -> None:
-        self.Session = Session
-
-    def set_state(self, vk_id: int, state: str) -> bool:
-        # Установка состояния пользователя
-        try:
-            with Session() as session:
-                create_or_update_user_state(session, vk_id, state)
-                return True
-        except SQLAlchemyError as e:
-            logger.error(f"Ошибка установки состояния для пользователя {vk_id}: {e}")
-            return False
-
-    def get_state(self, vk_id: int) -> Optional[str]:
+    # Менеджер состояний пользователей.
+    # id текущей анкеты хранится в данных состояния (candidate_id) - переживает
+    # перезапуск и общий для процессов бота; сама анкета кэшируется в памяти (LRU)
+
+    # Анкет в кэше текущих анкет
+    MAX_CANDIDATES = 10000
+
+    def __init__(self, max_candidates: int = None) -> None:
+        self.max_candidates = max_candidates or self.MAX_CANDIDATES
+        # Текущая показанная анкета пользователя (vk_id -> кандидат)
+        self._candidates: "OrderedDict[int, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_state(self, session: SASession, vk_id: int, state: str) -> None:
+        # Установка состояния пользователя. Ошибки БД не перехватываются -
+        # unit_of_work откатывает транзакцию события
+        create_or_update_user_state(session, vk_id, state)
+
+    def get_state(self, session: SASession, vk_id: int) -> Optional[str]:
         # Получение состояния пользователя
-        try:
-            with Session() as session:
-                user_state = get_user_state(session, vk_id)
-                return user_state.current_state if user_state else None
-        except SQLAlchemyError as e:
-            logger.error(f"Ошибка получения состояния пользователя {vk_id}: {e}")
-            return None
-
-    def update_data(self, vk_id: int, **kwargs) -> Dict:
+        user_state = get_user_state(session, vk_id)
+        return user_state.current_state if user_state else None
+
+    def update_data(self, session: SASession, vk_id: int, **kwargs) -> Dict:
         # Обновление данных состояния
-        with Session() as session:
-            user_state = get_user_state(session, vk_id)
-            if user_state:
-                current_data = user_state.state_data or {}
-                current_data.update(kwargs)
-                create_or_update_user_state(session, vk_id, user_state.current_state, current_data)
-                return current_data
-            else:
-                create_or_update_user_state(session, vk_id, 'start', kwargs)
-                return kwargs
-
-    def set_data(self, vk_id: int, **kwargs) -> None:
+        user_state = get_user_state(session, vk_id)
+        if user_state:
+            current_data = user_state.state_data or {}
+            current_data.update(kwargs)
+            create_or_update_user_state(session, vk_id, user_state.current_state, current_data)
+            return current_data
+        else:
+            create_or_update_user_state(session, vk_id, 'start', kwargs)
+            return kwargs
+
+    def set_data(self, session: SASession, vk_id: int, **kwargs) -> None:
         # Установка данных состояния ( полная замена )
-        with Session() as session:
-            user_state = get_user_state(session, vk_id)
-            current_state = user_state.current_state if user_state else 'start'
+        user_state = get_user_state(session, vk_id)
+        current_state = user_state.current_state if user_state else 'start'
 
-            data_to_save = kwargs.copy()
-            if 'vk_id' in data_to_save:
-                del data_to_save['vk_id']
+        data_to_save = kwargs.copy()
+        if 'vk_id' in data_to_save:
+            del data_to_save['vk_id']
 
-            create_or_update_user_state(session, vk_id, current_state, data_to_save)
+        create_or_update_user_state(session, vk_id, current_state, data_to_save)
 
-    def get_data(self, vk_id: int, key: str = None) -> Any:
+    def get_data(self, session: SASession, vk_id: int, key: str = None) -> Any:
         # Получение данных состояния
-        with Session() as session:
-            user_state = get_user_state(session, vk_id)
-            if user_state and user_state.state_data:
-                return user_state.state_data.get(key) if key else user_state.state_data
-            return None if key else {}
+        user_state = get_user_state(session, vk_id)
+        if user_state and user_state.state_data:
+            return user_state.state_data.get(key) if key else user_state.state_data
+        return None if key else {}
 
-    def clear_state(self, vk_id: int) -> None:
+    def clear_state(self, session: SASession, vk_id: int) -> None:
         # Очистка состояния пользователя
-        with Session() as session:
-            delete_user_state(session, vk_id)
+        delete_user_state(session, vk_id)
+        self._forget_candidate(vk_id)
+
+    def set_candidate(self, session: SASession, vk_id: int, candidate: Dict) -> None:
+        # Запоминаем анкету, которая сейчас показана пользователю
+        self.update_data(session, vk_id, candidate_id=candidate['profile_id'])
+        with self._lock:
+            self._candidates[vk_id] = candidate
+            self._candidates.move_to_end(vk_id)
+            while len(self._candidates) > self.max_candidates:
+                self._candidates.popitem(last=False)
+
+    def get_candidate(self, vk_id: int) -> Optional[Dict]:
+        # Текущая анкета пользователя из кэша, без обращения к БД
+        with self._lock:
+            candidate = self._candidates.get(vk_id)
+            if candidate is not None:
+                self._candidates.move_to_end(vk_id)
+            return candidate
+
+    def get_candidate_id(self, session: SASession, vk_id: int) -> Optional[int]:
+        # id текущей анкеты из данных состояния (промах кэша, другой процесс, перезапуск)
+        return self.get_data(session, vk_id, 'candidate_id')
+
+    def clear_candidate(self, session: SASession, vk_id: int) -> None:
+        # Сброс текущей анкеты
+        if self.get_data(session, vk_id, 'candidate_id') is not None:
+            self.update_data(session, vk_id, candidate_id=None)
+        self._forget_candidate(vk_id)
+
+    def _forget_candidate(self, vk_id: int) -> None:
+        with self._lock:
+            self._candidates.pop(vk_id, None)
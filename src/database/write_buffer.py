@@ -0,0 +1,234 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Set, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from src.config import settings
+from src.database.base import db_manager
+from src.database.exclusions import exclusion_sets
+from src.database.crud import add_viewed_profiles_batch, add_photo_likes_batch
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Отложенная пакетная запись просмотров анкет и лайков фото
+
+    События копятся в памяти и записываются многострочным
+    INSERT ... ON CONFLICT DO NOTHING раз в flush_interval_ms или при
+    накоплении max_rows строк. Еще не записанные события пользователя
+    доступны через pending_views / is_like_pending.
+    Если БД отклоняет пакет из-за ограничений, строки пишутся по одной и
+    отклоненные отбрасываются. При других ошибках события возвращаются в
+    буфер - не больше max_retries раз и не больше max_pending событий.
+    """
+
+    def __init__(self, flush_interval_ms: int = None, max_rows: int = None,
+                 max_retries: int = None, max_pending: int = None):
+        self.flush_interval = (flush_interval_ms or settings.WRITE_BEHIND_INTERVAL_MS) / 1000
+        self.max_rows = max_rows or settings.WRITE_BEHIND_MAX_ROWS
+        self.max_retries = max_retries or settings.WRITE_BEHIND_MAX_RETRIES
+        self.max_pending = max_pending or settings.WRITE_BEHIND_MAX_PENDING
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Порядок важен только внутри пары (пользователь, анкета/фото) - храним словарями
+        self._views: Dict[Tuple[int, int], datetime] = {}
+        self._likes: Dict[Tuple[int, str], Dict] = {}
+        # Неудачные попытки записи событий, возвращенных в буфер: ('view' | 'like', ключ) -> число
+        self._attempts: Dict[Tuple[str, Tuple], int] = {}
+        # Отброшенные события (метрика)
+        self.dropped = 0
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    # ==================== События ====================
+
+    def add_view(self, bot_user_id: int, profile_id: int) -> None:
+        # Анкета показана пользователю
+        with self._lock:
+            self._views.setdefault((bot_user_id, profile_id), datetime.now())
+            self._notify_if_full()
+
+    def add_like(self, bot_user_id: int, profile_id: int, photo_url: str) -> None:
+        # Лайк фото
+        with self._lock:
+            self._likes[(bot_user_id, photo_url)] = {
+                'bot_user_id': bot_user_id,
+                'profile_id': profile_id,
+                'photo_url': photo_url,
+                'liked_at': datetime.now()
+            }
+            self._notify_if_full()
+
+    def discard_like(self, bot_user_id: int, photo_url: str) -> bool:
+        # Отмена еще не записанного лайка. True - лайк был в буфере
+        with self._lock:
+            self._attempts.pop(('like', (bot_user_id, photo_url)), None)
+            return self._likes.pop((bot_user_id, photo_url), None) is not None
+
+    def toggle_like(self, bot_user_id: int, profile_id: int, photo_url: str,
+                    remove_stored: Callable[[], bool]) -> bool:
+        # Повторный выбор снимает лайк (еще не записанный или через remove_stored - уже в БД),
+        # новый лайк уходит в буфер. True - лайк поставлен, False - снят.
+        # Ждем идущую запись пакета: лайк из нее уже в БД и remove_stored его увидит
+        with self._flush_lock:
+            if self.discard_like(bot_user_id, photo_url) or remove_stored():
+                return False
+            self.add_like(bot_user_id, profile_id, photo_url)
+            return True
+
+    def discard_views(self, bot_user_id: int) -> int:
+        # Удаление еще не записанных просмотров пользователя (очистка истории).
+        # Ждем идущую запись пакета, чтобы она не вернула просмотры после очистки
+        with self._flush_lock, self._lock:
+            keys = [key for key in self._views if key[0] == bot_user_id]
+            for key in keys:
+                del self._views[key]
+                self._attempts.pop(('view', key), None)
+            return len(keys)
+
+    # ==================== Чтение своих событий ====================
+
+    def pending_views(self, bot_user_id: int) -> Set[int]:
+        # Анкеты, просмотр которых еще не записан в БД
+        with self._lock:
+            return {profile_id for user, profile_id in self._views if user == bot_user_id}
+
+    def is_like_pending(self, bot_user_id: int, photo_url: str) -> bool:
+        with self._lock:
+            return (bot_user_id, photo_url) in self._likes
+
+    def has_pending_likes(self, bot_user_id: int) -> bool:
+        with self._lock:
+            return any(user == bot_user_id for user, _ in self._likes)
+
+    # ==================== Запись ====================
+
+    def flush(self) -> int:
+        # Записать накопленные события. Возвращает число вставленных строк
+        with self._flush_lock:
+            with self._lock:
+                views, self._views = self._views, {}
+                likes, self._likes = self._likes, {}
+
+            if not views and not likes:
+                return 0
+
+            view_rows = [
+                {'bot_user_id': bot_user_id, 'profile_id': profile_id, 'viewed_at': viewed_at}
+                for (bot_user_id, profile_id), viewed_at in views.items()
+            ]
+            like_rows = list(likes.values())
+
+            session = db_manager.RequestSession()
+            try:
+                inserted, rejected = self._write(session, view_rows, like_rows)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Ошибка пакетной записи ({len(view_rows)} просмотров, "
+                             f"{len(like_rows)} лайков): {e}")
+                self._requeue(views, likes)
+                return 0
+            finally:
+                session.close()
+
+            with self._lock:
+                for key in views:
+                    self._attempts.pop(('view', key), None)
+                for key in likes:
+                    self._attempts.pop(('like', key), None)
+
+            # Записанные просмотры - в наборы исключений (до записи их учитывает pending_views)
+            for row in view_rows:
+                if id(row) not in rejected:
+                    exclusion_sets.add(row['bot_user_id'], row['profile_id'])
+
+            # Чтение с реплик для этих пользователей пока идет с основной БД
+            if db_manager.replica_engines:
+                for bot_user_id in {row['bot_user_id'] for row in view_rows + like_rows}:
+                    db_manager.mark_write(bot_user_id)
+
+            logger.debug(f"Пакетная запись: {len(view_rows)} просмотров, "
+                         f"{len(like_rows)} лайков, вставлено {inserted}")
+            return inserted
+
+    def shutdown(self) -> None:
+        # Остановка фонового потока и запись оставшихся событий
+        with self._lock:
+            self._stopped = True
+            self._wakeup.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def _write(self, session: Session, view_rows: List[Dict],
+               like_rows: List[Dict]) -> Tuple[int, Set[int]]:
+        # Запись пакета -> (вставлено строк, id() отклоненных строк). Если БД отклонила
+        # пакет (например, анкета или пользователь бота уже удалены), строки пишутся
+        # по одной, отклоненные отбрасываются
+        try:
+            with session.begin_nested():
+                inserted = add_viewed_profiles_batch(session, view_rows) + add_photo_likes_batch(session, like_rows)
+            return inserted, set()
+        except IntegrityError as e:
+            logger.warning(f"Пакет отклонен БД, запись по одной строке: {e.orig}")
+
+        inserted = 0
+        rejected: Set[int] = set()
+        for write, rows in ((add_viewed_profiles_batch, view_rows), (add_photo_likes_batch, like_rows)):
+            inserted += self._write_rows(session, write, rows, rejected)
+        return inserted, rejected
+
+    def _write_rows(self, session: Session, write: Callable[[Session, List[Dict]], int],
+                    rows: List[Dict], rejected: Set[int]) -> int:
+        inserted = 0
+        for row in rows:
+            try:
+                with session.begin_nested():
+                    inserted += write(session, [row])
+            except IntegrityError as e:
+                self.dropped += 1
+                rejected.add(id(row))
+                logger.error(f"Событие отброшено - отклонено БД: {row}: {e.orig}")
+        return inserted
+
+    def _requeue(self, views: Dict, likes: Dict) -> None:
+        # Возврат событий в буфер после ошибки (новые события не перезаписываем).
+        # Событие, не записанное max_retries раз, и события сверх max_pending отбрасываются
+        dropped = []
+        with self._lock:
+            for kind, events, pending in (('view', views, self._views), ('like', likes, self._likes)):
+                for key, event in events.items():
+                    attempts = self._attempts.pop((kind, key), 0) + 1
+                    if attempts >= self.max_retries or len(self._views) + len(self._likes) >= self.max_pending:
+                        dropped.append((kind, key))
+                        continue
+                    self._attempts[(kind, key)] = attempts
+                    pending.setdefault(key, event)
+            self.dropped += len(dropped)
+
+        if dropped:
+            logger.error(f"Отброшено событий после ошибок записи: {len(dropped)} "
+                         f"(первые: {dropped[:10]})")
+
+    def _notify_if_full(self) -> None:
+        # Вызывается под self._lock
+        if len(self._views) + len(self._likes) >= self.max_rows:
+            self._wakeup.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return
+                self._wakeup.wait(self.flush_interval)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Ошибка фоновой записи: {e}")
@@ -2,7 +2,8 @@ import logging
 import sys
 from src.config import settings
 from src.vk_bot.vk_bot import VkBot
-from src.database.base import create_tables
+from src.database.base import create_tables, Session
+from src.database.profile_index import profile_index
 
 # Настройка логирования
 logging.basicConfig(
@@ -50,6 +51,22 @@ def setup_database() -> bool:
         return False
 
 
+def setup_profile_index() -> None:
+    # Индекс анкет в памяти (необязательный, нужен numpy)
+    if not settings.PROFILE_INDEX:
+        return
+    try:
+        if settings.PROFILE_INDEX_DIR and profile_index.available():
+            # Несколько процессов бота делят один снимок индекса через mmap
+            profile_index.start_shared(settings.PROFILE_INDEX_DIR, Session,
+                                       settings.PROFILE_INDEX_REBUILD_SEC)
+        else:
+            with Session() as session:
+                profile_index.build(session)
+    except Exception as e:
+        logger.error(f"Ошибка построения индекса анкет: {e}. Выбор анкет через БД")
+
+
 def main():
     # Основная функция запуска
     logger.info("Запуск VKinder")
@@ -62,6 +79,8 @@ def main():
     if not setup_database():
         sys.exit(1)
 
+    setup_profile_index()
+
     # Запуск бота
     try:
         bot = VkBot(settings.VK_GROUP_TOKEN, settings.VK_USER_TOKEN)
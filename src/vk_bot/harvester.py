@@ -0,0 +1,113 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from src.config import settings
+from src.database.base import db_manager
+from src.database.crud import (
+    get_hot_search_criteria, count_profiles_by_criteria, save_search_results
+)
+from src.vk_bot.vk_searcher import VKSearcher
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileHarvester:
+    """Фоновое пополнение анкет для популярных критериев поиска
+
+    Раз в interval секунд в непиковые часы выбирает top_n самых частых
+    сочетаний (город, пол, возрастной интервал) из настроек поиска и для
+    тех, где в БД меньше pool_size анкет, догружает анкеты из VK. За запуск
+    делается не больше budget запросов users.search; поиск по каждому
+    сочетанию продолжается с места прошлой остановки.
+    """
+
+    def __init__(self, vk_searcher: VKSearcher, interval: int = None, budget: int = None,
+                 top_n: int = None, pool_size: int = None, hours: str = None):
+        self.vk_searcher = vk_searcher
+        self.interval = interval or settings.HARVEST_INTERVAL_SEC
+        self.budget = budget or settings.HARVEST_API_BUDGET
+        self.top_n = top_n or settings.HARVEST_TOP_CRITERIA
+        self.pool_size = pool_size or settings.HARVEST_POOL_SIZE
+        self.hours = self._parse_hours(hours or settings.HARVEST_HOURS)
+
+        # Позиции поиска VK по сочетаниям критериев
+        self._cursors: Dict[Tuple, Dict] = {}
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="harvester", daemon=True)
+            self._thread.start()
+            logger.info(f"Пополнение анкет: часы {self.hours[0]}-{self.hours[1]}, "
+                        f"бюджет {self.budget} запросов")
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+
+    def is_offpeak(self, now: Optional[datetime] = None) -> bool:
+        start, end = self.hours
+        hour = (now or datetime.now()).hour
+        if start <= end:
+            return start <= hour < end
+        # Интервал через полночь, например 22-6
+        return hour >= start or hour < end
+
+    def harvest(self) -> int:
+        # Один запуск пополнения. Возвращает число сохраненных анкет
+        with db_manager.unit_of_work() as session:
+            hot_criteria = get_hot_search_criteria(session, self.top_n)
+
+        budget = self.budget
+        saved_total = 0
+        for city, sex, age_from, age_to, users in hot_criteria:
+            if budget <= 0:
+                break
+            if not city:
+                # Без города поиск слишком широкий - пул не наполнить
+                continue
+
+            with db_manager.unit_of_work() as session:
+                pool = count_profiles_by_criteria(session, city, age_from, age_to, sex, self.pool_size)
+            if pool >= self.pool_size:
+                continue
+
+            key = (city.lower(), sex, age_from, age_to)
+            cursor = self._cursors.setdefault(key, {})
+            requests = min(budget, self.vk_searcher.MAX_SEARCH_REQUESTS)
+            found_users = self.vk_searcher.smart_search_users(
+                city=city,
+                age_from=age_from,
+                age_to=age_to,
+                sex=sex,
+                target_count=self.pool_size - pool,
+                cursor=cursor,
+                max_requests=requests
+            )
+            # Поиск мог остановиться раньше (пул наполнен, выдача кончилась, ошибка VK)
+            budget -= cursor.get('requests_made', requests)
+
+            if found_users:
+                with db_manager.unit_of_work() as session:
+                    saved_total += len(save_search_results(session, found_users))
+
+            logger.info(f"Пополнение {city}, пол {sex}, {age_from}-{age_to} "
+                        f"({users} польз.): в пуле {pool}, найдено {len(found_users)}")
+
+        return saved_total
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            if not self.is_offpeak():
+                continue
+            try:
+                saved = self.harvest()
+                logger.info(f"Пополнение анкет завершено: сохранено {saved}")
+            except Exception as e:
+                logger.error(f"Ошибка пополнения анкет: {e}", exc_info=True)
+
+    @staticmethod
+    def _parse_hours(hours: str) -> Tuple[int, int]:
+        start, end = hours.split("-")
+        return int(start) % 24, int(end) % 24
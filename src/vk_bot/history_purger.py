@@ -0,0 +1,92 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Optional
+from src.database.base import db_manager
+from src.database.crud import delete_history_chunk
+from src.database.exclusions import exclusion_sets
+from src.database.seen_filter import seen_filters
+from src.database.models import Blacklist, ViewedProfiles
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryPurger:
+    """Фоновая очистка истории поиска пользователя
+
+    Черный список и просмотренные анкеты удаляются порциями по chunk_size
+    строк, каждая порция - отдельная короткая транзакция. О ходе очистки
+    сообщается каждые progress_every порций.
+    """
+
+    # Таблицы истории поиска
+    TABLES = {
+        'blacklist': Blacklist,
+        'viewed_profiles': ViewedProfiles
+    }
+
+    def __init__(self, chunk_size: int = 1000, progress_every: int = 10, max_workers: int = 2):
+        self.chunk_size = chunk_size
+        self.progress_every = progress_every
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="history-purge")
+        self._lock = threading.Lock()
+        self._running: Dict[int, Future] = {}
+
+    def start(self, user_id: int, bot_user_id: int,
+              on_progress: Optional[Callable[[int], None]] = None,
+              on_done: Optional[Callable[[Dict[str, int]], None]] = None,
+              on_error: Optional[Callable[[Exception], None]] = None) -> bool:
+        # Запуск очистки. False - очистка для пользователя уже идет
+        with self._lock:
+            if user_id in self._running:
+                return False
+            self._running[user_id] = self._executor.submit(
+                self._run, user_id, bot_user_id, on_progress, on_done, on_error)
+        return True
+
+    def is_running(self, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._running
+
+    def purge(self, bot_user_id: int,
+              on_progress: Optional[Callable[[int], None]] = None) -> Dict[str, int]:
+        # Удаление порциями. Возвращает число удаленных строк по таблицам
+        removed = {table: 0 for table in self.TABLES}
+        total = 0
+        chunks = 0
+        for table, model in self.TABLES.items():
+            while True:
+                with db_manager.unit_of_work() as session:
+                    deleted = delete_history_chunk(session, model, bot_user_id, self.chunk_size)
+                removed[table] += deleted
+                total += deleted
+                if deleted:
+                    chunks += 1
+                    logger.debug(f"Очистка истории {bot_user_id}: {table} -{deleted}, всего {total}")
+                    if on_progress and chunks % self.progress_every == 0:
+                        on_progress(total)
+                if deleted < self.chunk_size:
+                    break
+
+        # Набор исключений пользователя загрузится заново уже без истории
+        exclusion_sets.reset(bot_user_id)
+        seen_filters.reset(bot_user_id)
+        return removed
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, user_id: int, bot_user_id: int, on_progress, on_done, on_error) -> None:
+        try:
+            removed = self.purge(bot_user_id, on_progress)
+            logger.info(f"История поиска пользователя {user_id} очищена: {removed}")
+            if on_done:
+                on_done(removed)
+        except Exception as e:
+            logger.error(f"Ошибка очистки истории пользователя {user_id}: {e}", exc_info=True)
+            if on_error:
+                on_error(e)
+        finally:
+            with self._lock:
+                self._running.pop(user_id, None)
@@ -1,72 +1,107 @@
+from functools import lru_cache
+from typing import Dict, List, Optional
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 
 
+def make_payload(command: str, profile_id: Optional[int] = None, **kwargs) -> Dict:
+    # Payload кнопки: команда и (при необходимости) id анкеты
+    payload = {"command": command}
+    if profile_id is not None:
+        payload["profile_id"] = profile_id
+    payload.update(kwargs)
+    return payload
+
+
 class VkBotKeyboards:
     @staticmethod
     def create_main_keyboard():
         # Основная клавиатура для существующих пользователей
         keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button('Поиск', color=VkKeyboardColor.PRIMARY)
-        keyboard.add_button('Избранное', color=VkKeyboardColor.SECONDARY)
+        keyboard.add_button('Поиск', color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("search"))
+        keyboard.add_button('Избранное', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("favorites"))
         keyboard.add_line()
-        keyboard.add_button('Настройки', color=VkKeyboardColor.SECONDARY)
-        keyboard.add_button('Помощь', color=VkKeyboardColor.SECONDARY)
+        keyboard.add_button('Настройки', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("settings"))
+        keyboard.add_button('Помощь', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("help"))
         return keyboard
 
     @staticmethod
     def create_welcome_keyboard():
         # Приветственная клавиатура для новых пользователей
         keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button('Старт', color=VkKeyboardColor.POSITIVE)
-        keyboard.add_button('Помощь', color=VkKeyboardColor.SECONDARY)
+        keyboard.add_button('Старт', color=VkKeyboardColor.POSITIVE,
+                            payload=make_payload("start"))
+        keyboard.add_button('Помощь', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("help"))
         return keyboard
 
     @staticmethod
     def create_search_keyboard():
         # Клавиатура поиска
         keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button('Начать поиск', color=VkKeyboardColor.POSITIVE)
-        keyboard.add_button('Мои настройки', color=VkKeyboardColor.SECONDARY)
+        keyboard.add_button('Начать поиск', color=VkKeyboardColor.POSITIVE,
+                            payload=make_payload("search"))
+        keyboard.add_button('Мои настройки', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("settings"))
         keyboard.add_line()
-        keyboard.add_button('Назад', color=VkKeyboardColor.NEGATIVE)
+        keyboard.add_button('Назад', color=VkKeyboardColor.NEGATIVE,
+                            payload=make_payload("back"))
         return keyboard
 
     @staticmethod
-    def create_viewing_keyboard():
-        # Клавиатура просмотра анкет
+    def create_viewing_keyboard(profile_id: Optional[int] = None):
+        # Клавиатура просмотра анкет (кнопки действий несут id анкеты)
         keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button('❤️ В избранное', color=VkKeyboardColor.POSITIVE)
-        keyboard.add_button('👍 Лайк фото', color=VkKeyboardColor.POSITIVE)
+        keyboard.add_button('❤️ В избранное', color=VkKeyboardColor.POSITIVE,
+                            payload=make_payload("like", profile_id))
+        keyboard.add_button('👍 Лайк фото', color=VkKeyboardColor.POSITIVE,
+                            payload=make_payload("photo_like", profile_id))
         keyboard.add_line()
-        keyboard.add_button('➡️ Далее', color=VkKeyboardColor.PRIMARY)
-        keyboard.add_button('👎 В черный список', color=VkKeyboardColor.NEGATIVE)
+        keyboard.add_button('➡️ Далее', color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("next"))
+        keyboard.add_button('👎 В черный список', color=VkKeyboardColor.NEGATIVE,
+                            payload=make_payload("dislike", profile_id))
         keyboard.add_line()
-        keyboard.add_button('💾 Мои лайки', color=VkKeyboardColor.SECONDARY)
-        keyboard.add_button('🏠 В меню', color=VkKeyboardColor.SECONDARY)
+        keyboard.add_button('💾 Мои лайки', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("my_likes"))
+        keyboard.add_button('🏠 В меню', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("menu"))
         return keyboard
 
     @staticmethod
     def create_settings_keyboard():
         # Клавиатура настроек
         keyboard = VkKeyboard(one_time=False)
-        keyboard.add_button("Изменить возраст", color=VkKeyboardColor.PRIMARY)
-        keyboard.add_button("Изменить город", color=VkKeyboardColor.PRIMARY)
+        keyboard.add_button("Изменить возраст", color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("change_age"))
+        keyboard.add_button("Изменить город", color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("change_city"))
         keyboard.add_line()
-        keyboard.add_button("Изменить пол", color=VkKeyboardColor.PRIMARY)
-        keyboard.add_button("Очистить историю", color=VkKeyboardColor.NEGATIVE)
+        keyboard.add_button("Изменить пол", color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("change_sex"))
+        keyboard.add_button("Очистить историю", color=VkKeyboardColor.NEGATIVE,
+                            payload=make_payload("clear_history"))
         keyboard.add_line()
-        keyboard.add_button("Назад", color=VkKeyboardColor.SECONDARY)
+        keyboard.add_button("Назад", color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("back"))
         return keyboard
 
     @staticmethod
     def create_photo_choice_keyboard():
         # Клавиатура выбора фотографии
         keyboard = VkKeyboard(one_time=True)
-        keyboard.add_button('1', color=VkKeyboardColor.PRIMARY)
-        keyboard.add_button('2', color=VkKeyboardColor.PRIMARY)
-        keyboard.add_button('3', color=VkKeyboardColor.PRIMARY)
+        keyboard.add_button('1', color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("photo_choice", photo=1))
+        keyboard.add_button('2', color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("photo_choice", photo=2))
+        keyboard.add_button('3', color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("photo_choice", photo=3))
         keyboard.add_line()
-        keyboard.add_button('Отмена', color=VkKeyboardColor.NEGATIVE)
+        keyboard.add_button('Отмена', color=VkKeyboardColor.NEGATIVE,
+                            payload=make_payload("cancel"))
         return keyboard
 
     @staticmethod
@@ -74,8 +109,56 @@ class VkBotKeyboards:
         # Клавиатура выбора фотографии
         keyboard = VkKeyboard(one_time=True)
         for i in range(1, min(photo_count, 5) + 1):  # максимум 5 кнопок
-            keyboard.add_button(str(i), color=VkKeyboardColor.PRIMARY)
+            keyboard.add_button(str(i), color=VkKeyboardColor.PRIMARY,
+                                payload=make_payload("photo_choice", photo=i))
         keyboard.add_line()
-        keyboard.add_button('Отмена', color=VkKeyboardColor.NEGATIVE)
+        keyboard.add_button('Отмена', color=VkKeyboardColor.NEGATIVE,
+                            payload=make_payload("cancel"))
         return keyboard
 
+    @staticmethod
+    def create_favorites_page_keyboard(after: Optional[List] = None, page: int = 1):
+        # Клавиатура списка избранного: следующая страница (курсор в payload) и меню
+        keyboard = VkKeyboard(one_time=False)
+        if after:
+            keyboard.add_button('Еще избранные ▶', color=VkKeyboardColor.PRIMARY,
+                                payload=make_payload("favorites", after=after, page=page + 1))
+            keyboard.add_line()
+        keyboard.add_button('Поиск', color=VkKeyboardColor.PRIMARY,
+                            payload=make_payload("search"))
+        keyboard.add_button('🏠 В меню', color=VkKeyboardColor.SECONDARY,
+                            payload=make_payload("menu"))
+        return keyboard
+
+    # ==================== Сериализованные клавиатуры ====================
+    # VK принимает клавиатуру строкой JSON - кодируем один раз и переиспользуем
+
+    @staticmethod
+    def serialize_static_keyboards() -> Dict[str, str]:
+        # Статические клавиатуры, сериализованные при запуске
+        return {
+            'main': VkBotKeyboards.create_main_keyboard().get_keyboard(),
+            'welcome': VkBotKeyboards.create_welcome_keyboard().get_keyboard(),
+            'search': VkBotKeyboards.create_search_keyboard().get_keyboard(),
+            'viewing': VkBotKeyboards.viewing_keyboard_json(),
+            'settings': VkBotKeyboards.create_settings_keyboard().get_keyboard(),
+            'photo_choice': VkBotKeyboards.photo_choice_keyboard_json()
+        }
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def viewing_keyboard_json(profile_id: Optional[int] = None) -> str:
+        # Клавиатура просмотра для анкеты (мемоизируется по id анкеты)
+        return VkBotKeyboards.create_viewing_keyboard(profile_id).get_keyboard()
+
+    @staticmethod
+    @lru_cache(maxsize=1)
+    def photo_choice_keyboard_json() -> str:
+        # Клавиатура выбора из трех фото
+        return VkBotKeyboards.create_photo_choice_keyboard().get_keyboard()
+
+    @staticmethod
+    @lru_cache(maxsize=8)
+    def photo_selection_keyboard_json(photo_count: int) -> str:
+        # Клавиатура выбора фото (мемоизируется по числу фото)
+        return VkBotKeyboards.create_photo_selection_keyboard(photo_count).get_keyboard()
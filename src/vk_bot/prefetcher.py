@@ -0,0 +1,62 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, CancelledError
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CandidatePrefetcher:
+    """Фоновая подготовка следующей анкеты
+
+    Пока пользователь смотрит анкету N, в фоне готовится анкета N+1:
+    профиль, фотографии, строка вложений и текст сообщения.
+    """
+
+    def __init__(self, render: Callable[[int], Optional[Dict]], max_workers: int = 4):
+        self._render = render
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+
+    def schedule(self, user_id: int) -> None:
+        # Запуск подготовки следующей анкеты
+        with self._lock:
+            previous = self._pending.pop(user_id, None)
+            if previous:
+                previous.cancel()
+            self._pending[user_id] = self._executor.submit(self._run, user_id)
+
+    def take(self, user_id: int) -> Optional[Dict]:
+        # Забрать подготовленную анкету (дожидается незавершенной подготовки)
+        with self._lock:
+            future = self._pending.pop(user_id, None)
+
+        if future is None:
+            return None
+
+        try:
+            return future.result()
+        except CancelledError:
+            return None
+
+    def cancel(self, user_id: int) -> None:
+        # Отмена подготовки, например после изменения настроек поиска
+        with self._lock:
+            future = self._pending.pop(user_id, None)
+        if future:
+            future.cancel()
+            logger.debug(f"Предзагрузка анкеты для пользователя {user_id} отменена")
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._pending.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, user_id: int) -> Optional[Dict]:
+        try:
+            return self._render(user_id)
+        except Exception as e:
+            logger.error(f"Ошибка предзагрузки анкеты для пользователя {user_id}: {e}")
+            return None
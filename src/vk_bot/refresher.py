@@ -0,0 +1,98 @@
+import logging
+import threading
+from typing import Dict, Optional
+from src.config import settings
+from src.database.base import db_manager
+from src.database.crud import (
+    get_stale_profile_vk_ids, mark_profiles_fetched, save_search_results,
+    get_stale_photo_profiles, add_photos_to_profile, delete_profile_photos
+)
+from src.database.freshness import freshness
+from src.database.photo_cache import photo_cache
+from src.vk_bot.vk_searcher import VKSearcher
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileRefresher:
+    """Фоновое обновление устаревших профилей и фото
+
+    Раз в interval секунд запрашивает из VK данные batch_size самых старых
+    устаревших профилей (один запрос users.get) и фото photo_batch профилей
+    с устаревшими фото. Сроки актуальности - в freshness.
+    """
+
+    def __init__(self, vk_searcher: VKSearcher, interval: int = None,
+                 batch_size: int = None, photo_batch: int = None):
+        self.vk_searcher = vk_searcher
+        self.interval = interval or settings.REFRESH_INTERVAL_SEC
+        self.batch_size = min(batch_size or settings.REFRESH_BATCH_SIZE, 1000)
+        self.photo_batch = photo_batch or settings.REFRESH_PHOTO_BATCH
+
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="refresher", daemon=True)
+            self._thread.start()
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+
+    def refresh_profiles(self) -> int:
+        # Обновление одной порции устаревших профилей. Возвращает число обновленных
+        with db_manager.unit_of_work() as session:
+            vk_ids = get_stale_profile_vk_ids(session, freshness.fresh_after('profile'), self.batch_size)
+        if not vk_ids:
+            return 0
+
+        fetched = self.vk_searcher.get_users(vk_ids)
+        if fetched is None:
+            # VK не ответил - порция остается устаревшей до следующего прохода
+            logger.warning(f"Не удалось обновить {len(vk_ids)} профилей: нет ответа VK")
+            return 0
+
+        users, answered_ids = fetched
+        with db_manager.unit_of_work() as session:
+            save_search_results(session, users)
+            # Свежими считаются только профили, по которым VK ответил
+            # (в том числе закрытые и удаленные)
+            mark_profiles_fetched(session, answered_ids)
+        return len(users)
+
+    def refresh_photos(self) -> int:
+        # Обновление фото одной порции профилей. Возвращает число обработанных профилей
+        with db_manager.unit_of_work() as session:
+            stale = get_stale_photo_profiles(session, freshness.fresh_after('photos'), self.photo_batch)
+
+        for profile_id, vk_id in stale:
+            if self._stopped.is_set():
+                break
+            photos = self.vk_searcher.get_user_photos(vk_id, include_tagged=True)
+            if photos is None:
+                # Ошибка запроса - сохраненные фото не трогаем
+                continue
+            with db_manager.unit_of_work() as session:
+                if photos:
+                    add_photos_to_profile(session, profile_id, photos)
+                else:
+                    # Фото больше недоступны - при показе анкеты запросим их заново
+                    delete_profile_photos(session, profile_id)
+            photo_cache.put(vk_id, photos)
+        return len(stale)
+
+    def refresh(self) -> Dict[str, int]:
+        return {
+            'profiles': self.refresh_profiles(),
+            'photos': self.refresh_photos()
+        }
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            try:
+                refreshed = self.refresh()
+                if any(refreshed.values()):
+                    logger.info(f"Обновлены устаревшие данные из VK: {refreshed}")
+            except Exception as e:
+                logger.error(f"Ошибка обновления данных из VK: {e}", exc_info=True)
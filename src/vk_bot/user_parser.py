@@ -0,0 +1,103 @@
+import json
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional
+from src.database.birth_dates import parse_bdate, age_on
+
+try:
+    import orjson
+except ImportError:  # Необязательно: без orjson ответы VK разбирает стандартный json
+    orjson = None
+
+
+def loads(content: bytes) -> Any:
+    # Разбор JSON ответа VK (orjson, если установлен)
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+class VKUser:
+    """Пользователь VK из ответа users.search / users.get / groups.getMembers
+
+    Компактная запись (__slots__) с полями строки profiles - передается
+    в crud.save_search_results без промежуточных словарей. Поддерживает
+    чтение как словаря (user['vk_id'], user.get('city')).
+    """
+
+    __slots__ = ('vk_id', 'first_name', 'last_name', 'profile_url', 'age', 'birth_date',
+                 'birth_year_missing', 'sex', 'city', 'photo_url', 'interests')
+
+    def __init__(self, vk_id: int, first_name: str = '', last_name: str = '',
+                 profile_url: Optional[str] = None, age: Optional[int] = None,
+                 birth_date: Optional[date] = None, birth_year_missing: bool = False,
+                 sex: int = 0, city: Optional[str] = None, photo_url: Optional[str] = None,
+                 interests: Optional[List[str]] = None):
+        self.vk_id = vk_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.profile_url = profile_url
+        self.age = age
+        self.birth_date = birth_date
+        self.birth_year_missing = birth_year_missing
+        self.sex = sex
+        self.city = city
+        self.photo_url = photo_url
+        self.interests = interests
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return getattr(self, key, default)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"VKUser({self.vk_id}, {self.first_name} {self.last_name})"
+
+
+def parse_users(items: Iterable[Dict], today: Optional[date] = None,
+                skip_closed: bool = True) -> List[VKUser]:
+    # Пользователи из ответа VK. Возраст считается на одну дату today для всего ответа,
+    # одинаковые строки дат рождения разбираются один раз
+    today = today or date.today()
+    bdates: Dict[Optional[str], tuple] = {None: (None, False, None)}
+    users = []
+    append = users.append
+
+    for item in items:
+        get = item.get
+        if skip_closed and get('is_closed') or get('deactivated'):
+            continue
+
+        bdate = get('bdate')
+        parsed = bdates.get(bdate)
+        if parsed is None:
+            birth_date, year_missing = parse_bdate(bdate)
+            age = age_on(birth_date, today) if birth_date and not year_missing else None
+            parsed = bdates[bdate] = (birth_date, year_missing, age)
+
+        vk_id = item['id']
+        city = get('city')
+        # Позиционные аргументы - в порядке __slots__
+        append(VKUser(
+            vk_id,
+            get('first_name', ''),
+            get('last_name', ''),
+            f"https://vk.com/{get('domain') or f'id{vk_id}'}",
+            parsed[2],
+            parsed[0],
+            parsed[1],
+            get('sex', 0),
+            city.get('title') if city else None,
+            get('photo_max_orig')
+        ))
+
+    return users
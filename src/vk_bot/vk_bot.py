@@ -1,24 +1,40 @@
+import json
 import logging
-from typing import Dict, List, Optional, Callable
+import re
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Callable, Tuple, Union
 from vk_api import VkApi
 from vk_api.longpoll import VkLongPoll, VkEventType
 from vk_api.keyboard import VkKeyboard
 from vk_api.utils import get_random_id
 
-from src.database.base import Session
+from sqlalchemy.orm import Session as SASession
+
+from src.database.base import db_manager
 from src.database.crud import (
     get_bot_user_by_vk_id, save_user_from_vk, save_search_results,
-    get_next_search_profile, add_to_favorites, add_to_viewed_profiles,
+    get_next_search_profile, insert_favorite,
     create_or_update_search_preferences, get_search_preferences,
-    add_photos_to_profile, get_favorites, is_in_favorites,
-    is_in_blacklist, add_to_blacklist, get_top_profile_photos,
-    is_photo_liked, remove_photo_like, add_photo_like,
-    get_user_photo_likes
+    add_photos_to_profile, get_favorites_page, count_favorites,
+    insert_blacklist, get_top_profile_photos, remove_photo_like,
+    get_photo_likes_summary, get_last_viewed_profile, get_profile,
+    get_viewed_vk_ids, search_criteria_hash, get_search_cursor, save_search_cursor,
+    count_search_candidates, get_fresh_profile_photos
 )
+from src.database.freshness import freshness
+from src.database.photo_cache import photo_cache
+from src.database.seen_filter import seen_filters
 from src.vk_bot.keyboards import VkBotKeyboards
 from src.database.statemanager import StateManager
 from src.vk_bot.vk_searcher import VKSearcher
-from src.database.models import Blacklist, ViewedProfiles
+from src.vk_bot.prefetcher import CandidatePrefetcher
+from src.database.write_buffer import WriteBehindBuffer
+from src.vk_bot.history_purger import HistoryPurger
+from src.vk_bot.harvester import ProfileHarvester
+from src.vk_bot.refresher import ProfileRefresher
+from src.config import settings
+from src.database.models import Profile
 
 logger = logging.getLogger(__name__)
 
@@ -42,20 +58,30 @@ class VkBot:
         "city": "город"
     }
 
-    # Команды бота
+    # Команды бота (фразы для свободного текста, без эмодзи)
     COMMANDS = {
         "start": ["/start", "старт", "начать"],
-        "search": ["поиск"],
+        "search": ["поиск", "начать поиск"],
         "favorites": ["избранное"],
-        "settings": ["настройки"],
+        "settings": ["настройки", "мои настройки"],
         "help": ["помощь"],
-        "next": ["➡️ далее", "далее", "next"],
-        "like": ["❤️ в избранное", "в избранное", "избранное"],
+        "next": ["далее", "next"],
+        "like": ["в избранное"],
+        "photo_like": ["лайк фото"],
         "my_likes": ["мои лайки", "лайки"],
-        "dislike": ["👎 в черный список", "не нравится", "в черный список", "черный список"],
-        "menu": ["🔙 в меню", "в меню", "меню", "🏠 в меню"],
-        "back": ["назад"]
+        "dislike": ["не нравится", "в черный список", "черный список"],
+        "menu": ["в меню", "меню"],
+        "back": ["назад"],
+        "change_age": ["изменить возраст"],
+        "change_city": ["изменить город"],
+        "change_sex": ["изменить пол"],
+        "clear_history": ["очистить историю", "сбросить поиск"]
     }
+    COMMAND_BY_PHRASE = {phrase: command for command, phrases in COMMANDS.items() for phrase in phrases}
+    # Эмодзи и пробелы в начале текста кнопки
+    COMMAND_PREFIX_RE = re.compile(r"^[^\w/]+")
+    # Анкет на странице избранного
+    FAVORITES_PAGE_SIZE = 10
 
     def __init__(self, group_token: str, user_token: str) -> None:
         """Инициализация бота"""
@@ -66,17 +92,21 @@ class VkBot:
         self.vk = self.vk_session.get_api()
         self.vk_searcher = VKSearcher(user_token)
 
-        # Инициализация клавиатур
-        self.keyboards = {
-            'main': VkBotKeyboards.create_main_keyboard(),
-            'welcome': VkBotKeyboards.create_welcome_keyboard(),
-            'search': VkBotKeyboards.create_search_keyboard(),
-            'viewing': VkBotKeyboards.create_viewing_keyboard(),
-            'settings': VkBotKeyboards.create_settings_keyboard()
-        }
+        # Инициализация клавиатур (сразу в виде готового JSON)
+        self.keyboards = VkBotKeyboards.serialize_static_keyboards()
 
         self.state_manager = StateManager()
         self.state_handlers = self._collect_state_handlers()
+        self.command_handlers = self._collect_command_handlers()
+        self.prefetcher = CandidatePrefetcher(self._render_next_candidate)
+        # Просмотры и лайки пишутся в БД пачками в фоне
+        self.write_buffer = WriteBehindBuffer()
+        self.history_purger = HistoryPurger()
+        # Пополнение анкет для популярных критериев в непиковые часы
+        self.harvester = ProfileHarvester(self.vk_searcher) if settings.HARVEST_ENABLED else None
+        # Обновление устаревших профилей и фото
+        self.refresher = ProfileRefresher(self.vk_searcher) if settings.REFRESH_ENABLED else None
+        self._stats_logged_at = time.monotonic()
 
         # Тест соединения
         self._test_connection()
@@ -127,9 +157,12 @@ class VkBot:
         logger.info("=== ТЕСТ ПОДКЛЮЧЕНИЯ ЗАВЕРШЕН ===")
 
     def send_message(self, user_id: int, message: str,
-                     keyboard: Optional[VkKeyboard] = None,
+                     keyboard: Optional[Union[str, VkKeyboard]] = None,
                      attachment: Optional[str] = None) -> None:
-        """Отправка сообщения пользователю"""
+        """Отправка сообщения пользователю
+
+        keyboard - готовый JSON клавиатуры (из кэша VkBotKeyboards) или VkKeyboard.
+        """
         params = {
             "user_id": user_id,
             "message": message,
@@ -137,7 +170,7 @@ class VkBot:
         }
 
         if keyboard:
-            params["keyboard"] = keyboard.get_keyboard()
+            params["keyboard"] = keyboard if isinstance(keyboard, str) else keyboard.get_keyboard()
         if attachment:
             params["attachment"] = attachment
 
@@ -190,75 +223,130 @@ class VkBot:
 
         return parts
 
-    def handle_start_command(self, user_id: int, from_button: bool = False) -> None:
+    def _build_candidate(self, bot_user_id: int, profile: Profile, photos: List[Dict]) -> Dict:
+        """Указатель на показанную анкету: профиль и его топ-фото"""
+        return {
+            'bot_user_id': bot_user_id,
+            'profile_id': profile.id,
+            'vk_id': profile.vk_id,
+            'first_name': profile.first_name,
+            'last_name': profile.last_name,
+            'photos': self._build_candidate_photos(photos)
+        }
+
+    def _build_candidate_photos(self, photos: List[Dict]) -> List[Dict]:
+        """Топ-фото анкеты, доступные для лайка"""
+        return [{'url': photo['url'], 'likes': photo.get('likes', 0)}
+                for photo in photos[:3]]
+
+    def _get_current_candidate(self, session: SASession, user_id: int, profile_id: Optional[int] = None) -> Optional[Dict]:
+        """Текущая анкета пользователя (кэш в памяти, иначе id из данных состояния)
+
+        profile_id из payload кнопки позволяет действовать над анкетой
+        из более раннего сообщения.
+        """
+        candidate = self.state_manager.get_candidate(user_id)
+        if candidate and (profile_id is None or candidate['profile_id'] == profile_id):
+            return candidate
+
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            return None
+
+        remember = profile_id is None
+        if profile_id is None:
+            profile_id = self.state_manager.get_candidate_id(session, user_id)
+        if profile_id is not None:
+            profile = get_profile(session, profile_id)
+        else:
+            # Состояние сохранено до появления candidate_id - последний просмотр,
+            # который может быть еще в буфере отложенной записи
+            if self.write_buffer.pending_views(user.id):
+                self.write_buffer.flush()
+            profile = get_last_viewed_profile(session, user.id)
+        if not profile:
+            return None
+
+        photos = [{'url': photo.photo_url, 'likes': photo.likes_count}
+                  for photo in get_top_profile_photos(session, profile.id)]
+        candidate = self._build_candidate(user.id, profile, photos)
+
+        if remember:
+            self.state_manager.set_candidate(session, user_id, candidate)
+        return candidate
+
+    def _viewing_keyboard(self, user_id: int) -> str:
+        """Клавиатура просмотра для текущей анкеты пользователя"""
+        candidate = self.state_manager.get_candidate(user_id)
+        return VkBotKeyboards.viewing_keyboard_json(candidate['profile_id'] if candidate else None)
+
+    def handle_start_command(self, session: SASession, user_id: int, from_button: bool = False) -> None:
         """Обработка команды /start"""
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
+        user = get_bot_user_by_vk_id(session, user_id)
 
-            if user is not None:
-                # Пользователь уже существует
-                if from_button:
-                    message = "✅ Вы уже зарегистрированы! Вот ваш профиль:"
-                else:
-                    message = "👋 С возвращением!"
+        if user is not None:
+            # Пользователь уже существует
+            if from_button:
+                message = "✅ Вы уже зарегистрированы! Вот ваш профиль:"
+            else:
+                message = "👋 С возвращением!"
 
-                self.show_user_profile(user_id)
-                self.send_message(user_id, message,
-                                  keyboard=self.keyboards['main'])
+            self.show_user_profile(session, user_id)
+            self.send_message(user_id, message,
+                              keyboard=self.keyboards['main'])
+        else:
+            # Новый пользователь
+            if from_button:
+                # Начинаем процесс регистрации
+                self.state_manager.set_state(session, user_id, "fill_missing_fields")
+                # Инициализируем данные состояния
+                user_data = {field: None for field in self.FIELD_NAMES_RU.keys()}
+                self.state_manager.set_data(session, user_id, **user_data)
+                # Запрашиваем первое поле
+                self._ask_next_field(session, user_id, user_data)
             else:
-                # Новый пользователь
-                if from_button:
-                    # Начинаем процесс регистрации
-                    self.state_manager.set_state(user_id, "fill_missing_fields")
-                    # Инициализируем данные состояния
-                    user_data = {field: None for field in self.FIELD_NAMES_RU.keys()}
-                    self.state_manager.set_data(user_id, **user_data)
-                    # Запрашиваем первое поле
-                    self._ask_next_field(user_id, user_data)
-                else:
-                    # Показываем приветственное сообщение
-                    welcome_message = (
-                        "👋 Привет! Я бот для знакомств VKinder.\n\n"
-                        "Я помогу вам найти интересных людей для общения.\n\n"
-                        "Для начала работы нажмите кнопку 'Старт' ниже 👇"
-                    )
-                    self.send_message(user_id, welcome_message,
-                                      keyboard=self.keyboards['welcome'])
+                # Показываем приветственное сообщение
+                welcome_message = (
+                    "👋 Привет! Я бот для знакомств VKinder.\n\n"
+                    "Я помогу вам найти интересных людей для общения.\n\n"
+                    "Для начала работы нажмите кнопку 'Старт' ниже 👇"
+                )
+                self.send_message(user_id, welcome_message,
+                                  keyboard=self.keyboards['welcome'])
 
-    def show_user_profile(self, user_id: int) -> None:
+    def show_user_profile(self, session: SASession, user_id: int) -> None:
         """Показ профиля пользователя"""
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                # Если пользователь не найден, предлагаем зарегистрироваться
-                self.send_message(user_id,
-                                  "Вы еще не зарегистрированы!\n"
-                                  "Нажмите 'Старт' для начала работы.",
-                                  keyboard=self.keyboards['welcome'])
-                return
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            # Если пользователь не найден, предлагаем зарегистрироваться
+            self.send_message(user_id,
+                              "Вы еще не зарегистрированы!\n"
+                              "Нажмите 'Старт' для начала работы.",
+                              keyboard=self.keyboards['welcome'])
+            return
 
-            sex_display = self._format_sex(user.sex)
-            vk_link = f"https://vk.com/id{user.vk_id}"
+        sex_display = self._format_sex(user.sex)
+        vk_link = f"https://vk.com/id{user.vk_id}"
 
-            message = (
-                f"👤 Ваш профиль:\n"
-                f"Имя: {user.first_name or 'Не указано'} {user.last_name or 'Не указано'}\n"
-                f"Ссылка: {vk_link}\n"
-                f"Возраст: {user.age or 'Не указано'}\n"
-                f"Пол: {sex_display}\n"
-                f"Город: {user.city or 'Не указано'}\n"
-            )
+        message = (
+            f"👤 Ваш профиль:\n"
+            f"Имя: {user.first_name or 'Не указано'} {user.last_name or 'Не указано'}\n"
+            f"Ссылка: {vk_link}\n"
+            f"Возраст: {user.age or 'Не указано'}\n"
+            f"Пол: {sex_display}\n"
+            f"Город: {user.city or 'Не указано'}\n"
+        )
 
-            self.send_message(user_id, message, keyboard=self.keyboards['main'])
+        self.send_message(user_id, message, keyboard=self.keyboards['main'])
 
     @state_handler("fill_missing_fields")
-    def handle_fill_missing_fields(self, user_id: int, text: str) -> None:
+    def handle_fill_missing_fields(self, session: SASession, user_id: int, text: str) -> None:
         """Заполнение недостающих полей профиля"""
-        user_data = self.state_manager.get_data(user_id) or {}
+        user_data = self.state_manager.get_data(session, user_id) or {}
 
         if not user_data:
             user_data = {field: None for field in self.FIELD_NAMES_RU.keys()}
-            self.state_manager.set_data(user_id, **user_data)
+            self.state_manager.set_data(session, user_id, **user_data)
 
         # Определяем текущее поле для заполнения
         current_field = None
@@ -269,7 +357,7 @@ class VkBot:
 
         if current_field is None:
             # Все поля заполнены
-            self._save_user_profile(user_id, user_data)
+            self._save_user_profile(session, user_id, user_data)
             return
 
         # Обработка ввода
@@ -303,10 +391,10 @@ class VkBot:
             user_data[current_field] = text
 
         # Сохраняем данные
-        self.state_manager.set_data(user_id, **user_data)
+        self.state_manager.set_data(session, user_id, **user_data)
 
         # Запрашиваем следующее поле
-        self._ask_next_field(user_id, user_data)
+        self._ask_next_field(session, user_id, user_data)
 
     def _parse_sex_input(self, text: str) -> Optional[int]:
         """Парсинг ввода пола"""
@@ -317,13 +405,13 @@ class VkBot:
         }
         return sex_mapping.get(text_lower)
 
-    def _ask_next_field(self, user_id: int, user_data: Dict) -> None:
+    def _ask_next_field(self, session: SASession, user_id: int, user_data: Dict) -> None:
         """Запрос следующего поля для заполнения"""
         missing_fields = [f for f in self.FIELD_NAMES_RU.keys()
                           if user_data.get(f) is None]
 
         if not missing_fields:
-            self._save_user_profile(user_id, user_data)
+            self._save_user_profile(session, user_id, user_data)
             return
 
         next_field = missing_fields[0]
@@ -340,18 +428,17 @@ class VkBot:
 
         self.send_message(user_id, prompt)
 
-    def _save_user_profile(self, user_id: int, user_data: Dict) -> None:
+    def _save_user_profile(self, session: SASession, user_id: int, user_data: Dict) -> None:
         """Сохранение профиля пользователя"""
-        with Session() as session:
-            save_user_from_vk(
-                session,
-                vk_id=user_id,
-                first_name=user_data["first_name"],
-                last_name=user_data["last_name"],
-                age=user_data["age"],
-                sex=user_data["sex"],
-                city=user_data["city"]
-            )
+        save_user_from_vk(
+            session,
+            vk_id=user_id,
+            first_name=user_data["first_name"],
+            last_name=user_data["last_name"],
+            age=user_data["age"],
+            sex=user_data["sex"],
+            city=user_data["city"]
+        )
 
         welcome_message = (
             "🎉 Поздравляем! Ваш профиль успешно создан!\n\n"
@@ -362,253 +449,301 @@ class VkBot:
             "• ❓ Помощь - если возникнут вопросы"
         )
 
-        self.show_user_profile(user_id)
-        self.state_manager.clear_state(user_id)
+        self.show_user_profile(session, user_id)
+        self.state_manager.clear_state(session, user_id)
         self.send_message(user_id, welcome_message,
                           keyboard=self.keyboards['main'])
 
-    def show_next_profile(self, user_id: int) -> None:
-        """Показать следующую анкету"""
-        with Session() as session:
-            profile = get_next_search_profile(session, user_id)
+    def _format_profile_message(self, profile: Profile) -> str:
+        """Текст сообщения с анкетой"""
+        sex_display = self._format_sex(profile.sex)
+
+        message = f"👤 {profile.first_name} {profile.last_name}\n"
+        message += f"🔗 Ссылка: {profile.profile_url}\n"
+        if profile.current_age:
+            message += f"📅 Возраст: {profile.current_age} лет\n"
+        message += f"⚧️ Пол: {sex_display}\n"
+        if profile.city:
+            message += f"📍 Город: {profile.city}\n"
+        message += f"\nВыберите действие:"
+        return message
+
+    def _render_next_candidate(self, user_id: int) -> Optional[Dict]:
+        """Подготовка следующей анкеты: профиль, фото, вложения и текст сообщения"""
+        # Выбор анкеты только читает - подойдет реплика
+        with db_manager.read_session(user_id) as session:
+            user = get_bot_user_by_vk_id(session, user_id)
+            if not user:
+                return None
 
+            # Исключаем и просмотры, еще не записанные из буфера
+            profile = get_next_search_profile(session, user_id,
+                                              self.write_buffer.pending_views(user.id))
             if not profile:
-                self.send_message(user_id,
-                                  "Все доступные анкеты просмотрены!\n"
-                                  "Попробуйте:\n"
-                                  "• Изменить параметры поиска в настройках\n"
-                                  "• Начать новый поиск",
-                                  keyboard=self.keyboards['main'])
-                return
+                return None
 
-            sex_display = self._format_sex(profile.sex)
+            candidate = self._build_candidate(user.id, profile, [])
+            message = self._format_profile_message(profile)
 
+            # Фото: кэш в памяти -> недавно загруженные в таблице photos -> VK
+            cached = photo_cache.get(profile.vk_id,
+                                     lambda: self._load_fresh_photos(session, profile.id))
+
+        fetched_photos = []
+        if cached is None:
             # Получаем фотографии через VKSearcher с обработкой ошибок
-            photos = []
             try:
-                photos = self.vk_searcher.get_user_photos(profile.vk_id, include_tagged=True)
+                fetched_photos = self.vk_searcher.get_user_photos(candidate['vk_id'], include_tagged=True)
             except Exception as e:
-                logger.error(f"Ошибка получения фотографий для пользователя {profile.vk_id}: {e}")
-
-            # Сохраняем фото в БД
-            if photos:
-                add_photos_to_profile(session, profile.id, photos)
-
-            # Формируем attachments
-            attachments = []
-            for photo in photos[:3]:  # Берем до 3 фото
-                if 'owner_id' in photo and 'id' in photo:
-                    attachments.append(f"photo{photo['owner_id']}_{photo['id']}")
-
-            # Формируем сообщение
-            message = f"👤 {profile.first_name} {profile.last_name}\n"
-            message += f"🔗 Ссылка: {profile.profile_url}\n"
-            if profile.age:
-                message += f"📅 Возраст: {profile.age} лет\n"
-            message += f"⚧️ Пол: {sex_display}\n"
-            if profile.city:
-                message += f"📍 Город: {profile.city}\n"
-            message += f"\nВыберите действие:"
-
-            if attachments:
-                attachment_str = ','.join(attachments)
-                self.send_message(user_id, message,
-                                  keyboard=self.keyboards['viewing'],
-                                  attachment=attachment_str)
+                logger.error(f"Ошибка получения фотографий для пользователя {candidate['vk_id']}: {e}")
+                fetched_photos = None
+            if fetched_photos is None:
+                # VK не ответил - показываем анкету без фото, но не кэшируем это
+                fetched_photos = []
+                cached = {'photos': [], 'attachment': None}
             else:
-                message += "\nФотографии отсутствуют"
-                self.send_message(user_id, message,
-                                  keyboard=self.keyboards['viewing'])
+                cached = photo_cache.put(candidate['vk_id'], fetched_photos)
+
+        photos = cached['photos']
+        if not cached['attachment']:
+            message += "\nФотографии отсутствуют"
+
+        candidate['photos'] = self._build_candidate_photos(photos)
+        return {
+            'candidate': candidate,
+            # Фото из VK, которые нужно сохранить в БД
+            'photos': fetched_photos,
+            'attachment': cached['attachment'],
+            'message': message
+        }
 
-            # Добавляем в просмотренные
-            user = get_bot_user_by_vk_id(session, user_id)
-            if user:
-                add_to_viewed_profiles(session, user.id, profile.id)
+    def _load_fresh_photos(self, session: SASession, profile_id: int) -> Optional[Tuple[List[Dict], datetime]]:
+        """Недавно загруженные из VK фото анкеты из БД и время их загрузки"""
+        rows = get_fresh_profile_photos(session, profile_id, freshness.fresh_after('photos'))
+        if not rows:
+            return None
+        photos = [{'url': photo.photo_url, 'likes': photo.likes_count,
+                   'owner_id': photo.owner_id, 'id': photo.vk_photo_id}
+                  for photo in rows]
+        return photos, rows[0].fetched_at
+
+    def show_next_profile(self, session: SASession, user_id: int) -> None:
+        """Показать следующую анкету"""
+        # Анкета обычно уже подготовлена в фоне, пока пользователь смотрел предыдущую.
+        # Иначе готовим ее сейчас, не удерживая соединение на время запросов к VK
+        rendered = self.prefetcher.take(user_id)
+        if not rendered:
+            db_manager.release(session)
+            rendered = self._render_next_candidate(user_id)
+
+        if not rendered:
+            self.state_manager.clear_candidate(session, user_id)
+            self.send_message(user_id,
+                              "Все доступные анкеты просмотрены!\n"
+                              "Попробуйте:\n"
+                              "• Изменить параметры поиска в настройках\n"
+                              "• Начать новый поиск",
+                              keyboard=self.keyboards['main'])
+            return
 
-    def show_favorites(self, user_id: int) -> None:
-        """Показать избранные анкеты"""
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                self.send_message(user_id, "Сначала заполните профиль!",
-                                  keyboard=self.keyboards['main'])
-                return
+        candidate = rendered['candidate']
+        self.send_message(user_id, rendered['message'],
+                          keyboard=VkBotKeyboards.viewing_keyboard_json(candidate['profile_id']),
+                          attachment=rendered['attachment'])
+
+        # Сохраняем фото в БД
+        if rendered['photos']:
+            add_photos_to_profile(session, candidate['profile_id'], rendered['photos'])
+
+        # Добавляем в просмотренные (отложенная запись; предзагрузка учитывает
+        # буфер и не выберет эту же анкету)
+        self.write_buffer.add_view(candidate['bot_user_id'], candidate['profile_id'])
+        seen_filters.add(candidate['bot_user_id'], candidate['vk_id'])
+
+        # Запоминаем текущую анкету и готовим следующую
+        self.state_manager.set_candidate(session, user_id, candidate)
+        db_manager.release(session)
+        self.prefetcher.schedule(user_id)
+
+    def show_favorites(self, session: SASession, user_id: int, payload: Optional[Dict] = None) -> None:
+        """Показать страницу избранных анкет"""
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            self.send_message(user_id, "Сначала заполните профиль!",
+                              keyboard=self.keyboards['main'])
+            return
 
-            favorites = get_favorites(session, user.id)
-            if not favorites:
-                self.send_message(user_id, "У вас пока нет избранных анкет.",
-                                  keyboard=self.keyboards['main'])
-                return
+        # Курсор страницы приходит в payload кнопки "Еще избранные"
+        payload = payload or {}
+        after = self._decode_cursor(payload.get("after"))
+        page = payload.get("page", 1) if after else 1
+
+        with db_manager.read_session(user_id, session) as read:
+            favorites, next_cursor = get_favorites_page(read, user.id, self.FAVORITES_PAGE_SIZE, after)
+            total = count_favorites(read, user.id) if page == 1 else None
+        if not favorites:
+            self.send_message(user_id, "У вас пока нет избранных анкет." if page == 1 else
+                              "Больше избранных анкет нет.",
+                              keyboard=self.keyboards['main'])
+            return
 
-            message = f"❤️ Ваши избранные ({len(favorites)} анкет):\n\n"
-            for i, profile in enumerate(favorites, 1):
-                sex_display = self._format_sex(profile.sex)
-                message += f"{i}. {profile.first_name} {profile.last_name}\n"
-                message += f"   {profile.profile_url}\n"
-                if profile.age:
-                    message += f"   📅 Возраст: {profile.age} лет\n"
-                message += f"   ⚧️ Пол: {sex_display}\n"
-                if profile.city:
-                    message += f"   📍 Город: {profile.city}\n"
-                message += "\n"
-
-            # Разбиваем длинное сообщение
-            messages = self._split_long_message(message)
-            for msg_part in messages:
-                self.send_message(user_id, msg_part,
-                                  keyboard=self.keyboards['main'])
+        if total is not None:
+            message = f"❤️ Ваши избранные ({total} анкет):\n\n"
+        else:
+            message = f"❤️ Ваши избранные, страница {page}:\n\n"
+        start = (page - 1) * self.FAVORITES_PAGE_SIZE + 1
+        for i, profile in enumerate(favorites, start):
+            sex_display = self._format_sex(profile.sex)
+            message += f"{i}. {profile.first_name} {profile.last_name}\n"
+            message += f"   {profile.profile_url}\n"
+            if profile.current_age:
+                message += f"   📅 Возраст: {profile.current_age} лет\n"
+            message += f"   ⚧️ Пол: {sex_display}\n"
+            if profile.city:
+                message += f"   📍 Город: {profile.city}\n"
+            message += "\n"
+
+        keyboard = VkBotKeyboards.create_favorites_page_keyboard(
+            self._encode_cursor(next_cursor), page).get_keyboard()
+        self.send_message(user_id, message, keyboard=keyboard)
+
+    @staticmethod
+    def _encode_cursor(cursor: Optional[Tuple[datetime, int]]) -> Optional[List]:
+        """Курсор страницы для payload кнопки"""
+        if cursor is None:
+            return None
+        added_at, entry_id = cursor
+        return [added_at.isoformat() if added_at else None, entry_id]
+
+    @staticmethod
+    def _decode_cursor(raw_cursor) -> Optional[Tuple[datetime, int]]:
+        """Курсор страницы из payload кнопки"""
+        try:
+            added_at, entry_id = raw_cursor
+            return datetime.fromisoformat(added_at), int(entry_id)
+        except (TypeError, ValueError):
+            return None
 
-    def add_to_favorites_handler(self, user_id: int) -> None:
+    def add_to_favorites_handler(self, session: SASession, user_id: int, profile_id: Optional[int] = None) -> None:
         """Добавить текущий профиль в избранное"""
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                self.send_message(user_id, "Ошибка: пользователь не найден",
-                                  keyboard=self.keyboards['main'])
-                return
-
-            # Получаем последний просмотренный профиль
-            last_viewed = session.query(ViewedProfiles).filter(
-                ViewedProfiles.bot_user_id == user.id
-            ).order_by(ViewedProfiles.viewed_at.desc()).first()
-
-            if not last_viewed:
-                self.send_message(user_id, "Нет профиля для добавления в избранное",
-                                  keyboard=self.keyboards['main'])
-                return
+        candidate = self._get_current_candidate(session, user_id, profile_id)
+        if not candidate:
+            self.send_message(user_id, "Нет профиля для добавления в избранное",
+                              keyboard=self.keyboards['main'])
+            return
 
-            profile = last_viewed.profile
+        # Добавляем в избранное (повтор отсекает уникальный индекс)
+        if not insert_favorite(session, candidate['bot_user_id'], candidate['profile_id']):
+            self.send_message(user_id, "Этот профиль уже в избранном!",
+                              keyboard=VkBotKeyboards.viewing_keyboard_json(candidate['profile_id']))
+            return
 
-            # Проверяем, не добавлен ли уже
-            if is_in_favorites(session, user.id, profile.id):
-                self.send_message(user_id, "Этот профиль уже в избранном!",
-                                  keyboard=self.keyboards['viewing'])
-                return
+        self.send_message(user_id,
+                          f"✅ {candidate['first_name']} {candidate['last_name']} добавлен(а) в избранное!",
+                          keyboard=VkBotKeyboards.viewing_keyboard_json(candidate['profile_id']))
 
-            # Добавляем в избранное
-            add_to_favorites(session, user.id, profile.id)
-            self.send_message(user_id,
-                              f"✅ {profile.first_name} {profile.last_name} добавлен(а) в избранное!",
-                              keyboard=self.keyboards['viewing'])
-
-    def add_to_blacklist_handler(self, user_id: int) -> None:
+    def add_to_blacklist_handler(self, session: SASession, user_id: int, profile_id: Optional[int] = None) -> None:
         """Добавить текущий профиль в черный список"""
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                self.send_message(user_id, "Ошибка: пользователь не найден",
-                                  keyboard=self.keyboards['main'])
-                return
-
-            # Получаем последний просмотренный профиль
-            last_viewed = session.query(ViewedProfiles).filter(
-                ViewedProfiles.bot_user_id == user.id
-            ).order_by(ViewedProfiles.viewed_at.desc()).first()
-
-            if not last_viewed:
-                self.send_message(user_id, "Нет профиля для добавления в черный список",
-                                  keyboard=self.keyboards['main'])
-                return
-
-            profile = last_viewed.profile
+        candidate = self._get_current_candidate(session, user_id, profile_id)
+        if not candidate:
+            self.send_message(user_id, "Нет профиля для добавления в черный список",
+                              keyboard=self.keyboards['main'])
+            return
 
-            # Проверяем, не добавлен ли уже
-            if is_in_blacklist(session, user.id, profile.id):
-                self.send_message(user_id, "Этот профиль уже в черном списке!",
-                                  keyboard=self.keyboards['viewing'])
-                return
+        # Добавляем в черный список (повтор отсекает уникальный индекс)
+        if not insert_blacklist(session, candidate['bot_user_id'], candidate['profile_id']):
+            self.send_message(user_id, "Этот профиль уже в черном списке!",
+                              keyboard=VkBotKeyboards.viewing_keyboard_json(candidate['profile_id']))
+            return
 
-            # Добавляем в черный список
-            add_to_blacklist(session, user.id, profile.id)
-            self.send_message(user_id,
-                              f"👎 {profile.first_name} {profile.last_name} добавлен(а) в черный список!",
-                              keyboard=self.keyboards['viewing'])
+        self.send_message(user_id,
+                          f"👎 {candidate['first_name']} {candidate['last_name']} добавлен(а) в черный список!",
+                          keyboard=VkBotKeyboards.viewing_keyboard_json(candidate['profile_id']))
 
             
 
-    def handle_settings(self, user_id: int, text: str = "") -> None:
+    def handle_settings(self, session: SASession, user_id: int, text: str = "") -> None:
         # Настройки поиска
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                self.send_message(user_id, "Сначала заполните профиль!",
-                                  keyboard=self.keyboards['main'])
-                return
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            self.send_message(user_id, "Сначала заполните профиль!",
+                              keyboard=self.keyboards['main'])
+            return
 
-            text_lower = text.lower()
-
-            if text_lower == "настройки":
-                # Показываем текущие настройки
-                prefs = get_search_preferences(session, user.id)
-                if prefs:
-                    city_display = prefs.search_city if prefs.search_city else (user.city if user.city else 'не установлен')
-                    sex_display = self._format_sex(prefs.search_sex) if prefs.search_sex is not None else 'любой'
-                    min_age_display = prefs.search_age_min if prefs.search_age_min else '18 (по умолчанию)'
-                    max_age_display = prefs.search_age_max if prefs.search_age_max else '45 (по умолчанию)'
-
-                    message = (
-                        "⚙️ Ваши текущие настройки поиска:\n\n"
-                        f"• Минимальный возраст: {min_age_display}\n"
-                        f"• Максимальный возраст: {max_age_display}\n"
-                        f"• Город: {city_display}\n"
-                        f"• Пол: {sex_display}\n\n"
-                        "Используйте кнопки ниже для изменения настроек:"
-                    )
-                else:
-                    message = (
-                        "⚙️ Настройки поиска не установлены.\n\n"
-                        f"Текущие значения по умолчанию:\n"
-                        f"• Возраст: 18-45 лет\n"
-                        f"• Город: {user.city if user.city else 'не установлен'}\n"
-                        f"• Пол: любой\n\n"
-                        "Используйте кнопки ниже для установки настроек:"
-                    )
-                self.send_message(user_id, message,
-                                  keyboard=self.keyboards['settings'])
-                self.state_manager.set_state(user_id, "settings")
-                return
+        text_lower = text.lower()
 
-            # Обработка кнопок изменения настроек
-            if text_lower == "изменить возраст":
-                self.send_message(user_id,
-                                  "Введите возраст в формате 'от-до', например: 25-35")
-                self.state_manager.set_state(user_id, "waiting_for_age")
-                return
+        if text_lower == "настройки":
+            # Показываем текущие настройки
+            prefs = get_search_preferences(session, user.id)
+            if prefs:
+                city_display = prefs.search_city if prefs.search_city else (user.city if user.city else 'не установлен')
+                sex_display = self._format_sex(prefs.search_sex) if prefs.search_sex is not None else 'любой'
+                min_age_display = prefs.search_age_min if prefs.search_age_min else '18 (по умолчанию)'
+                max_age_display = prefs.search_age_max if prefs.search_age_max else '45 (по умолчанию)'
+
+                message = (
+                    "⚙️ Ваши текущие настройки поиска:\n\n"
+                    f"• Минимальный возраст: {min_age_display}\n"
+                    f"• Максимальный возраст: {max_age_display}\n"
+                    f"• Город: {city_display}\n"
+                    f"• Пол: {sex_display}\n\n"
+                    "Используйте кнопки ниже для изменения настроек:"
+                )
+            else:
+                message = (
+                    "⚙️ Настройки поиска не установлены.\n\n"
+                    f"Текущие значения по умолчанию:\n"
+                    f"• Возраст: 18-45 лет\n"
+                    f"• Город: {user.city if user.city else 'не установлен'}\n"
+                    f"• Пол: любой\n\n"
+                    "Используйте кнопки ниже для установки настроек:"
+                )
+            self.send_message(user_id, message,
+                              keyboard=self.keyboards['settings'])
+            self.state_manager.set_state(session, user_id, "settings")
+            return
 
-            if text_lower == "изменить город":
-                self.send_message(user_id,
-                                  "Введите название города для поиска:")
-                self.state_manager.set_state(user_id, "waiting_for_city")
-                return
+        # Обработка кнопок изменения настроек
+        if text_lower == "изменить возраст":
+            self.send_message(user_id,
+                              "Введите возраст в формате 'от-до', например: 25-35")
+            self.state_manager.set_state(session, user_id, "waiting_for_age")
+            return
 
-            if text_lower == "изменить пол":
-                self.send_message(user_id,
-                                  "Введите пол для поиска:\n• мужской\n• женский\n• любой")
-                self.state_manager.set_state(user_id, "waiting_for_sex")
-                return
+        if text_lower == "изменить город":
+            self.send_message(user_id,
+                              "Введите название города для поиска:")
+            self.state_manager.set_state(session, user_id, "waiting_for_city")
+            return
 
-            if text_lower == "назад":
-                self.send_message(user_id, "Возвращаемся в главное меню",
-                                  keyboard=self.keyboards['main'])
-                self.state_manager.clear_state(user_id)
-                return
+        if text_lower == "изменить пол":
+            self.send_message(user_id,
+                              "Введите пол для поиска:\n• мужской\n• женский\n• любой")
+            self.state_manager.set_state(session, user_id, "waiting_for_sex")
+            return
 
-            if text_lower in ["очистить историю", "сбросить поиск"]:
-                self.clear_search_history(user_id)
-                return
+        if text_lower == "назад":
+            self.send_message(user_id, "Возвращаемся в главное меню",
+                              keyboard=self.keyboards['main'])
+            self.state_manager.clear_state(session, user_id)
+            return
+
+        if text_lower in ["очистить историю", "сбросить поиск"]:
+            self.clear_search_history(session, user_id)
+            return
 
-            # Если команда не распознана, показываем настройки снова
-            self.handle_settings(user_id, "настройки")
+        # Если команда не распознана, показываем настройки снова
+        self.handle_settings(session, user_id, "настройки")
 
     @state_handler("waiting_for_age")
-    def handle_age_input(self, user_id: int, text: str) -> None:
+    def handle_age_input(self, session: SASession, user_id: int, text: str) -> None:
         # Обработка ввода возраста
         text_lower = text.lower()
 
         if text_lower in ["назад", "отмена"]:
             self.send_message(user_id, "Отмена изменения возраста",
                               keyboard=self.keyboards['settings'])
-            self.state_manager.set_state(user_id, "settings")
+            self.state_manager.set_state(session, user_id, "settings")
             return
 
         try:
@@ -642,23 +777,23 @@ class VkBot:
                     )
                     return
 
-                with Session() as session:
-                    user = get_bot_user_by_vk_id(session, user_id)
-                    if user:
-                        create_or_update_search_preferences(
-                            session,
-                            user.id,
-                            search_age_min=min_age,
-                            search_age_max=max_age
-                        )
-                        self.send_message(user_id,
-                                          f"✅ Возраст поиска установлен: {min_age}-{max_age} лет",
-                                          keyboard=self.keyboards['settings'])
-                        self.state_manager.set_state(user_id, "settings")
-                    else:
-                        self.send_message(user_id, "❌ Пользователь не найден",
-                                          keyboard=self.keyboards['main'])
-                        self.state_manager.clear_state(user_id)
+                user = get_bot_user_by_vk_id(session, user_id)
+                if user:
+                    create_or_update_search_preferences(
+                        session,
+                        user.id,
+                        search_age_min=min_age,
+                        search_age_max=max_age
+                    )
+                    self.prefetcher.cancel(user_id)
+                    self.send_message(user_id,
+                                      f"✅ Возраст поиска установлен: {min_age}-{max_age} лет",
+                                      keyboard=self.keyboards['settings'])
+                    self.state_manager.set_state(session, user_id, "settings")
+                else:
+                    self.send_message(user_id, "❌ Пользователь не найден",
+                                      keyboard=self.keyboards['main'])
+                    self.state_manager.clear_state(session, user_id)
             else:
                 self.send_message(
                     user_id,
@@ -675,14 +810,14 @@ class VkBot:
             )
 
     @state_handler("waiting_for_city")
-    def handle_city_input(self, user_id: int, text: str) -> None:
+    def handle_city_input(self, session: SASession, user_id: int, text: str) -> None:
         # Обработка ввода города
         text_lower = text.lower()
 
         if text_lower in ["назад", "отмена"]:
             self.send_message(user_id, "Отмена изменения города",
                               keyboard=self.keyboards['settings'])
-            self.state_manager.set_state(user_id, "settings")
+            self.state_manager.set_state(session, user_id, "settings")
             return
 
         if not text.strip():
@@ -693,27 +828,27 @@ class VkBot:
             return
 
         city = text.strip()
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if user:
-                create_or_update_search_preferences(session, user.id, search_city=city)
-                self.send_message(user_id, f"✅ Город поиска установлен: {city}",
-                                  keyboard=self.keyboards['settings'])
-                self.state_manager.set_state(user_id, "settings")
-            else:
-                self.send_message(user_id, "❌ Пользователь не найден",
-                                  keyboard=self.keyboards['main'])
-                self.state_manager.clear_state(user_id)
+        user = get_bot_user_by_vk_id(session, user_id)
+        if user:
+            create_or_update_search_preferences(session, user.id, search_city=city)
+            self.prefetcher.cancel(user_id)
+            self.send_message(user_id, f"✅ Город поиска установлен: {city}",
+                              keyboard=self.keyboards['settings'])
+            self.state_manager.set_state(session, user_id, "settings")
+        else:
+            self.send_message(user_id, "❌ Пользователь не найден",
+                              keyboard=self.keyboards['main'])
+            self.state_manager.clear_state(session, user_id)
 
     @state_handler("waiting_for_sex")
-    def handle_sex_input(self, user_id: int, text: str) -> None:
+    def handle_sex_input(self, session: SASession, user_id: int, text: str) -> None:
         # Обработка ввода пола
         text_lower = text.lower()
 
         if text_lower in ["назад", "отмена"]:
             self.send_message(user_id, "Отмена изменения пола",
                               keyboard=self.keyboards['settings'])
-            self.state_manager.set_state(user_id, "settings")
+            self.state_manager.set_state(session, user_id, "settings")
             return
 
         sex_mapping = {
@@ -732,417 +867,346 @@ class VkBot:
             )
             return
 
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if user:
-                create_or_update_search_preferences(session, user.id, search_sex=sex_value)
-                sex_display = self._format_sex(sex_value)
-                self.send_message(user_id,
-                                  f"✅ Пол для поиска установлен: {sex_display}",
-                                  keyboard=self.keyboards['settings'])
-                self.state_manager.set_state(user_id, "settings")
-            else:
-                self.send_message(user_id, "❌ Пользователь не найден",
-                                  keyboard=self.keyboards['main'])
-                self.state_manager.clear_state(user_id)
+        user = get_bot_user_by_vk_id(session, user_id)
+        if user:
+            create_or_update_search_preferences(session, user.id, search_sex=sex_value)
+            self.prefetcher.cancel(user_id)
+            sex_display = self._format_sex(sex_value)
+            self.send_message(user_id,
+                              f"✅ Пол для поиска установлен: {sex_display}",
+                              keyboard=self.keyboards['settings'])
+            self.state_manager.set_state(session, user_id, "settings")
+        else:
+            self.send_message(user_id, "❌ Пользователь не найден",
+                              keyboard=self.keyboards['main'])
+            self.state_manager.clear_state(session, user_id)
 
     @state_handler("waiting_for_photo_choice")
-    def handle_photo_choice(self, user_id: int, text: str) -> None:
+    def handle_photo_choice(self, session: SASession, user_id: int, text: str) -> None:
         # Обработка выбора лайка под фото
         text_lower = text.lower().strip()
 
         if text_lower in ["отмена", "назад"]:
             self.send_message(user_id, "Отмена лайка фото",
-                              keyboard=self.keyboards['viewing'])
-            self.state_manager.clear_state(user_id)
+                              keyboard=self._viewing_keyboard(user_id))
+            self.state_manager.clear_state(session, user_id)
             return
 
         try:
             choice = int(text_lower)
-            with Session() as session:
-                user = get_bot_user_by_vk_id(session, user_id)
-                if not user:
-                    self.send_message(user_id, "Пользователь не найден",
-                                      keyboard=self.keyboards['main'])
-                    self.state_manager.clear_state(user_id)
-                    return
+            candidate = self._get_current_candidate(session, user_id)
+            if not candidate:
+                self.send_message(user_id, "Профиль не найден",
+                                  keyboard=self.keyboards['main'])
+                self.state_manager.clear_state(session, user_id)
+                return
 
-                # Получаем последний просмотренный профиль
-                last_viewed = session.query(ViewedProfiles).filter(
-                    ViewedProfiles.bot_user_id == user.id
-                ).order_by(ViewedProfiles.viewed_at.desc()).first()
+            photos = candidate['photos']
+            bot_user_id = candidate['bot_user_id']
 
-                if not last_viewed:
-                    self.send_message(user_id, "Профиль не найден",
-                                      keyboard=self.keyboards['main'])
-                    self.state_manager.clear_state(user_id)
-                    return
+            if 1 <= choice <= len(photos):
+                photo_url = photos[choice - 1]['url']
 
-                profile = last_viewed.profile
-                photos = get_top_profile_photos(session, profile.id)
-
-                if 1 <= choice <= len(photos):
-                    selected_photo = photos[choice - 1]
-
-                    # Проверяем, не лайкнуто ли уже
-                    if is_photo_liked(session, user.id, selected_photo.photo_url):
-                        remove_photo_like(session, user.id, selected_photo.photo_url)
-                        self.send_message(user_id, f"👎 Лайк убран с фотографии",
-                                          keyboard=self.keyboards['viewing'])
-                    else:
-                        add_photo_like(session, user.id, profile.id, selected_photo.photo_url)
-                        self.send_message(user_id, f"❤️ Вы поставили лайк на фотографию!",
-                                          keyboard=self.keyboards['viewing'])
+                # Повторный выбор снимает лайк (еще не записанный или уже в БД),
+                # новый лайк уходит в буфер отложенной записи
+                liked = self.write_buffer.toggle_like(
+                    bot_user_id, candidate['profile_id'], photo_url,
+                    lambda: remove_photo_like(session, bot_user_id, photo_url))
+                if liked:
+                    self.send_message(user_id, f"❤️ Вы поставили лайк на фотографию!",
+                                      keyboard=self._viewing_keyboard(user_id))
                 else:
-                    self.send_message(user_id, f"Неверный номер. Выберите от 1 до {len(photos)}",
-                                      keyboard=self.keyboards['viewing'])
+                    self.send_message(user_id, f"👎 Лайк убран с фотографии",
+                                      keyboard=self._viewing_keyboard(user_id))
+            else:
+                self.send_message(user_id, f"Неверный номер. Выберите от 1 до {len(photos)}",
+                                  keyboard=self._viewing_keyboard(user_id))
 
         except ValueError:
             self.send_message(user_id, "Введите номер фотографии цифрами",
-                              keyboard=self.keyboards['viewing'])
+                              keyboard=self._viewing_keyboard(user_id))
 
-        self.state_manager.clear_state(user_id)
+        self.state_manager.clear_state(session, user_id)
 
-    def start_search(self, user_id: int) -> None:
-        # Поиск
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                self.send_message(user_id,
-                                  "Сначала нужно зарегистрироваться!\n"
-                                  "Нажмите 'Старт' для начала работы.",
-                                  keyboard=self.keyboards['welcome'])
-                return
-
-            # Получаем настройки поиска
-            prefs = get_search_preferences(session, user.id)
+    def start_search(self, session: SASession, user_id: int) -> None:
+        # Поиск: чтение настроек -> запросы к VK -> запись результатов.
+        # Транзакция чтения завершается до сетевых запросов
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            self.send_message(user_id,
+                              "Сначала нужно зарегистрироваться!\n"
+                              "Нажмите 'Старт' для начала работы.",
+                              keyboard=self.keyboards['welcome'])
+            return
 
-            # Используем настройки или данные пользователя по умолчанию
-            search_city = prefs.search_city if prefs and prefs.search_city else user.city or ""
-            search_age_min = prefs.search_age_min if prefs and prefs.search_age_min else 18
-            search_age_max = prefs.search_age_max if prefs and prefs.search_age_max else 45
-            search_sex = prefs.search_sex if prefs and prefs.search_sex is not None else 0
-
-            # Информируем пользователя о параметрах поиска
-            sex_display = self._format_sex(search_sex)
-            city_display = search_city if search_city else "любой"
-
-            info_msg = (
-                f"🔎 Начинаю поиск с параметрами:\n\n"
-                f"📍 Город: {city_display}\n"
-                f"📅 Возраст: {search_age_min}-{search_age_max} лет\n"
-                f"⚧️ Пол: {sex_display}\n\n"
-                f"Поиск может занять несколько секунд..."
-            )
-            self.send_message(user_id, info_msg)
+        # Получаем настройки поиска
+        prefs = get_search_preferences(session, user.id)
+
+        # Используем настройки или данные пользователя по умолчанию
+        search_city = prefs.search_city if prefs and prefs.search_city else user.city or ""
+        search_age_min = prefs.search_age_min if prefs and prefs.search_age_min else 18
+        search_age_max = prefs.search_age_max if prefs and prefs.search_age_max else 45
+        search_sex = prefs.search_sex if prefs and prefs.search_sex is not None else 0
+        user_name = f"{user.first_name} {user.last_name}"
+        bot_user_id = user.id
+
+        # Анкет под настройки в БД достаточно (например, после пополнения) - VK не нужен
+        min_candidates = settings.SEARCH_DB_MIN_CANDIDATES
+        if min_candidates and count_search_candidates(session, bot_user_id, min_candidates) >= min_candidates:
+            logger.info(f"Поиск для {user_name}: в БД не меньше {min_candidates} анкет, без запросов к VK")
+            self.send_message(user_id, "✅ Поиск завершен!\nПоказываю первую...",
+                              keyboard=self.keyboards['viewing'])
+            self.show_next_profile(session, user_id)
+            return
 
-            logger.info("=== НАЧАЛО ПОИСКА ===")
-            logger.info(f"Пользователь: {user.first_name} {user.last_name}")
-            logger.info("Параметры: город='%s', возраст=%s-%s, пол=%s",
-                        search_city, search_age_min, search_age_max, search_sex)
+        # Фильтр просмотренных загружаем, пока соединение еще открыто
+        seen_filters.load(bot_user_id, lambda: get_viewed_vk_ids(session, bot_user_id))
 
-            try:
-                # Используем умный поиск
-                found_users = self.vk_searcher.smart_search_users(
-                    city=search_city,
-                    age_from=search_age_min,
-                    age_to=search_age_max,
-                    sex=search_sex,
-                    target_count=1050
-                )
+        # Поиск продолжается с места остановки прошлого поиска с теми же критериями
+        criteria_hash = search_criteria_hash(search_city, search_age_min, search_age_max, search_sex)
+        search_cursor = get_search_cursor(session, bot_user_id, criteria_hash) or {}
 
-                logger.info(f"Умный поиск нашел {len(found_users)} пользователей")
+        # Соединение не нужно на время запросов к VK
+        db_manager.release(session)
 
-                if not found_users:
-                    # Пробуем альтернативные стратегии
-                    logger.info("Пробуем альтернативные стратегии поиска...")
-
-                    # Стратегия 1: Без города
-                    if search_city:
-                        found_users = self.vk_searcher.smart_search_users(
-                            city="",
-                            age_from=search_age_min,
-                            age_to=search_age_max,
-                            sex=search_sex,
-                            target_count=30
-                        )
-                        logger.info(f"Поиск без города нашел {len(found_users)} пользователей")
-
-                    # Стратегия 2: Расширенный возраст
-                    if not found_users:
-                        found_users = self.vk_searcher.smart_search_users(
-                            city=search_city,
-                            age_from=max(18, search_age_min - 5),
-                            age_to=min(99, search_age_max + 5),
-                            sex=search_sex,
-                            target_count=30
-                        )
-                        logger.info(f"Расширенный возраст нашел {len(found_users)} пользователей")
-
-                    # Стратегия 3: Любой пол
-                    if not found_users and search_sex != 0:
-                        found_users = self.vk_searcher.smart_search_users(
-                            city=search_city,
-                            age_from=search_age_min,
-                            age_to=search_age_max,
-                            sex=0,
-                            target_count=30
-                        )
-                        logger.info(f"Любой пол нашел {len(found_users)} пользователей")
+        # Информируем пользователя о параметрах поиска
+        sex_display = self._format_sex(search_sex)
+        city_display = search_city if search_city else "любой"
 
-                if not found_users:
-                    self.send_message(user_id,
-                                      "❌ Не удалось найти подходящих пользователей.\n\n"
-                                      "Возможные причины:\n"
-                                      "• В выбранном городе мало открытых профилей\n"
-                                      "• Параметры поиска слишком строгие\n"
-                                      "• Проблемы с подключением к VK\n\n"
-                                      "Попробуйте:\n"
-                                      "1. Изменить город в настройках\n"
-                                      "2. Расширить возрастной диапазон\n"
-                                      "3. Попробовать позже",
-                                      keyboard=self.keyboards['main'])
-                    return
+        info_msg = (
+            f"🔎 Начинаю поиск с параметрами:\n\n"
+            f"📍 Город: {city_display}\n"
+            f"📅 Возраст: {search_age_min}-{search_age_max} лет\n"
+            f"⚧️ Пол: {sex_display}\n\n"
+            f"Поиск может занять несколько секунд..."
+        )
+        self.send_message(user_id, info_msg)
 
-                # Сохраняем результаты
-                saved_profiles = save_search_results(session, found_users)
+        logger.info("=== НАЧАЛО ПОИСКА ===")
+        logger.info(f"Пользователь: {user_name}")
+        logger.info("Параметры: город='%s', возраст=%s-%s, пол=%s",
+                    search_city, search_age_min, search_age_max, search_sex)
 
-                if saved_profiles:
-                    success_msg = (
-                        f"✅ Поиск завершен!\n"
-                        f"Найдено анкет: {len(saved_profiles)}\n"
-                        f"Показываю первую..."
+        try:
+            # Используем умный поиск
+            found_users = self.vk_searcher.smart_search_users(
+                city=search_city,
+                age_from=search_age_min,
+                age_to=search_age_max,
+                sex=search_sex,
+                target_count=1050,
+                cursor=search_cursor
+            )
+            if search_cursor:
+                save_search_cursor(session, bot_user_id, criteria_hash, search_cursor)
+
+            logger.info(f"Умный поиск нашел {len(found_users)} пользователей")
+
+            if not found_users:
+                # Пробуем альтернативные стратегии
+                logger.info("Пробуем альтернативные стратегии поиска...")
+
+                # Стратегия 1: Без города
+                if search_city:
+                    found_users = self.vk_searcher.smart_search_users(
+                        city="",
+                        age_from=search_age_min,
+                        age_to=search_age_max,
+                        sex=search_sex,
+                        target_count=30
                     )
-                    self.send_message(user_id, success_msg,
-                                      keyboard=self.keyboards['viewing'])
+                    logger.info(f"Поиск без города нашел {len(found_users)} пользователей")
 
-                    # Показываем первый профиль
-                    self.show_next_profile(user_id)
-                else:
-                    self.send_message(user_id, "Не удалось сохранить результаты поиска",
-                                      keyboard=self.keyboards['main'])
+                # Стратегия 2: Расширенный возраст
+                if not found_users:
+                    found_users = self.vk_searcher.smart_search_users(
+                        city=search_city,
+                        age_from=max(18, search_age_min - 5),
+                        age_to=min(99, search_age_max + 5),
+                        sex=search_sex,
+                        target_count=30
+                    )
+                    logger.info(f"Расширенный возраст нашел {len(found_users)} пользователей")
+
+                # Стратегия 3: Любой пол
+                if not found_users and search_sex != 0:
+                    found_users = self.vk_searcher.smart_search_users(
+                        city=search_city,
+                        age_from=search_age_min,
+                        age_to=search_age_max,
+                        sex=0,
+                        target_count=30
+                    )
+                    logger.info(f"Любой пол нашел {len(found_users)} пользователей")
 
-            except Exception as e:
-                logger.error(f"Ошибка при поиске: {e}", exc_info=True)
+            if not found_users:
                 self.send_message(user_id,
-                                  "⚠️ Произошла ошибка при поиске.\n"
-                                  "Попробуйте изменить параметры или повторить позже.",
+                                  "❌ Не удалось найти подходящих пользователей.\n\n"
+                                  "Возможные причины:\n"
+                                  "• В выбранном городе мало открытых профилей\n"
+                                  "• Параметры поиска слишком строгие\n"
+                                  "• Проблемы с подключением к VK\n\n"
+                                  "Попробуйте:\n"
+                                  "1. Изменить город в настройках\n"
+                                  "2. Расширить возрастной диапазон\n"
+                                  "3. Попробовать позже",
                                   keyboard=self.keyboards['main'])
+                return
 
-    def clear_search_history(self, user_id: int) -> None:
-        # Очистка историю поиска
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if user:
-                # Удаляем записи из черного списка
-                session.query(Blacklist).filter(
-                    Blacklist.bot_user_id == user.id
-                ).delete()
-
-                # Очищаем таблицу viewed_profiles
-                try:
-                    session.query(ViewedProfiles).filter(
-                        ViewedProfiles.bot_user_id == user.id
-                    ).delete()
-                except Exception:
-                    pass
-
-                session.commit()
+            # Уже просмотренных не записываем повторно
+            fresh_users = seen_filters.filter_unseen(
+                bot_user_id, found_users,
+                verify=lambda vk_ids: get_viewed_vk_ids(session, bot_user_id, vk_ids))
 
-                self.send_message(user_id,
-                                  "✅ История поиска очищена!\n"
-                                  "Теперь вы сможете увидеть ранее показанные анкеты снова.",
-                                  keyboard=self.keyboards['main'])
+            # Сохраняем результаты
+            saved_count = len(save_search_results(session, fresh_users))
+
+            if saved_count or len(fresh_users) < len(found_users):
+                success_msg = (
+                    f"✅ Поиск завершен!\n"
+                    f"Найдено анкет: {len(found_users)}, новых: {saved_count}\n"
+                    f"Показываю первую..."
+                )
+                self.send_message(user_id, success_msg,
+                                  keyboard=self.keyboards['viewing'])
+
+                # Показываем первый профиль
+                self.show_next_profile(session, user_id)
             else:
-                self.send_message(user_id, "Пользователь не найден",
+                self.send_message(user_id, "Не удалось сохранить результаты поиска",
                                   keyboard=self.keyboards['main'])
 
-    def show_photo_likes_menu(self, user_id: int):
-        # Показываем меню лайков на фотографиях
-        with Session() as session:
-            user = get_bot_user_by_vk_id(session, user_id)
-            if not user:
-                self.send_message(user_id, "Пользователь не найден",
-                                  keyboard=self.keyboards['main'])
-                return
+        except Exception as e:
+            logger.error(f"Ошибка при поиске: {e}", exc_info=True)
+            self.send_message(user_id,
+                              "⚠️ Произошла ошибка при поиске.\n"
+                              "Попробуйте изменить параметры или повторить позже.",
+                              keyboard=self.keyboards['main'])
 
-            liked_photos = get_user_photo_likes(session, user.id)
+    def clear_search_history(self, session: SASession, user_id: int) -> None:
+        # Очистка истории поиска: порциями в фоне, по завершении - отчет
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            self.send_message(user_id, "Пользователь не найден",
+                              keyboard=self.keyboards['main'])
+            return
 
-            if not liked_photos:
-                message = "У вас пока нет лайков на фотографиях.\n\n"
-                message += "Чтобы поставить лайк:\n"
-                message += "1. Нажмите 'Поиск' для просмотра анкет\n"
-                message += "2. Выберите анкету с фотографиями\n"
-                message += "3. Нажмите '👍 Лайк фото'\n"
-                message += "4. Выберите номер фотографии"
-                self.send_message(user_id, message, keyboard=self.keyboards['main'])
-                return
+        # Сначала отбрасываем незаписанные просмотры из буфера
+        self.write_buffer.discard_views(user.id)
+        self.prefetcher.cancel(user_id)
+
+        started = self.history_purger.start(
+            user_id, user.id,
+            on_progress=lambda removed: self._report_purge_progress(user_id, removed),
+            on_done=lambda removed: self._report_purge_done(user_id, removed),
+            on_error=lambda error: self.send_message(
+                user_id, "⚠️ Не удалось очистить историю поиска. Попробуйте позже.",
+                keyboard=self.keyboards['main'])
+        )
+        if not started:
+            self.send_message(user_id, "⏳ История поиска уже очищается, подождите...",
+                              keyboard=self.keyboards['main'])
 
-            # Группируем лайки по профилю
-            from collections import defaultdict
-            profile_likes = defaultdict(list)
-            for like in liked_photos:
-                profile_likes[like.profile].append(like)
+    def _report_purge_progress(self, user_id: int, removed: int) -> None:
+        """Промежуточный отчет об очистке (для большой истории)"""
+        self.send_message(user_id, f"🧹 Очищаю историю поиска... удалено записей: {removed}")
+
+    def _report_purge_done(self, user_id: int, removed: Dict[str, int]) -> None:
+        """Итог очистки истории"""
+        self.prefetcher.cancel(user_id)
+        self.send_message(user_id,
+                          "✅ История поиска очищена!\n"
+                          f"Удалено из черного списка: {removed['blacklist']}\n"
+                          f"Удалено просмотров: {removed['viewed_profiles']}\n"
+                          "Теперь вы сможете увидеть ранее показанные анкеты снова.",
+                          keyboard=self.keyboards['main'])
+
+    def show_photo_likes_menu(self, session: SASession, user_id: int):
+        # Показываем меню лайков на фотографиях
+        user = get_bot_user_by_vk_id(session, user_id)
+        if not user:
+            self.send_message(user_id, "Пользователь не найден",
+                              keyboard=self.keyboards['main'])
+            return
+
+        # Свои еще не записанные лайки должны попасть в список
+        if self.write_buffer.has_pending_likes(user.id):
+            self.write_buffer.flush()
+
+        # Итог и первые профили с фото считает БД - объем не зависит от числа лайков
+        with db_manager.read_session(user_id, session) as read:
+            total_likes, profile_likes = get_photo_likes_summary(
+                read, user.id, max_profiles=10, photos_per_profile=3)
+
+        if not total_likes:
+            message = "У вас пока нет лайков на фотографиях.\n\n"
+            message += "Чтобы поставить лайк:\n"
+            message += "1. Нажмите 'Поиск' для просмотра анкет\n"
+            message += "2. Выберите анкету с фотографиями\n"
+            message += "3. Нажмите '👍 Лайк фото'\n"
+            message += "4. Выберите номер фотографии"
+            self.send_message(user_id, message, keyboard=self.keyboards['main'])
+            return
 
-            message = f"❤️ Ваши лайки ({len(liked_photos)} фото):\n\n"
+        message = f"❤️ Ваши лайки ({total_likes} фото):\n\n"
 
-            for profile, likes in list(profile_likes.items())[:10]:  # Показываем первые 10 профилей
-                message += f"👤 {profile.first_name} {profile.last_name}:\n"
-                message += f"   🔗 {profile.profile_url}\n"
-                for like in likes[:3]:  # Показываем до 3 фото на профиль
-                    message += f"   📷 Фото: {like.photo_url[:50]}...\n"
-                message += "\n"
+        shown = 0
+        for profile, photo_urls in profile_likes:  # Первые 10 профилей
+            message += f"👤 {profile.first_name} {profile.last_name}:\n"
+            message += f"   🔗 {profile.profile_url}\n"
+            for photo_url in photo_urls:  # До 3 фото на профиль
+                message += f"   📷 Фото: {photo_url[:50]}...\n"
+            message += "\n"
+            shown += len(photo_urls)
 
-            if len(liked_photos) > 30:
-                message += f"... и еще {len(liked_photos) - 30} фото"
+        if total_likes > shown:
+            message += f"... и еще {total_likes - shown} фото"
 
-            # Разбиваем длинное сообщение
-            messages = self._split_long_message(message)
-            for msg_part in messages:
-                self.send_message(user_id, msg_part, keyboard=self.keyboards['main'])
+        # Разбиваем длинное сообщение
+        messages = self._split_long_message(message)
+        for msg_part in messages:
+            self.send_message(user_id, msg_part, keyboard=self.keyboards['main'])
 
-    def handle_message(self, user_id: int, text: str) -> None:
+    def handle_message(self, session: SASession, user_id: int, text: str, payload: Optional[Dict] = None) -> None:
         # Обработка входящих сообщений
         logger.info(f"Новое сообщение от {user_id}: {text}")
 
         try:
             text_lower = text.lower().strip()
 
+            # Команда из payload кнопки, иначе - разбор свободного текста
+            payload = payload or {}
+            command = payload.get("command") or self._match_command(text_lower)
+
             # Обработка команды /start и кнопки Старт
-            if any(cmd in text_lower for cmd in self.COMMANDS["start"]) or text_lower == "старт":
-                self.state_manager.clear_state(user_id)
-                self.handle_start_command(user_id, from_button=(text_lower == "старт"))
+            if command == "start":
+                self.state_manager.clear_state(session, user_id)
+                self.handle_start_command(session, user_id, from_button=("command" in payload or text_lower == "старт"))
                 return
 
             # Проверяем текущее состояние ДО обработки других команд
-            current_state = self.state_manager.get_state(user_id)
+            current_state = self.state_manager.get_state(session, user_id)
 
             # Обработка состояний ДО всех остальных команд
             if current_state in self.state_handlers:
-                self.state_handlers[current_state](user_id, text)
+                self.state_handlers[current_state](session, user_id, text)
                 return
 
             # Проверяем, зарегистрирован ли пользователь
-            with Session() as session:
-                user = get_bot_user_by_vk_id(session, user_id)
-                if not user:
-                    # Если пользователь не зарегистрирован, предлагаем начать
-                    welcome_message = (
-                        "👋 Вы еще не зарегистрированы!\n\n"
-                        "Чтобы начать пользоваться ботом, нажмите кнопку 'Старт' или напишите /start"
-                    )
-                    self.send_message(user_id, welcome_message,
-                                      keyboard=self.keyboards['welcome'])
-                    return
-
-            # Обработка специальных команд (должны быть до общих команд типа "like")
-            if "лайк фото" in text_lower:
-                with Session() as session:
-                    user = get_bot_user_by_vk_id(session, user_id)
-                    if user:
-                        last_viewed = session.query(ViewedProfiles).filter(
-                            ViewedProfiles.bot_user_id == user.id
-                        ).order_by(ViewedProfiles.viewed_at.desc()).first()
-
-                        if last_viewed:
-                            photos = get_top_profile_photos(session, last_viewed.profile_id)
-                            if photos:
-                                message = "Выберите фотографию для лайка:\n\n"
-                                for i, photo in enumerate(photos, 1):
-                                    message += f"{i}. Фото ({photo.likes_count} лайков)\n"
-
-                                self.send_message(user_id, message,
-                                                  keyboard=VkBotKeyboards.create_photo_choice_keyboard())
-                                self.state_manager.set_state(user_id, "waiting_for_photo_choice")
-                                return
-
-                self.send_message(user_id, "Сначала просмотрите профиль с фотографиями")
-                return
-
-            if "мои лайки" in text_lower:
-                self.show_photo_likes_menu(user_id)
-                return
-
-            # Обработка команд главного меню
-            if text_lower == "поиск":
-                self.start_search(user_id)
-                return
-
-            if text_lower == "избранное":
-                self.show_favorites(user_id)
-                return
-
-            if text_lower == "помощь":
-                help_text = (
-                    "🤖 Помощь по командам:\n\n"
-                    "🎯 Основные команды:\n"
-                    "• Старт - Начать работу с ботом\n"
-                    "• Поиск - Начать поиск анкет\n"
-                    "• Избранное - Показать избранные анкеты\n"
-                    "• Настройки - Настройки поиска\n"
-                    "• Помощь - Эта справка\n\n"
-                    "👁️ Во время просмотра:\n"
-                    "• Далее - Следующая анкета\n"
-                    "• В избранное - Добавить в избранное\n"
-                    "• Не нравится - Пропустить анкету\n"
-                    "• В меню - Вернуться в главное меню"
+            user = get_bot_user_by_vk_id(session, user_id)
+            if not user:
+                # Если пользователь не зарегистрирован, предлагаем начать
+                welcome_message = (
+                    "👋 Вы еще не зарегистрированы!\n\n"
+                    "Чтобы начать пользоваться ботом, нажмите кнопку 'Старт' или напишите /start"
                 )
-                self.send_message(user_id, help_text,
-                                  keyboard=self.keyboards['main'])
-                return
-
-            # Обработка команд во время просмотра
-            if any(cmd in text_lower for cmd in self.COMMANDS["next"]):
-                self.show_next_profile(user_id)
-                return
-
-            if any(cmd in text_lower for cmd in self.COMMANDS["like"]):
-                self.add_to_favorites_handler(user_id)
-                return
-
-            if any(cmd in text_lower for cmd in self.COMMANDS["dislike"]):
-                self.add_to_blacklist_handler(user_id)
-                return
-
-            if any(cmd in text_lower for cmd in self.COMMANDS["menu"]):
-                with Session() as session:
-                    user = get_bot_user_by_vk_id(session, user_id)
-                    if user:
-                        self.send_message(user_id, "🏠 Возвращаемся в главное меню",
-                                          keyboard=self.keyboards['main'])
-                    else:
-                        self.send_message(user_id, "🏠 Возвращаемся в начало",
-                                          keyboard=self.keyboards['welcome'])
-                self.state_manager.clear_state(user_id)
-                return
-
-            # Обработка настроек
-            if text_lower == "настройки":
-                self.handle_settings(user_id, "настройки")
-                return
-
-            # Обработка команд из клавиатуры настроек
-            if text_lower == "изменить возраст":
-                self.handle_settings(user_id, "изменить возраст")
-                return
-
-            if text_lower == "изменить город":
-                self.handle_settings(user_id, "изменить город")
-                return
-
-            if text_lower == "изменить пол":
-                self.handle_settings(user_id, "изменить пол")
-                return
-
-            if text_lower == "очистить историю":
-                self.clear_search_history(user_id)
+                self.send_message(user_id, welcome_message,
+                                  keyboard=self.keyboards['welcome'])
                 return
 
-            # Обработка команды "назад"
-            if text_lower == "назад":
-                self.send_message(user_id, "Возвращаемся в главное меню",
-                                  keyboard=self.keyboards['main'])
-                self.state_manager.clear_state(user_id)
+            handler = self.command_handlers.get(command)
+            if handler:
+                handler(session, user_id, payload)
                 return
 
             # Если команда не распознана
@@ -1153,22 +1217,132 @@ class VkBot:
         except Exception as e:
             logger.error(f"Ошибка при обработке сообщения от {user_id}: {e}",
                          exc_info=True)
+            # Изменения, сделанные до ошибки, не фиксируем
+            session.rollback()
             self.send_message(user_id,
                               "⚠️ Произошла ошибка при обработке запроса. Пожалуйста, попробуйте еще раз.",
                               keyboard=self.keyboards['main'])
 
+    def _match_command(self, text_lower: str) -> Optional[str]:
+        """Определение команды по свободному тексту"""
+        phrase = self.COMMAND_PREFIX_RE.sub("", text_lower)
+        return self.COMMAND_BY_PHRASE.get(phrase)
+
+    def _parse_payload(self, raw_payload) -> Optional[Dict]:
+        """Разбор payload кнопки"""
+        if not raw_payload:
+            return None
+        if isinstance(raw_payload, dict):
+            return raw_payload
+        try:
+            payload = json.loads(raw_payload)
+        except (TypeError, ValueError):
+            logger.warning(f"Некорректный payload: {raw_payload}")
+            return None
+        return payload if isinstance(payload, dict) else None
+
+    def _collect_command_handlers(self) -> Dict[str, Callable]:
+        """Таблица обработчиков команд: команда -> обработчик(session, user_id, payload)"""
+        return {
+            "search": lambda session, user_id, payload: self.start_search(session, user_id),
+            "favorites": lambda session, user_id, payload: self.show_favorites(session, user_id, payload),
+            "help": lambda session, user_id, payload: self.show_help(user_id),
+            "next": lambda session, user_id, payload: self.show_next_profile(session, user_id),
+            "like": lambda session, user_id, payload: self.add_to_favorites_handler(
+                session, user_id, payload.get("profile_id")),
+            "dislike": lambda session, user_id, payload: self.add_to_blacklist_handler(
+                session, user_id, payload.get("profile_id")),
+            "photo_like": lambda session, user_id, payload: self.show_photo_choice(
+                session, user_id, payload.get("profile_id")),
+            "my_likes": lambda session, user_id, payload: self.show_photo_likes_menu(session, user_id),
+            "menu": lambda session, user_id, payload: self.return_to_menu(session, user_id, "🏠 Возвращаемся в главное меню"),
+            "back": lambda session, user_id, payload: self.return_to_menu(session, user_id, "Возвращаемся в главное меню"),
+            "settings": lambda session, user_id, payload: self.handle_settings(session, user_id, "настройки"),
+            "change_age": lambda session, user_id, payload: self.handle_settings(session, user_id, "изменить возраст"),
+            "change_city": lambda session, user_id, payload: self.handle_settings(session, user_id, "изменить город"),
+            "change_sex": lambda session, user_id, payload: self.handle_settings(session, user_id, "изменить пол"),
+            "clear_history": lambda session, user_id, payload: self.clear_search_history(session, user_id),
+        }
+
+    def show_photo_choice(self, session: SASession, user_id: int, profile_id: Optional[int] = None) -> None:
+        """Выбор фотографии текущей анкеты для лайка"""
+        candidate = self._get_current_candidate(session, user_id, profile_id)
+        if candidate and candidate['photos']:
+            # Выбор номера фото относится к этой анкете
+            self.state_manager.set_candidate(session, user_id, candidate)
+            message = "Выберите фотографию для лайка:\n\n"
+            for i, photo in enumerate(candidate['photos'], 1):
+                message += f"{i}. Фото ({photo['likes']} лайков)\n"
+
+            self.send_message(user_id, message,
+                              keyboard=self.keyboards['photo_choice'])
+            self.state_manager.set_state(session, user_id, "waiting_for_photo_choice")
+            return
+
+        self.send_message(user_id, "Сначала просмотрите профиль с фотографиями")
+
+    def show_help(self, user_id: int) -> None:
+        """Справка по командам"""
+        help_text = (
+            "🤖 Помощь по командам:\n\n"
+            "🎯 Основные команды:\n"
+            "• Старт - Начать работу с ботом\n"
+            "• Поиск - Начать поиск анкет\n"
+            "• Избранное - Показать избранные анкеты\n"
+            "• Настройки - Настройки поиска\n"
+            "• Помощь - Эта справка\n\n"
+            "👁️ Во время просмотра:\n"
+            "• Далее - Следующая анкета\n"
+            "• В избранное - Добавить в избранное\n"
+            "• Не нравится - Пропустить анкету\n"
+            "• В меню - Вернуться в главное меню"
+        )
+        self.send_message(user_id, help_text,
+                          keyboard=self.keyboards['main'])
+
+    def return_to_menu(self, session: SASession, user_id: int, message: str) -> None:
+        """Возврат в главное меню"""
+        self.send_message(user_id, message, keyboard=self.keyboards['main'])
+        self.state_manager.clear_state(session, user_id)
+
+    def stats(self) -> Dict[str, Dict]:
+        # Метрики: пул соединений БД, фильтры просмотренных (ложные срабатывания),
+        # кэш фото и отброшенные буфером записи события
+        return {
+            'db_pool': db_manager.pool_stats(),
+            'seen_filters': seen_filters.stats(),
+            'photo_cache': photo_cache.stats(),
+            'write_buffer': {'dropped': self.write_buffer.dropped}
+        }
+
+    def _log_stats_if_due(self) -> None:
+        if not settings.STATS_LOG_INTERVAL_SEC:
+            return
+        now = time.monotonic()
+        if now - self._stats_logged_at >= settings.STATS_LOG_INTERVAL_SEC:
+            self._stats_logged_at = now
+            logger.info(f"Метрики: {self.stats()}")
+
     def run(self) -> None:
         # Запуск бота
         logger.info("Бот запущен")
+        if self.harvester:
+            self.harvester.start()
+        if self.refresher:
+            self.refresher.start()
 
         try:
             for event in self.longpoll.listen():
                 if event.type == VkEventType.MESSAGE_NEW and event.to_me:
                     request = event.text
                     user_id = event.user_id
-                    if user_id and request:
+                    payload = self._parse_payload(getattr(event, 'payload', None))
+                    if user_id and (request or payload):
                         try:
-                            self.handle_message(user_id, request)
+                            # Одна сессия и одна транзакция на входящее событие
+                            with db_manager.track_request(f"Сообщение от {user_id}"), \
+                                    db_manager.unit_of_work(user_id) as session:
+                                self.handle_message(session, user_id, request or "", payload)
                         except Exception as e:
                             logger.error(f"Ошибка в обработке сообщения: {e}",
                                          exc_info=True)
@@ -1178,7 +1352,17 @@ class VkBot:
                                                   keyboard=self.keyboards['main'])
                             except Exception as e2:
                                 logger.error(f"Ошибка отправки сообщения об ошибке: {e2}")
+                        self._log_stats_if_due()
         except KeyboardInterrupt:
             logger.info("Бот остановлен пользователем")
         except Exception as e:
-            logger.error(f"Критическая ошибка в работе бота: {e}", exc_info=True)
\ No newline at end of file
+            logger.error(f"Критическая ошибка в работе бота: {e}", exc_info=True)
+        finally:
+            self.prefetcher.shutdown()
+            self.history_purger.shutdown()
+            self.write_buffer.shutdown()
+            if self.harvester:
+                self.harvester.shutdown()
+            if self.refresher:
+                self.refresher.shutdown()
+            logger.info(f"Метрики: {self.stats()}")
\ No newline at end of file
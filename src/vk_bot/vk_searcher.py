@@ -1,8 +1,11 @@
 import requests
+import threading
 import time
-from typing import List, Dict, Optional
-from datetime import datetime
+from typing import List, Dict, Optional, Tuple
+from datetime import date
 import logging
+from src.database.birth_dates import parse_bdate, age_on
+from src.vk_bot.user_parser import VKUser, parse_users, loads
 
 logger = logging.getLogger(__name__)
 
@@ -20,17 +23,20 @@ class RateLimiter:
         self.last_request_time = 0
         self.request_count = 0
         self.reset_time = time.time()
+        # Запросы идут и из фоновых потоков (предзагрузка анкет)
+        self._lock = threading.Lock()
 
     def wait_if_needed(self):
         """Ожидание при необходимости"""
-        current_time = time.time()
-        time_since_last = current_time - self.last_request_time
+        with self._lock:
+            current_time = time.time()
+            time_since_last = current_time - self.last_request_time
 
-        if time_since_last < self.min_interval:
-            sleep_time = self.min_interval - time_since_last
-            time.sleep(sleep_time)
+            if time_since_last < self.min_interval:
+                sleep_time = self.min_interval - time_since_last
+                time.sleep(sleep_time)
 
-        self.last_request_time = time.time()
+            self.last_request_time = time.time()
 
 
 class VKSearcher:
@@ -39,6 +45,29 @@ class VKSearcher:
     API_URL = "https://api.vk.com/method/"
     API_VERSION = "5.131"
 
+    # Достаточно фото в альбоме профиля - отмеченные фото не нужны
+    ENOUGH_PROFILE_PHOTOS = 3
+
+    # Фото профиля и отмеченные фото за один запрос (VKScript для execute)
+    PHOTOS_EXECUTE_CODE = (
+        'var profile = API.photos.get({"owner_id": %(user_id)d, "album_id": "profile", '
+        '"extended": 1, "count": 30});'
+        'var tagged = null;'
+        'if (!profile || profile.count < %(enough)d) {'
+        'tagged = API.photos.getUserPhotos({"user_id": %(user_id)d, "extended": 1, "count": 30});'
+        '}'
+        'return {"profile": profile, "tagged": tagged};'
+    )
+
+    # Ограничение VK API на число запросов за один поиск
+    MAX_SEARCH_REQUESTS = 10
+
+    # Стратегии поиска: сортировка и смещения
+    SEARCH_STRATEGIES = [
+        {"sort": 0, "offset_range": range(0, 1000, 100)},  # по популярности
+        {"sort": 1, "offset_range": range(0, 500, 100)},   # по дате регистрации
+    ]
+
     def __init__(self, access_token: str):
         self.token = access_token
         self.rate_limiter = RateLimiter()
@@ -46,6 +75,8 @@ class VKSearcher:
         self.session.headers.update({
             'User-Agent': 'VKinder/1.0'
         })
+        # ID городов по названию - чтобы не запрашивать его на каждой странице поиска
+        self._city_ids: Dict[str, Optional[int]] = {}
 
     def _make_request(self, method: str, params: Dict) -> Optional[Dict]:
         """Выполнение запроса к VK API"""
@@ -60,7 +91,7 @@ class VKSearcher:
         try:
             response = self.session.get(url, params=params, timeout=30)
             response.raise_for_status()
-            data = response.json()
+            data = loads(response.content)
 
             if 'error' in data:
                 error = data['error']
@@ -97,8 +128,18 @@ class VKSearcher:
 
     def search_users(self, city: str, age_from: int, age_to: int,
                      sex: int = 0, offset: int = 0, count: int = 1000,
-                     sort: int = 0, hometown: str = None) -> List[Dict]:
-        """Упрощенный поиск пользователей"""
+                     sort: int = 0, hometown: str = None) -> Optional[List[VKUser]]:
+        """Упрощенный поиск пользователей (None - запрос не удался)"""
+        page = self.search_users_page(city, age_from, age_to, sex, offset, count, sort, hometown)
+        return page[0] if page is not None else None
+
+    def search_users_page(self, city: str, age_from: int, age_to: int,
+                          sex: int = 0, offset: int = 0, count: int = 1000,
+                          sort: int = 0, hometown: str = None) -> Optional[Tuple[List[VKUser], int]]:
+        """Страница users.search: (открытые профили, число записей в ответе VK)
+
+        None - запрос не удался. Ноль записей в ответе - выдача закончилась.
+        """
         logger.info(f"Поиск: город='{city}', возраст={age_from}-{age_to}, пол={sex}, offset={offset}, sort={sort}")
 
         # Получаем ID города
@@ -135,55 +176,64 @@ class VKSearcher:
 
         response = self._make_request('users.search', params)
 
-        if not response:
-            logger.warning("Пустой ответ от API")
-            return []
+        if response is None:
+            logger.warning("Нет ответа от API")
+            return None
 
         items = response.get('items', [])
         total_count = response.get('count', 0)
 
         logger.info(f"Всего найдено: {total_count}, возвращено: {len(items)}")
 
-        return self._parse_users_response(items)
+        return self._parse_users_response(items), len(items)
+
+    def get_users(self, vk_ids: List[int]) -> Optional[Tuple[List[VKUser], List[int]]]:
+        """Актуальные данные профилей (до 1000 за запрос)
+
+        Возвращает (открытые профили, id всех профилей из ответа VK, включая
+        закрытые и удаленные) или None, если запрос не удался.
+        """
+        if not vk_ids:
+            return [], []
+
+        response = self._make_request('users.get', {
+            'user_ids': ','.join(str(vk_id) for vk_id in vk_ids[:1000]),
+            'fields': 'photo_max_orig,sex,bdate,city,domain'
+        })
+
+        if response is None:
+            return None
+
+        answered_ids = [user['id'] for user in response if 'id' in user]
+        return self._parse_users_response(response), answered_ids
 
     def _get_city_id(self, city_name: str) -> Optional[int]:
         """Получение ID города"""
         if not city_name:
             return None
 
+        key = city_name.lower()
+        if key in self._city_ids:
+            return self._city_ids[key]
+
         city_data = self._make_request('database.getCities', {
             'q': city_name,
             'count': 1
         })
 
-        if city_data and city_data.get('items'):
-            return city_data['items'][0]['id']
-
-        logger.warning(f"Город '{city_name}' не найден")
-        return None
-
-    def _parse_users_response(self, users: List[Dict]) -> List[Dict]:
-        """Парсинг ответа с пользователями"""
-        parsed_users = []
-
-        for user in users:
-            if user.get('is_closed', False):
-                continue
-
-            parsed_user = {
-                'vk_id': user['id'],
-                'first_name': user.get('first_name', ''),
-                'last_name': user.get('last_name', ''),
-                'profile_url': self._get_profile_url(user),
-                'age': self._calculate_age(user.get('bdate')),
-                'sex': user.get('sex', 0),
-                'city': user.get('city', {}).get('title') if user.get('city') else None,
-                'photo_url': user.get('photo_max_orig')
-            }
+        if city_data is None:
+            # Ошибка запроса - не кэшируем
+            return None
 
-            parsed_users.append(parsed_user)
+        city_id = city_data['items'][0]['id'] if city_data.get('items') else None
+        if city_id is None:
+            logger.warning(f"Город '{city_name}' не найден")
+        self._city_ids[key] = city_id
+        return city_id
 
-        return parsed_users
+    def _parse_users_response(self, users: List[Dict]) -> List[VKUser]:
+        """Парсинг ответа с пользователями (закрытые профили пропускаются)"""
+        return parse_users(users)
 
     def _get_profile_url(self, user: Dict) -> str:
         """Получение URL профиля"""
@@ -192,28 +242,13 @@ class VKSearcher:
 
     def _calculate_age(self, bdate: Optional[str]) -> Optional[int]:
         """Расчет возраста по дате рождения"""
-        if not bdate:
-            return None
-
-        try:
-            parts = bdate.split('.')
-            if len(parts) != 3:
-                return None
-
-            day, month, year = map(int, parts)
-            birth_date = datetime(year, month, day)
-            today = datetime.now()
-
-            age = today.year - birth_date.year
-            if (today.month, today.day) < (birth_date.month, birth_date.day):
-                age -= 1
-
-            return age
-        except (ValueError, AttributeError):
+        birth_date, year_missing = parse_bdate(bdate)
+        if year_missing:
             return None
+        return age_on(birth_date)
 
-    def get_user_tagged_photos(self, user_id: int) -> List[Dict]:
-        """Получение фотографий, где отмечен пользователь"""
+    def get_user_tagged_photos(self, user_id: int) -> Optional[List[Dict]]:
+        """Получение фотографий, где отмечен пользователь (None - запрос не удался)"""
         params = {
             'user_id': user_id,
             'count': 30,
@@ -222,119 +257,138 @@ class VKSearcher:
 
         response = self._make_request('photos.getUserPhotos', params)
 
-        if not response:
-            return []
-
-        items = response.get('items', [])
-
-        # Сортируем по лайкам и берем топ-3
-        sorted_photos = sorted(
-            items,
-            key=lambda x: x.get('likes', {}).get('count', 0),
-            reverse=True
-        )[:3]
-
-        photos = []
-        for photo in sorted_photos:
-            sizes = photo.get('sizes', [])
-            if sizes:
-                # Берем фото максимального размера
-                size_types = ['w', 'z', 'y', 'x', 'm', 's']
-                selected_size = None
-
-                for size_type in size_types:
-                    for size in sizes:
-                        if size.get('type') == size_type:
-                            selected_size = size
-                            break
-                    if selected_size:
-                        break
-
-                if selected_size:
-                    photos.append({
-                        'url': selected_size['url'],
-                        'likes': photo.get('likes', {}).get('count', 0),
-                        'owner_id': photo.get('owner_id'),
-                        'id': photo.get('id')
-                    })
+        if response is None:
+            return None
 
-        return photos
+        return self._parse_photos(response.get('items', []))
 
     def smart_search_users(self, city: str, age_from: int, age_to: int,
-                           sex: int = 0, target_count: int = 1500) -> List[Dict]:
-        """Умный поиск с обходом ограничений VK API"""
+                           sex: int = 0, target_count: int = 1500,
+                           cursor: Optional[Dict] = None,
+                           max_requests: Optional[int] = None) -> List[VKUser]:
+        """Умный поиск с обходом ограничений VK API
+
+        cursor - позиция, с которой продолжить поиск ({'sort', 'offset',
+        'exhausted'}). После поиска обновляется на место остановки; когда все
+        стратегии пройдены, следующий поиск начинается сначала. Запрос, на
+        который VK не ответил, останавливает поиск - курсор остается на нем.
+        В cursor['requests_made'] записывается число сделанных запросов.
+        max_requests - не больше стольких запросов users.search (по умолчанию
+        MAX_SEARCH_REQUESTS).
+        """
         try:
             if city is None and sex == 0:
                 logger.warning("Мало параметров для поиска, будут использованы широкие критерии")
 
-            MAX_REQUESTS = 10  # Ограничение VK API
             all_users = []
+            seen_ids = set()
             requests_made = 0
-
-            # Стратегии поиска с ограничением по количеству запросов
-            strategies = [
-                {"sort": 0, "offset_range": range(0, 1000, 100)},  # по популярности
-                {"sort": 1, "offset_range": range(0, 500, 100)},   # по дате регистрации
-            ]
-
-            for strategy in strategies:
-                if len(all_users) >= target_count or requests_made >= MAX_REQUESTS:
+            if max_requests is None:
+                max_requests = self.MAX_SEARCH_REQUESTS
+
+            steps = self._search_steps()
+            position = self._cursor_position(steps, cursor)
+
+            while (position < len(steps) and len(all_users) < target_count
+                   and requests_made < max_requests):
+                sort, offset = steps[position]
+                page = self.search_users_page(
+                    city=city,
+                    age_from=age_from,
+                    age_to=age_to,
+                    sex=sex,
+                    offset=offset,
+                    sort=sort
+                )
+                requests_made += 1
+                if page is None:
+                    # Ошибка или лимит VK - повторим этот запрос при следующем поиске
                     break
 
-                for offset in strategy["offset_range"]:
-                    if len(all_users) >= target_count or requests_made >= MAX_REQUESTS:
-                        break
+                users, items_count = page
+                position += 1
+                new_users = [u for u in users if u['vk_id'] not in seen_ids]
+                seen_ids.update(u['vk_id'] for u in new_users)
+                all_users.extend(new_users)
+                if not items_count:
+                    # Выдача с этой сортировкой закончилась
+                    while position < len(steps) and steps[position][0] == sort:
+                        position += 1
 
-                    users = self.search_users(
-                        city=city,
-                        age_from=age_from,
-                        age_to=age_to,
-                        sex=sex,
-                        offset=offset,
-                        sort=strategy["sort"]
-                    )
-                    requests_made += 1
-
-                    if users:
-                        existing_ids = {u['vk_id'] for u in all_users}
-                        new_users = [u for u in users if u['vk_id'] not in existing_ids]
-                        all_users.extend(new_users)
+            if cursor is not None:
+                cursor.update(self._cursor_at(steps, position))
+                cursor['requests_made'] = requests_made
 
             return all_users[:target_count]
         except Exception as e:
             logger.error(f"Ошибка поиска: {e}")
         return []
 
-    def get_user_photos(self, user_id: int, include_tagged: bool = False) -> List[Dict]:
-        """Получение фотографий пользователя (профиль + отмеченные)"""
-        profile_photos = self.get_user_profile_photos(user_id)
-
-        if include_tagged:
-            tagged_photos = self.get_user_tagged_photos(user_id)
-            # Объединяем и сортируем по лайкам
-            all_photos = profile_photos + tagged_photos
-            all_photos.sort(key=lambda x: x.get('likes', 0), reverse=True)
-            return all_photos[:6]  # Возвращаем до 6 фото
-
-        return profile_photos
-
-
-    def get_user_profile_photos(self, user_id: int) -> List[Dict]:
-        """Получение только фотографий профиля"""
-        params = {
-            'owner_id': user_id,
-            'album_id': 'profile',
-            'extended': 1,
-            'count': 30
-        }
-
-        response = self._make_request('photos.get', params)
-
-        if not response:
-            return []
-
-        items = response.get('items', [])
+    def _search_steps(self) -> List[Tuple[int, int]]:
+        """Запросы users.search по порядку: (сортировка, смещение)"""
+        return [(strategy["sort"], offset)
+                for strategy in self.SEARCH_STRATEGIES
+                for offset in strategy["offset_range"]]
+
+    def _cursor_position(self, steps: List[Tuple[int, int]], cursor: Optional[Dict]) -> int:
+        """Номер запроса, с которого продолжить поиск"""
+        if not cursor:
+            return 0
+        if cursor.get('exhausted'):
+            logger.info("Все стратегии поиска пройдены, начинаем сначала")
+            return 0
+        try:
+            return steps.index((cursor.get('sort'), cursor.get('offset')))
+        except ValueError:
+            return 0
+
+    def _cursor_at(self, steps: List[Tuple[int, int]], position: int) -> Dict:
+        """Курсор, указывающий на запрос с номером position"""
+        if position >= len(steps):
+            return {'sort': None, 'offset': 0, 'exhausted': True}
+        sort, offset = steps[position]
+        return {'sort': sort, 'offset': offset, 'exhausted': False}
+
+    def get_user_photos(self, user_id: int, include_tagged: bool = False) -> Optional[List[Dict]]:
+        """Получение фотографий пользователя (профиль + отмеченные)
+
+        Оба списка запрашиваются одним вызовом execute. Отмеченные фото
+        не запрашиваются, если в альбоме профиля уже достаточно фотографий.
+        None - VK не ответил, [] - фотографий нет.
+        """
+        if not include_tagged:
+            return self.get_user_profile_photos(user_id)
+
+        response = self._make_request('execute', {
+            'code': self.PHOTOS_EXECUTE_CODE % {
+                'user_id': int(user_id),
+                'enough': self.ENOUGH_PROFILE_PHOTOS
+            }
+        })
 
+        if response is not None:
+            if not isinstance(response.get('profile'), dict):
+                # photos.get внутри execute завершился ошибкой
+                return None
+            profile_photos = self._parse_photos(response['profile'].get('items', []))
+            tagged_photos = self._parse_photos((response.get('tagged') or {}).get('items', []))
+        else:
+            # execute недоступен - запрашиваем по отдельности
+            profile_photos = self.get_user_profile_photos(user_id)
+            if profile_photos is None:
+                return None
+            tagged_photos = []
+            if len(profile_photos) < self.ENOUGH_PROFILE_PHOTOS:
+                # Без отмеченных фото обойдемся, если альбом профиля получен
+                tagged_photos = self.get_user_tagged_photos(user_id) or []
+
+        # Объединяем и сортируем по лайкам
+        all_photos = profile_photos + tagged_photos
+        all_photos.sort(key=lambda x: x.get('likes', 0), reverse=True)
+        return all_photos[:6]  # Возвращаем до 6 фото
+
+    def _parse_photos(self, items: List[Dict]) -> List[Dict]:
+        """Топ-3 фото по лайкам в максимальном размере"""
         # Сортируем по лайкам и берем топ-3
         sorted_photos = sorted(
             items,
@@ -368,11 +422,30 @@ class VKSearcher:
 
         return photos
 
+    def get_user_profile_photos(self, user_id: int) -> Optional[List[Dict]]:
+        """Получение только фотографий профиля (None - запрос не удался)"""
+        params = {
+            'owner_id': user_id,
+            'album_id': 'profile',
+            'extended': 1,
+            'count': 30
+        }
+
+        response = self._make_request('photos.get', params)
+
+        if response is None:
+            return None
+
+        return self._parse_photos(response.get('items', []))
+
     def search_by_interests(self, city: str, interests: List[str], age_from: int = 18,
-                            age_to: int = 45, sex: int = 0, limit: int = 100) -> List[Dict]:
+                            age_to: int = 45, sex: int = 0, limit: int = 100) -> List[VKUser]:
         """Поиск пользователей по интересам через группы"""
 
         found_users = []
+        found_ids = set()
+        # Возраст всех участников считается на одну дату
+        today = date.today()
 
         for interest in interests[:3]:  # Ограничиваем 3 интересами
             # Ищем группы по интересу
@@ -399,39 +472,25 @@ class VKSearcher:
                     continue
 
                 # Фильтруем по параметрам
-                for user in members.get('items', []):
-                    if user.get('is_closed', False):
-                        continue
-
+                for user in parse_users(members.get('items', []), today):
                     # Проверяем возраст
-                    age = self._calculate_age(user.get('bdate'))
-                    if not (age_from <= age <= age_to):
+                    if user.age is None or not (age_from <= user.age <= age_to):
                         continue
 
                     # Проверяем пол
-                    if sex != 0 and user.get('sex', 0) != sex:
+                    if sex != 0 and user.sex != sex:
                         continue
 
                     # Проверяем город
-                    user_city = user.get('city', {}).get('title') if user.get('city') else None
-                    if city and user_city and user_city.lower() != city.lower():
+                    if city and user.city and user.city.lower() != city.lower():
                         continue
 
-                    # Добавляем пользователя
-                    parsed_user = {
-                        'vk_id': user['id'],
-                        'first_name': user.get('first_name', ''),
-                        'last_name': user.get('last_name', ''),
-                        'profile_url': self._get_profile_url(user),
-                        'age': age,
-                        'sex': user.get('sex', 0),
-                        'city': user_city,
-                        'interests': [interest]
-                    }
-
                     # Проверяем дубликаты
-                    if not any(u['vk_id'] == parsed_user['vk_id'] for u in found_users):
-                        found_users.append(parsed_user)
+                    if user.vk_id in found_ids:
+                        continue
+                    user.interests = [interest]
+                    found_ids.add(user.vk_id)
+                    found_users.append(user)
 
                     if len(found_users) >= limit:
                         return found_users